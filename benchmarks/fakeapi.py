@@ -0,0 +1,411 @@
+"""
+Offline Bot API stand-in.
+A local HTTP server implementing the Bot API methods used by the bot (getMe, deleteWebhook, getUpdates, sendMessage,
+editMessageText, answerCallbackQuery, deleteMessage), with configurable latency, 429 injection on the flood limited
+methods and recording of every outbound call. Point the bot at it with TELEGRAM_BASE_URL=http://HOST:PORT/bot
+
+Usage: python -m benchmarks.fakeapi [--port 8081] [--latency 0.05] [--flood-rate 0.01]
+"""
+
+import argparse
+import itertools
+import json
+import logging
+import random
+import threading
+import time
+from http import HTTPStatus
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qsl, urlsplit
+
+# Same flood limited methods of the outbound scheduler
+RATE_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+
+BOT_USER = {"id": 1, "is_bot": True, "first_name": "Fake", "username": "fake_bot"}
+MAX_POLL_TIMEOUT = 30
+
+logger = logging.getLogger(__name__)
+
+
+class FakeBotApiError(Exception):
+    """
+    Bot API error returned to the client
+    """
+
+    def __init__(self, error_code: int, description: str, parameters: dict = None):
+        """
+        Init method
+        :param error_code: error code
+        :param description: error description
+        :param parameters: response parameters (E.g. retry_after)
+        """
+        super().__init__(description)
+        self.error_code = error_code
+        self.description = description
+        self.parameters = parameters
+
+
+class FakeBotApiRequestHandler(BaseHTTPRequestHandler):
+    """
+    Bot API request handler, serving /bot<token>/<method>
+    """
+
+    server: "FakeBotApi"
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def do_GET(self):
+        """
+        Handle a GET request
+        """
+        self.do_POST()
+
+    def do_POST(self):
+        """
+        Handle a POST request
+        """
+        url = urlsplit(self.path)
+        prefix, _, method = url.path.rpartition("/")
+        if not prefix.startswith("/bot"):
+            self.reply(HTTPStatus.NOT_FOUND, {"ok": False, "error_code": 404, "description": "Not Found"})
+            return
+
+        params = dict(parse_qsl(url.query))
+        length = int(self.headers.get("Content-Length") or 0)
+        if length:
+            body = self.rfile.read(length)
+            if self.headers.get("Content-Type", "").startswith("application/json"):
+                params.update(json.loads(body))
+            else:
+                params.update(parse_qsl(body.decode()))
+
+        try:
+            result = self.server.call(method, params)
+        except FakeBotApiError as e:
+            response = {"ok": False, "error_code": e.error_code, "description": e.description}
+            if e.parameters:
+                response["parameters"] = e.parameters
+            self.reply(e.error_code, response)
+            return
+
+        self.reply(HTTPStatus.OK, {"ok": True, "result": result})
+
+    def reply(self, status: int, response: dict):
+        """
+        Send the JSON response
+        :param status: HTTP status
+        :param response: response
+        """
+        body = json.dumps(response).encode()
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        """
+        Redirect the request log to the module logger
+        :param format: format
+        :param args: args
+        """
+        logger.debug(format, *args)
+
+
+class FakeBotApi(ThreadingHTTPServer):
+    """
+    Fake Bot API server.
+    Updates pushed with push_update are served by getUpdates (long polling is supported), every other call is
+    recorded with its arrival time, so a load generator can match the bot replies with the updates it pushed
+    """
+
+    daemon_threads = True
+
+    def __init__(self, host: str = "127.0.0.1", port: int = 0, latency: float = 0.0, flood_rate: float = 0.0,
+                 retry_after: int = 1, seed: int = None):
+        """
+        Init method
+        :param host: listen host
+        :param port: listen port (0 to pick a free port)
+        :param latency: delay added to every call, except getUpdates
+        :param flood_rate: probability of a 429 error on the flood limited methods
+        :param retry_after: retry_after of the injected 429 errors
+        :param seed: random seed of the 429 injection
+        """
+        super().__init__((host, port), FakeBotApiRequestHandler)
+        self.latency = latency
+        self.flood_rate = flood_rate
+        self.retry_after = retry_after
+        self.random = random.Random(seed)
+        self.updates = []
+        self.update_ids = itertools.count(1)
+        self.message_ids = itertools.count(1)
+        self.calls = []
+        self.flood_errors = 0
+        self.polling = threading.Event()
+        self._condition = threading.Condition()
+        self._thread = None
+        self.methods = {
+            "getMe": self.get_me,
+            "deleteWebhook": self.delete_webhook,
+            "getUpdates": self.get_updates,
+            "sendMessage": self.send_message,
+            "editMessageText": self.edit_message_text,
+            "answerCallbackQuery": self.answer_callback_query,
+            "deleteMessage": self.delete_message,
+        }
+
+    @property
+    def base_url(self):
+        """
+        Base URL to use as TELEGRAM_BASE_URL
+        :return: the base URL
+        """
+        return f"http://{self.server_address[0]}:{self.server_address[1]}/bot"
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name="fakeapi", daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        """
+        Stop serving requests
+        """
+        with self._condition:
+            self._condition.notify_all()
+        self.shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
+
+    def push_update(self, update: dict):
+        """
+        Queue an update for getUpdates
+        :param update: update, without update_id
+        :return: the update id
+        """
+        with self._condition:
+            update_id = next(self.update_ids)
+            self.updates.append({"update_id": update_id, **update})
+            self._condition.notify_all()
+
+        return update_id
+
+    def call_count(self):
+        """
+        Number of recorded calls
+        :return: the number of recorded calls
+        """
+        with self._condition:
+            return len(self.calls)
+
+    def wait_call(self, predicate, start: int = 0, timeout: float = None):
+        """
+        Wait a recorded call matching the predicate
+        :param predicate: function of the call returning True when call matches
+        :param start: index of the first call to check
+        :param timeout: max wait, None to wait forever
+        :return: the matching call, None on timeout
+        """
+        deadline = None if timeout is None else time.monotonic() + timeout
+        with self._condition:
+            while True:
+                for call in self.calls[start:]:
+                    if predicate(call):
+                        return call
+                start = len(self.calls)
+
+                remaining = None if deadline is None else deadline - time.monotonic()
+                if remaining is not None and remaining <= 0:
+                    return None
+                self._condition.wait(remaining)
+
+    def method_counts(self):
+        """
+        Count the recorded calls by method
+        :return: dict of method -> calls
+        """
+        counts = dict()
+        with self._condition:
+            for call in self.calls:
+                counts[call["method"]] = counts.get(call["method"], 0) + 1
+
+        return counts
+
+    def call(self, method: str, params: dict):
+        """
+        Execute a Bot API call
+        :param method: Bot API method
+        :param params: call params
+        :return: the call result
+        :raise FakeBotApiError: if method is unknown or a 429 is injected
+        """
+        handler = self.methods.get(method)
+        if handler is None:
+            raise FakeBotApiError(HTTPStatus.NOT_FOUND, "Not Found: method not found")
+
+        if method == "getUpdates":
+            return handler(params)
+
+        arrival = time.monotonic()
+        if self.latency:
+            time.sleep(self.latency)
+
+        if self.flood_rate and method.startswith(RATE_LIMITED_PREFIXES) and self.random.random() < self.flood_rate:
+            with self._condition:
+                self.flood_errors += 1
+            raise FakeBotApiError(
+                HTTPStatus.TOO_MANY_REQUESTS,
+                f"Too Many Requests: retry after {self.retry_after}",
+                {"retry_after": self.retry_after},
+            )
+
+        result = handler(params)
+        with self._condition:
+            self.calls.append({"method": method, "params": params, "result": result, "time": arrival})
+            self._condition.notify_all()
+
+        return result
+
+    # noinspection PyUnusedLocal
+    def get_me(self, params: dict):
+        """
+        getMe method
+        :param params: call params
+        :return: the bot user
+        """
+        return BOT_USER
+
+    # noinspection PyUnusedLocal
+    def delete_webhook(self, params: dict):
+        """
+        deleteWebhook method
+        :param params: call params
+        :return: True
+        """
+        return True
+
+    def get_updates(self, params: dict):
+        """
+        getUpdates method. Updates before the offset are confirmed and removed
+        :param params: call params
+        :return: the pending updates
+        """
+        offset = int(params.get("offset") or 0)
+        limit = int(params.get("limit") or 100)
+        deadline = time.monotonic() + min(float(params.get("timeout") or 0), MAX_POLL_TIMEOUT)
+
+        self.polling.set()
+        with self._condition:
+            while True:
+                self.updates = [update for update in self.updates if update["update_id"] >= offset]
+                remaining = deadline - time.monotonic()
+                if self.updates or remaining <= 0:
+                    return self.updates[:limit]
+                self._condition.wait(remaining)
+
+    def send_message(self, params: dict):
+        """
+        sendMessage method
+        :param params: call params
+        :return: the sent message
+        """
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+        reply_markup = decode_reply_markup(params.get("reply_markup"))
+        if reply_markup and "inline_keyboard" in reply_markup:
+            message["reply_markup"] = reply_markup
+
+        return message
+
+    def edit_message_text(self, params: dict):
+        """
+        editMessageText method
+        :param params: call params
+        :return: the edited message
+        """
+        if params.get("inline_message_id"):
+            return True
+
+        message = {
+            "message_id": int(params["message_id"]),
+            "date": int(time.time()),
+            "edit_date": int(time.time()),
+            "chat": {"id": int(params["chat_id"]), "type": "private"},
+            "from": BOT_USER,
+            "text": params.get("text", ""),
+        }
+
+        reply_markup = decode_reply_markup(params.get("reply_markup"))
+        if reply_markup:
+            message["reply_markup"] = reply_markup
+
+        return message
+
+    # noinspection PyUnusedLocal
+    def answer_callback_query(self, params: dict):
+        """
+        answerCallbackQuery method
+        :param params: call params
+        :return: True
+        """
+        return True
+
+    # noinspection PyUnusedLocal
+    def delete_message(self, params: dict):
+        """
+        deleteMessage method
+        :param params: call params
+        :return: True
+        """
+        return True
+
+
+def decode_reply_markup(reply_markup):
+    """
+    Decode the reply markup param, sent as JSON string
+    :param reply_markup: reply markup param
+    :return: the reply markup, None if not filled
+    """
+    if isinstance(reply_markup, str):
+        return json.loads(reply_markup)
+
+    return reply_markup
+
+
+def main():
+    """
+    Run the fake Bot API until interrupted
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8081)
+    parser.add_argument("--latency", type=float, default=0.0, help="seconds added to every call")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a 429 error")
+    parser.add_argument("--retry-after", type=int, default=1)
+    args = parser.parse_args()
+
+    logging.basicConfig(format="%(asctime)s - %(name)s - %(levelname)s - %(message)s", level=logging.INFO)
+
+    server = FakeBotApi(args.host, args.port, args.latency, args.flood_rate, args.retry_after)
+    logger.info("Fake Bot API listening, set TELEGRAM_BASE_URL=%s", server.base_url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+        logger.info("Recorded calls: %s, injected flood errors: %s", server.method_counts(), server.flood_errors)
+
+
+if __name__ == "__main__":
+    main()
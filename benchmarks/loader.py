@@ -0,0 +1,105 @@
+"""
+Shifts loader benchmark.
+Compare peak RSS and load time of the json.load based loader against the streaming loader and the compiled
+snapshot on a synthetic file.
+
+Usage: python -m benchmarks.loader [--groups 500] [--years 5]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import subprocess
+import sys
+import tempfile
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+MEASURE_SCRIPT = """
+import resource, sys, time
+from shift import shiftsheduling
+baseline = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+start = time.perf_counter()
+if sys.argv[2] == "snapshot":
+    store = shiftsheduling.read_shifts(sys.argv[1])
+elif sys.argv[2] != "none":
+    store = shiftsheduling.parse_shifts(sys.argv[1], streaming=sys.argv[2] == "streaming")
+elapsed = time.perf_counter() - start
+print(elapsed, baseline, resource.getrusage(resource.RUSAGE_SELF).ru_maxrss)
+"""
+
+
+def write_shifts_file(file, groups: int, years: int, start: datetime.date = datetime.date(2022, 1, 3)):
+    """
+    Write a synthetic shifts file, with a shift for every working day
+    :param file: output file
+    :param groups: number of groups
+    :param years: number of years
+    :param start: first date
+    """
+    dates = [
+        (start + datetime.timedelta(days=i)).isoformat()
+        for i in range(years * 365)
+        if (start + datetime.timedelta(days=i)).weekday() < 5
+    ]
+
+    with open(file, "w") as f:
+        f.write('{"groups": [')
+        for group in range(groups):
+            if group:
+                f.write(", ")
+            json.dump(
+                {
+                    "name": f"GROUP_{group}",
+                    "shifts": [{"date": date, "presence": (i + group) % 2 == 0} for i, date in enumerate(dates)],
+                },
+                f,
+            )
+        f.write("]}")
+
+
+def measure(file, mode: str):
+    """
+    Load the file in a fresh interpreter
+    :param file: shifts file
+    :param mode: loader mode (json, streaming, snapshot or none for interpreter baseline)
+    :return: tuple of (load time in seconds, peak RSS in KiB)
+    """
+    output = subprocess.run(
+        [sys.executable, "-c", MEASURE_SCRIPT, file, mode],
+        check=True,
+        capture_output=True,
+        text=True,
+        cwd=ROOT_DIR,
+    ).stdout.split()
+
+    return float(output[0]), int(output[2])
+
+
+def main():
+    """
+    Benchmark entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--groups", type=int, default=500)
+    parser.add_argument("--years", type=int, default=5)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        file = os.path.join(tmp, "shifts.json")
+        write_shifts_file(file, args.groups, args.years)
+        print(f"File: {args.groups} groups x {args.years} years, {os.path.getsize(file) / 2 ** 20:.1f} MiB")
+
+        # Compile in a child process: peak RSS is inherited by the processes spawned later
+        subprocess.run([sys.executable, "-m", "shift.snapshot", "compile", file], check=True, cwd=ROOT_DIR,
+                       capture_output=True)
+
+        _, baseline_rss = measure(file, "none")
+        for mode in ("json", "streaming", "snapshot"):
+            elapsed, rss = measure(file, mode)
+            print(f"{mode:>10}: {elapsed:8.3f}s  peak RSS {rss / 1024:8.1f} MiB "
+                  f"({(rss - baseline_rss) / 1024:.1f} MiB over interpreter baseline)")
+
+if __name__ == "__main__":
+    main()
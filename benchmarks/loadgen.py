@@ -0,0 +1,267 @@
+"""
+End-to-end load generator.
+Start the fake Bot API and the bot (main.py, in a subprocess pointed at the fake API with TELEGRAM_BASE_URL), then
+simulate users doing /login, /turni with page flips, /domani and a reminder setup. Every user waits the bot reply
+before the next action, the latency of an action is the time from the update to the first reply call of its chat.
+
+The bot runs with the environment of the caller, so the bot settings can be tuned as usual
+(E.g. OUTBOUND_CHAT_RATE=100 UPDATE_WORKERS=8 python -m benchmarks.loadgen).
+
+Usage: python -m benchmarks.loadgen [--users 50] [--rounds 3] [--groups 10] [--latency 0.0] [--flood-rate 0.0]
+"""
+
+import argparse
+import itertools
+import json
+import os
+import signal
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+
+from benchmarks.fakeapi import FakeBotApi
+from shift import bot, notifications
+from shift.constants import GROUP_PREFIX, get_shifts_filename
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIRST_USER_ID = 1000
+REPLY_METHODS = ("sendMessage", "editMessageText", "deleteMessage")
+REPLY_TIMEOUT = 30
+
+
+def percentile(values: list, percent: float):
+    """
+    Nearest rank percentile
+    :param values: values
+    :param percent: percentile (0-100)
+    :return: the percentile, None if values is empty
+    """
+    if not values:
+        return None
+
+    values = sorted(values)
+    return values[min(len(values) - 1, max(0, round(percent / 100 * len(values)) - 1))]
+
+
+def write_shifts(data_dir: str, groups: int):
+    """
+    Write a shifts file with a weekly rotation for every group
+    :param data_dir: data directory
+    :param groups: number of groups
+    """
+    shifts = {"groups": [
+        {
+            "name": f"{GROUP_PREFIX}{group}",
+            "rules": [
+                {"weekdays": [group % 5, (group + 1) % 5], "weeks": "odd", "presence": True},
+                {"weekdays": [0, 1, 2, 3, 4], "presence": False},
+            ],
+        }
+        for group in range(1, groups + 1)
+    ]}
+
+    with open(os.path.join(data_dir, get_shifts_filename()), "w") as f:
+        json.dump(shifts, f)
+
+
+class SimulatedUser:
+    """
+    Simulated user, sending updates to the fake Bot API and waiting the bot replies
+    """
+
+    message_ids = itertools.count(1)
+
+    def __init__(self, api: FakeBotApi, user_id: int, group: int):
+        """
+        Init method
+        :param api: fake Bot API
+        :param user_id: user id
+        :param group: group number
+        """
+        self.api = api
+        self.user_id = user_id
+        self.group = group
+        self.user = {"id": user_id, "is_bot": False, "first_name": f"user{user_id}"}
+        self.chat = {"id": user_id, "type": "private"}
+        self.last_message = None
+        self.latencies = dict()
+        self.errors = 0
+
+    def send_text(self, name: str, text: str):
+        """
+        Send a text message (a command if text starts with /)
+        :param name: action name
+        :param text: text
+        """
+        message = {
+            "message_id": next(self.message_ids),
+            "date": int(time.time()),
+            "chat": self.chat,
+            "from": self.user,
+            "text": text,
+        }
+        if text.startswith("/"):
+            message["entities"] = [{"type": "bot_command", "offset": 0, "length": len(text.split()[0])}]
+
+        self.act(name, {"message": message})
+
+    def press(self, name: str, action: str):
+        """
+        Press the inline button of the action in the last bot message
+        :param name: action name
+        :param action: callback action
+        """
+        buttons = (self.last_message or {}).get("reply_markup", {}).get("inline_keyboard", [])
+        data = next(
+            (button["callback_data"] for row in buttons for button in row
+             if button.get("callback_data", "").partition("#")[0] == action),
+            None,
+        )
+        if data is None:
+            self.errors += 1
+            return
+
+        self.act(name, {"callback_query": {
+            "id": f"{self.user_id}-{next(self.message_ids)}",
+            "from": self.user,
+            "chat_instance": str(self.user_id),
+            "message": self.last_message,
+            "data": data,
+        }})
+
+    def act(self, name: str, update: dict):
+        """
+        Push the update and wait the bot reply
+        :param name: action name
+        :param update: update
+        """
+        start = self.api.call_count()
+        pushed = time.monotonic()
+        self.api.push_update(update)
+
+        call = self.api.wait_call(self.is_reply, start, REPLY_TIMEOUT)
+        if call is None:
+            self.errors += 1
+            return
+
+        self.latencies.setdefault(name, []).append(call["time"] - pushed)
+        if isinstance(call["result"], dict):
+            self.last_message = call["result"]
+
+    def is_reply(self, call: dict):
+        """
+        Return if the call is a reply to this user
+        :param call: recorded call
+        :return: True if call is a reply, False otherwise
+        """
+        return call["method"] in REPLY_METHODS and str(call["params"].get("chat_id")) == str(self.user_id)
+
+    def run(self, rounds: int):
+        """
+        Run the user session
+        :param rounds: number of /turni, page flips and /domani rounds
+        """
+        self.send_text("/login", "/login")
+        self.send_text("group", str(self.group))
+
+        for _ in range(rounds):
+            self.send_text("/turni", "/turni")
+            self.press("next", bot.SHIFTS_NEXT_CALLBACK)
+            self.press("previous", bot.SHIFTS_PREVIOUS_CALLBACK)
+            self.send_text("/domani", "/domani")
+
+        self.send_text("/notifiche", "/notifiche")
+        self.press("add", notifications.NOTIFICATION_ADD_CALLBACK)
+        self.press("type", notifications.REMIND_OFFICE_CALLBACK)
+        self.press("days", notifications.CHOOSE_TIME_CALLBACK)
+        self.send_text("time", "18:30")
+
+
+def start_bot(api: FakeBotApi, data_dir: str, users: int):
+    """
+    Start the bot in a subprocess, pointed at the fake Bot API. Simulated users are admins, so they are enabled
+    :param api: fake Bot API
+    :param data_dir: data directory
+    :param users: number of users
+    :return: the bot process
+    """
+    env = dict(
+        os.environ,
+        TELEGRAM_TOKEN="123456:loadgen",
+        TELEGRAM_BASE_URL=api.base_url,
+        DATA_DIR=data_dir,
+        ADMIN_USERS=",".join(str(FIRST_USER_ID + i) for i in range(users)),
+    )
+    env.pop("WEBHOOK_URL", None)
+
+    return subprocess.Popen(
+        [sys.executable, os.path.join(ROOT_DIR, "main.py")],
+        cwd=data_dir,
+        env=env,
+        stdout=subprocess.DEVNULL,
+        stderr=None if os.getenv("LOADGEN_BOT_LOG") else subprocess.DEVNULL,
+    )
+
+
+def main():
+    """
+    Load generator entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--users", type=int, default=50)
+    parser.add_argument("--rounds", type=int, default=3)
+    parser.add_argument("--groups", type=int, default=10)
+    parser.add_argument("--latency", type=float, default=0.0, help="fake Bot API latency in seconds")
+    parser.add_argument("--flood-rate", type=float, default=0.0, help="probability of a 429 error")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    api = FakeBotApi(latency=args.latency, flood_rate=args.flood_rate, seed=args.seed)
+    api.start()
+
+    with tempfile.TemporaryDirectory() as data_dir:
+        write_shifts(data_dir, args.groups)
+        process = start_bot(api, data_dir, args.users)
+
+        try:
+            if not api.polling.wait(60) or process.poll() is not None:
+                raise SystemExit("Bot didn't start polling the fake Bot API (set LOADGEN_BOT_LOG=1 to see its log)")
+
+            users = [SimulatedUser(api, FIRST_USER_ID + i, i % args.groups + 1) for i in range(args.users)]
+            threads = [threading.Thread(target=user.run, args=(args.rounds,)) for user in users]
+
+            start = time.monotonic()
+            for thread in threads:
+                thread.start()
+            for thread in threads:
+                thread.join()
+            elapsed = time.monotonic() - start
+        finally:
+            process.send_signal(signal.SIGINT)
+            try:
+                process.wait(30)
+            except subprocess.TimeoutExpired:
+                process.kill()
+            api.stop()
+
+    latencies = dict()
+    for user in users:
+        for name, values in user.latencies.items():
+            latencies.setdefault(name, []).extend(values)
+    all_latencies = [value for values in latencies.values() for value in values]
+
+    print(f"{args.users} users, {args.rounds} rounds, {len(all_latencies)} updates in {elapsed:.2f}s: "
+          f"{len(all_latencies) / elapsed:.1f} updates/s, {sum(user.errors for user in users)} errors")
+    print(f"{'action':>12} {'count':>7} {'p50 ms':>9} {'p99 ms':>9}")
+    for name, values in itertools.chain(latencies.items(), [("all", all_latencies)]):
+        print(f"{name:>12} {len(values):7d} {percentile(values, 50) * 1000:9.1f} {percentile(values, 99) * 1000:9.1f}")
+
+    print(f"Outbound calls: {api.method_counts()}, injected 429: {api.flood_errors}")
+
+
+if __name__ == "__main__":
+    main()
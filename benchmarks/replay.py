@@ -0,0 +1,294 @@
+"""
+Update stream replay.
+Feed a recording made with RECORD_UPDATES back into the handlers registered by run(), against a copy of the
+persistence, at the recorded speed (--speed 1), N times faster (--speed N) or as fast as possible (--speed 0).
+Outbound calls go to the offline fake Bot API.
+
+The copy of the persistence is remapped with the pseudonymous ids of the recording when the RECORD_KEY used to
+record is given (--key or RECORD_KEY env), so replayed users find their data. The reminder index is rebuilt.
+
+Output: per handler timing, persistence write counts and outbound call counts.
+
+Usage: python -m benchmarks.replay updates.jsonl.gz [--data-dir DIR] [--speed 0] [--key KEY] [--workers N] [--json]
+"""
+
+import argparse
+import json
+import os
+import shutil
+import tempfile
+import time
+import warnings
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+
+from telegram import Update
+from telegram.ext import PicklePersistence
+from telegram.utils.deprecate import TelegramDeprecationWarning
+
+from benchmarks.fakeapi import FakeBotApi
+from benchmarks.loadgen import percentile
+from shift import bot, broadcast, concurrency, notifications, outbound, shiftsheduling
+from shift.constants import *
+from shift.helpers import sign_callback_data
+from shift.recorder import pseudonym, read_recording
+from shift.reminders import SLOT_KEY_PREFIX
+from shift.router import UpdateRouter
+from shift.snapshot import get_snapshot_filename
+from shift.sqlitepersistence import SQLitePersistence
+from shift.userindex import USER_INDEX_KEY_PREFIX, USER_INDEX_VERSION
+
+PERSISTENCE_METHODS = ("update_user_data", "update_chat_data", "update_bot_data", "flush")
+
+
+def copy_data_dir(data_dir: str, target_dir: str):
+    """
+    Copy the persistence and shifts files
+    :param data_dir: data directory
+    :param target_dir: target directory
+    """
+    shifts_file = get_shifts_filename()
+    for name in (get_database_name(), get_sqlite_database_name(), shifts_file, get_snapshot_filename(shifts_file)):
+        if os.path.exists(os.path.join(data_dir, name)):
+            shutil.copy2(os.path.join(data_dir, name), os.path.join(target_dir, name))
+
+
+def iter_persisted_user_data(persistence):
+    """
+    Iterate the user data of a persistence
+    :param persistence: persistence
+    :return: iterator of (user id, user data)
+    """
+    if isinstance(persistence, SQLitePersistence):
+        return persistence.iter_user_data()
+
+    return iter(persistence.get_user_data().items())
+
+
+def remap_bot_data(bot_data: dict, remap):
+    """
+    Remap the user ids of bot data. Reminder and user indexes are dropped, so they're rebuilt from the remapped user
+    data, and the broadcast campaign is dropped, so it isn't resumed
+    :param bot_data: bot data
+    :param remap: function mapping a user id to its pseudonym
+    :return: the remapped bot data
+    """
+    result = dict()
+    for key, value in bot_data.items():
+        if key.startswith((SLOT_KEY_PREFIX, USER_INDEX_KEY_PREFIX)) or key in (
+            notifications.REMINDER_INDEX_VERSION,
+            USER_INDEX_VERSION,
+            broadcast.BROADCAST_CAMPAIGN,
+        ):
+            continue
+
+        if key == ENABLED_USERS:
+            value = {remap(user_id) for user_id in value}
+        elif key == bot.PENDING_APPROVAL:
+            value = dict.fromkeys(remap(user_id) for user_id in value)
+
+        result[key] = value
+
+    return result
+
+
+def copy_persistence(source_dir: str, target_dir: str, remap):
+    """
+    Copy the persistence, remapping the user and chat ids
+    :param source_dir: directory of the source persistence
+    :param target_dir: directory of the target persistence (same backend)
+    :param remap: function mapping a user or chat id to its pseudonym
+    """
+    source = bot.create_persistence(source_dir)
+    target = bot.create_persistence(target_dir)
+    # Pickle persistence writes the whole file on every update unless it's written on flush
+    if isinstance(target, PicklePersistence):
+        target.on_flush = True
+
+    for user_id, data in iter_persisted_user_data(source):
+        target.update_user_data(remap(user_id), data)
+    for chat_id, data in source.get_chat_data().items():
+        target.update_chat_data(remap(chat_id), data)
+    target.update_bot_data(remap_bot_data(source.get_bot_data(), remap))
+
+    target.flush()
+    for persistence in (source, target):
+        if isinstance(persistence, SQLitePersistence):
+            persistence.close()
+
+
+def instrument_handlers(dispatcher, timings: dict):
+    """
+    Time every handler, by callback name
+    :param dispatcher: dispatcher
+    :param timings: dict of callback name -> list of durations, filled by the handlers
+    """
+    for handlers in dispatcher.handlers.values():
+        for handler in handlers:
+            handle_update = handler.handle_update
+
+            def timed(update, dispatcher_, check_result, context=None, handler=handler, handle_update=handle_update):
+                """
+                Handle the update, recording its duration
+                """
+                callback = check_result if isinstance(handler, UpdateRouter) else handler.callback
+                start = time.perf_counter()
+                try:
+                    return handle_update(update, dispatcher_, check_result, context)
+                finally:
+                    timings.setdefault(callback.__name__, []).append(time.perf_counter() - start)
+
+            with warnings.catch_warnings():
+                warnings.simplefilter("ignore", TelegramDeprecationWarning)
+                handler.handle_update = timed
+
+
+def instrument_persistence(persistence, counts: dict):
+    """
+    Count the persistence writes, by method
+    :param persistence: persistence
+    :param counts: dict of method -> calls, filled by the persistence
+    """
+    for name in PERSISTENCE_METHODS:
+        method = getattr(persistence, name)
+
+        def counted(*args, name=name, method=method, **kwargs):
+            """
+            Call the persistence method, counting it
+            """
+            counts[name] = counts.get(name, 0) + 1
+            return method(*args, **kwargs)
+
+        with warnings.catch_warnings():
+            warnings.simplefilter("ignore", TelegramDeprecationWarning)
+            setattr(persistence, name, counted)
+
+
+def resign_callback_data(data: dict):
+    """
+    Sign again the callback data of a recorded update for its (pseudonymous) user
+    :param data: update dict
+    :return: the update dict
+    """
+    query = data.get("callback_query")
+    if query and "#" in query.get("data", "") and "." not in query["data"]:
+        action, _, argument = query["data"].partition("#")
+        query["data"] = sign_callback_data(query["from"]["id"], action, argument)
+
+    return data
+
+
+def main():
+    """
+    Replay entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("recording")
+    parser.add_argument("--data-dir", default=os.getenv("DATA_DIR") or os.getcwd())
+    parser.add_argument("--speed", type=float, default=0, help="replay speed, 0 for max speed")
+    parser.add_argument("--key", default=get_record_key(), help="RECORD_KEY of the recording")
+    parser.add_argument("--workers", type=int, default=get_update_workers())
+    parser.add_argument("--json", action="store_true", help="print the results as JSON")
+    args = parser.parse_args()
+
+    if args.key:
+        key = args.key.encode()
+        remap = lambda value: pseudonym(value, key)  # noqa: E731
+    else:
+        remap = lambda value: value  # noqa: E731
+
+    # Admins are enabled users, they must be remapped before their first lookup
+    if os.getenv("ADMIN_USERS"):
+        os.environ["ADMIN_USERS"] = ",".join(
+            str(remap(int(user_id))) for user_id in os.environ["ADMIN_USERS"].split(",") if user_id.strip()
+        )
+
+    api = FakeBotApi()
+    api.start()
+
+    with tempfile.TemporaryDirectory() as source_dir, tempfile.TemporaryDirectory() as replay_dir:
+        copy_data_dir(args.data_dir, source_dir)
+        copy_data_dir(args.data_dir, replay_dir)
+        for name in (get_database_name(), get_sqlite_database_name()):
+            if os.path.exists(os.path.join(replay_dir, name)):
+                os.remove(os.path.join(replay_dir, name))
+        copy_persistence(source_dir, replay_dir, remap)
+
+        persistence = bot.create_persistence(replay_dir)
+        telegram_bot = outbound.create_bot(
+            os.environ["TELEGRAM_TOKEN"],
+            con_pool_size=concurrency.get_con_pool_size(args.workers),
+            rate=get_outbound_rate(),
+            chat_rate=get_outbound_chat_rate(),
+            chat_burst=get_outbound_chat_burst(),
+            jitter=get_outbound_jitter(),
+            base_url=api.base_url,
+        )
+        updater = concurrency.create_updater(telegram_bot, persistence, args.workers)
+        dispatcher = updater.dispatcher
+
+        # Same setup of run(), without the network and the jobs
+        bot.register_handlers(dispatcher)
+        shiftsheduling.week_cache.resize(get_week_cache_size())
+        shiftsheduling.load_shifts(os.path.join(replay_dir, get_shifts_filename()))
+        notifications.setup_scheduler(updater, bot.dispatch_reminders)
+        bot.check_admin_users(dispatcher)
+        bot.check_pending_approval(dispatcher)
+        bot.setup_user_index(dispatcher)
+
+        timings, writes = dict(), dict()
+        instrument_handlers(dispatcher, timings)
+        instrument_persistence(persistence, writes)
+
+        replayed = 0
+        start = time.monotonic()
+        for offset, data in read_recording(args.recording):
+            if args.speed > 0:
+                wait = start + offset / args.speed - time.monotonic()
+                if wait > 0:
+                    time.sleep(wait)
+
+            dispatcher.process_update(Update.de_json(resign_callback_data(data), telegram_bot))
+            replayed += 1
+
+        if isinstance(dispatcher, concurrency.ConcurrentDispatcher):
+            dispatcher.executor.shutdown()
+        persistence.flush()
+        elapsed = time.monotonic() - start
+
+        if isinstance(persistence, SQLitePersistence):
+            persistence.close()
+
+    api.stop()
+
+    results = {
+        "updates": replayed,
+        "elapsed": elapsed,
+        "updates_per_second": replayed / elapsed if elapsed else None,
+        "handlers": {
+            name: {
+                "count": len(values),
+                "total_ms": sum(values) * 1000,
+                "p50_ms": percentile(values, 50) * 1000,
+                "p99_ms": percentile(values, 99) * 1000,
+            }
+            for name, values in sorted(timings.items())
+        },
+        "persistence_writes": writes,
+        "outbound_calls": api.method_counts(),
+    }
+
+    if args.json:
+        print(json.dumps(results, indent=2))
+        return
+
+    print(f"Replayed {replayed} updates in {elapsed:.2f}s ({results['updates_per_second'] or 0:.1f} updates/s)")
+    print(f"{'handler':>28} {'count':>7} {'total ms':>10} {'p50 ms':>8} {'p99 ms':>8}")
+    for name, stats in results["handlers"].items():
+        print(f"{name:>28} {stats['count']:7d} {stats['total_ms']:10.1f} {stats['p50_ms']:8.2f} {stats['p99_ms']:8.2f}")
+    print(f"Persistence writes: {writes}")
+    print(f"Outbound calls: {results['outbound_calls']}")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,162 @@
+"""
+Update routing benchmark.
+Compare the cost of selecting the handler of an update with the legacy chain of regex CallbackQueryHandlers against
+the UpdateRouter, and the legacy rebuilt input kinds list against the prebuilt input handlers map.
+
+Usage: python -m benchmarks.routing [--iterations 20000]
+"""
+
+import argparse
+import os
+import timeit
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+
+from telegram import Bot, CallbackQuery, Chat, Message, MessageEntity, Update, User
+from telegram.ext import CallbackQueryHandler, CommandHandler, Filters, MessageHandler
+
+from shift import bot, notifications
+from shift.constants import INPUT_KIND
+from shift.helpers import callback_pattern, sign_callback_data
+
+USER_ID = 1000
+
+
+def make_bot():
+    """
+    Create an offline bot
+    :return: the bot
+    """
+    telegram_bot = Bot(os.environ["TELEGRAM_TOKEN"])
+    telegram_bot._bot = User(id=1, first_name="bot", is_bot=True, username="benchmark_bot")
+    return telegram_bot
+
+
+def make_updates(telegram_bot: Bot):
+    """
+    Create one callback query update for every route, plus a text message and a command
+    :param telegram_bot: bot
+    :return: dict of update name -> update
+    """
+    user = User(id=USER_ID, first_name="user", is_bot=False)
+    chat = Chat(id=USER_ID, type=Chat.PRIVATE)
+    updates = dict()
+
+    for index, action in enumerate(bot.callback_routes()):
+        message = Message(index, None, chat, from_user=user, bot=telegram_bot)
+        query = CallbackQuery(str(index), user, "chat", message=message, data=sign_callback_data(USER_ID, action),
+                              bot=telegram_bot)
+        updates[action] = Update(index, callback_query=query)
+
+    text = Message(1, None, chat, from_user=user, text="12:00", bot=telegram_bot)
+    updates["text"] = Update(1, message=text)
+
+    command = Message(2, None, chat, from_user=user, text="/turni", bot=telegram_bot,
+                      entities=[MessageEntity(MessageEntity.BOT_COMMAND, 0, 6)])
+    updates["/turni"] = Update(2, message=command)
+
+    return updates
+
+
+def legacy_handlers():
+    """
+    Rebuild the handlers chain used before the router: commands, one regex CallbackQueryHandler for every callback
+    (callbacks with more actions use an alternation pattern) and the text MessageHandler
+    :return: legacy handlers
+    """
+    actions = dict()
+    for action, callback in bot.callback_routes().items():
+        actions.setdefault(callback, []).append(action)
+
+    command_handlers = [handler for handler in bot.build_handlers() if isinstance(handler, CommandHandler)]
+    callback_handlers = [
+        CallbackQueryHandler(callback, pattern=callback_pattern(keys[0] if len(keys) == 1 else f'({"|".join(keys)})'))
+        for callback, keys in actions.items()
+    ]
+
+    return command_handlers + callback_handlers + [MessageHandler(Filters.text & ~Filters.command, bot.user_input)]
+
+
+def select_handler(handlers: list, update: Update):
+    """
+    Select the handler of the update, as the dispatcher does
+    :param handlers: handlers
+    :param update: update
+    :return: the handler, None if no handler matches
+    """
+    for handler in handlers:
+        check = handler.check_update(update)
+        if check is not None and check is not False:
+            return handler
+
+    return None
+
+
+def legacy_input_lookup(user_data: dict):
+    """
+    Input handler lookup used before the prebuilt map
+    :param user_data: user data
+    :return: the input handler
+    """
+    input_kinds = [(bot.KIND_CREDENTIALS, bot.credentials_input)] + list(notifications.user_input_handlers().items())
+    for input_kind, input_callback in input_kinds:
+        if user_data.get(INPUT_KIND) == input_kind:
+            return input_callback
+
+    return None
+
+
+def routed_input_lookup(user_data: dict):
+    """
+    Input handler lookup in the prebuilt map
+    :param user_data: user data
+    :return: the input handler
+    """
+    return bot.input_handlers.get(user_data.get(INPUT_KIND))
+
+
+def main():
+    """
+    Benchmark entry point
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--iterations", type=int, default=20000)
+    args = parser.parse_args()
+
+    updates = make_updates(make_bot())
+    legacy = legacy_handlers()
+    routed = bot.build_handlers()
+
+    # Keep the benchmark honest: both chains handle every update, with the same callback for callback queries
+    for name, update in updates.items():
+        legacy_handler, routed_handler = select_handler(legacy, update), select_handler(routed, update)
+        assert legacy_handler is not None and routed_handler is not None, f"{name} isn't handled"
+        if isinstance(legacy_handler, CallbackQueryHandler):
+            assert legacy_handler.callback is routed_handler.check_update(update), name
+
+    def run(handlers):
+        """
+        Route every update once
+        :param handlers: handlers
+        """
+        for update in updates.values():
+            select_handler(handlers, update)
+
+    print(f"Routing {len(updates)} updates ({len(updates) - 2} callback queries, a text input and a command)")
+    results = dict()
+    for name, handlers in (("legacy", legacy), ("router", routed)):
+        elapsed = min(timeit.repeat(lambda: run(handlers), number=args.iterations // len(updates), repeat=5))
+        results[name] = elapsed / (args.iterations // len(updates)) / len(updates) * 1e6
+        print(f"{name:>10}: {results[name]:8.2f} µs/update")
+    print(f"{'speedup':>10}: {results['legacy'] / results['router']:8.1f}x")
+
+    print("Input kind lookup")
+    user_datas = [{INPUT_KIND: kind} for kind in bot.input_handlers] + [{INPUT_KIND: None}]
+    for name, lookup in (("legacy", legacy_input_lookup), ("router", routed_input_lookup)):
+        number = args.iterations // len(user_datas)
+        elapsed = min(timeit.repeat(lambda: [lookup(data) for data in user_datas], number=number, repeat=5))
+        print(f"{name:>10}: {elapsed / number / len(user_datas) * 1e6:8.3f} µs/lookup")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,293 @@
+"""
+Hot paths benchmark suite.
+Build synthetic data (groups, years of shifts, users and reminders per user) and time the hot paths: shifts
+loading, week rendering (cold and cached), presence lookup, scheduler setup (index rebuild and load), an 18:00
+reminder burst through shift_reminder and a persistence flush after N updates. Results are written as JSON and can be
+compared against a stored baseline.
+
+Usage:
+    python -m benchmarks.suite run [--groups 200] [--years 5] [--users 2000] [--reminders 2] [--output results.json]
+    python -m benchmarks.suite compare baseline.json results.json [--threshold 10]
+"""
+
+import argparse
+import datetime
+import json
+import os
+import platform
+import random
+import sys
+import tempfile
+import timeit
+
+os.environ.setdefault("TELEGRAM_TOKEN", "123456:benchmark")
+
+from telegram import Bot
+from telegram.ext import PicklePersistence, Updater
+
+from benchmarks.loader import write_shifts_file
+from shift import bot, notifications, shiftsheduling, sqlitepersistence
+from shift.constants import USER_GROUP, get_default_timezone
+from shift.notifications import SHIFT_REMINDERS
+
+SEED = 0
+
+
+class CountingBot:
+    """
+    Offline bot counting the sent messages
+    """
+
+    def __init__(self):
+        """
+        Init method
+        """
+        self.sent = 0
+
+    def send_message(self, **_):
+        """
+        Count the message
+        :param _: message params
+        """
+        self.sent += 1
+
+
+def measure(func, number: int, repeat: int, setup=None):
+    """
+    Time a function, taking the best of repeat runs
+    :param func: function to time
+    :param number: calls of every run
+    :param repeat: runs
+    :param setup: function called before every run, not timed
+    :return: dict of results
+    """
+    timings = []
+    for _ in range(repeat):
+        if setup:
+            setup()
+        timings.append(timeit.timeit(func, number=number))
+
+    best = min(timings)
+    return {"seconds": best, "number": number, "repeat": repeat, "per_op_us": best / number * 1e6}
+
+
+def make_user_data(users: int, groups: int, reminders: int):
+    """
+    Create the user data, every user with a group and its reminders at 18:00
+    :param users: number of users
+    :param groups: number of groups
+    :param reminders: reminders per user
+    :return: dict of user id -> user data
+    """
+    return {
+        user_id: {
+            USER_GROUP: f"GROUP_{user_id % groups}",
+            SHIFT_REMINDERS: [
+                {
+                    notifications.SHIFT_TYPE: (user_id + i) % 2,
+                    notifications.WHEN_DAYS: [0, 1, 2, 3, 4],
+                    notifications.WHEN_TIME: "18:00" if i == 0 else f"{7 + i % 12:02d}:30",
+                    notifications.WHEN_TIMEZONE: get_default_timezone(),
+                }
+                for i in range(reminders)
+            ],
+        }
+        for user_id in range(1, users + 1)
+    }
+
+
+def make_updater(user_data: dict):
+    """
+    Create an offline updater filled with the user data
+    :param user_data: user data
+    :return: the updater
+    """
+    updater = Updater(bot=Bot(os.environ["TELEGRAM_TOKEN"]))
+    updater.dispatcher.user_data.update(user_data)
+    return updater
+
+
+def run_suite(args):
+    """
+    Run the benchmarks
+    :param args: command line arguments
+    :return: dict of benchmark name -> results
+    """
+    rng = random.Random(SEED)
+    days = args.years * 365
+    # Shifts start on a Monday half of the period ago, so the reminders of tomorrow have shifts to evaluate
+    today = datetime.date.today()
+    start = today - datetime.timedelta(days=today.weekday(), weeks=args.years * 26)
+    dates = [start + datetime.timedelta(days=rng.randrange(days)) for _ in range(1000)]
+    groups = [f"GROUP_{rng.randrange(args.groups)}" for _ in range(1000)]
+    user_datas = [{USER_GROUP: group} for group in groups]
+    results = dict()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        shifts_file = os.path.join(tmp, "shifts.json")
+        write_shifts_file(shifts_file, args.groups, args.years, start)
+
+        print("load_shifts", file=sys.stderr)
+        results["load_shifts"] = measure(lambda: shiftsheduling.load_shifts(shifts_file), 1, args.repeat)
+
+        print("week rendering", file=sys.stderr)
+        store = shiftsheduling.shift_store
+        pairs = list(zip(groups, dates))
+        results["week_render"] = measure(
+            lambda: [shiftsheduling.render_week_shifts(store, group, date) for group, date in pairs],
+            1, args.repeat,
+        )
+        results["week_render"]["per_op_us"] /= len(pairs)
+        cached = list(zip(dates, user_datas))[:100]
+        results["get_week_shifts_message"] = measure(
+            lambda: [shiftsheduling.get_week_shifts_message(date, user_data) for date, user_data in cached],
+            100, args.repeat, setup=shiftsheduling.week_cache.clear,
+        )
+        results["get_week_shifts_message"]["per_op_us"] /= len(cached)
+
+        print("is_presence_day", file=sys.stderr)
+        lookups = list(zip(dates, user_datas))
+        results["is_presence_day"] = measure(
+            lambda: [shiftsheduling.is_presence_day(date, user_data) for date, user_data in lookups],
+            10, args.repeat,
+        )
+        results["is_presence_day"]["per_op_us"] /= len(lookups)
+
+        print("setup_scheduler", file=sys.stderr)
+        user_data = make_user_data(args.users, args.groups, args.reminders)
+        updater = make_updater(user_data)
+        # The index is stored in bot_data as with SQLitePersistence, so it can be loaded
+        bot_data = updater.dispatcher.bot_data
+        results["setup_scheduler_rebuild"] = measure(
+            lambda: notifications.setup_scheduler(updater, bot.dispatch_reminders, bot_data), 1, args.repeat,
+            setup=lambda: bot_data.pop(notifications.REMINDER_INDEX_VERSION, None),
+        )
+        results["setup_scheduler_load"] = measure(
+            lambda: notifications.setup_scheduler(updater, bot.dispatch_reminders, bot_data), 1, args.repeat,
+        )
+
+        print("reminder burst", file=sys.stderr)
+        burst = [
+            (user_id, values, schedule_data)
+            for user_id, values in user_data.items()
+            for schedule_data in values[SHIFT_REMINDERS]
+            if schedule_data[notifications.WHEN_TIME] == "18:00"
+        ]
+        counting_bot = CountingBot()
+        results["reminder_burst"] = measure(lambda: bot.dispatch_reminders(counting_bot, burst), 1, args.repeat)
+        results["reminder_burst"]["reminders"] = len(burst)
+        results["reminder_burst"]["per_op_us"] /= len(burst)
+
+        print("persistence flush", file=sys.stderr)
+        updates = list(user_data.items())[:args.updates]
+
+        def flush_persistence(persistence):
+            """
+            Update the user data of N users and flush
+            :param persistence: persistence
+            """
+            for user_id, values in updates:
+                persistence.update_user_data(user_id, values)
+            persistence.flush()
+
+        pickle_persistence = PicklePersistence(os.path.join(tmp, "bot.db"), on_flush=True)
+        results["persistence_flush_pickle"] = measure(lambda: flush_persistence(pickle_persistence), 1, args.repeat)
+
+        sqlite_persistence = sqlitepersistence.create_persistence(
+            os.path.join(tmp, "bot.sqlite3"), batch_size=len(updates) + 1, batch_interval=3600,
+        )
+        results["persistence_flush_sqlite"] = measure(lambda: flush_persistence(sqlite_persistence), 1, args.repeat)
+        sqlite_persistence.close()
+
+    return results
+
+
+def compare(baseline: dict, current: dict, threshold: float):
+    """
+    Compare the results against the baseline
+    :param baseline: baseline results
+    :param current: current results
+    :param threshold: max slowdown in percent before a benchmark is a regression
+    :return: the regressed benchmarks
+    """
+    regressions = []
+    if baseline.get("params") != current.get("params"):
+        print(f"Warning: different params, baseline {baseline.get('params')} current {current.get('params')}")
+
+    print(f"{'benchmark':>26} {'baseline us':>12} {'current us':>12} {'change':>8}")
+    for name, result in current["results"].items():
+        base = baseline["results"].get(name)
+        if base is None:
+            print(f"{name:>26} {'-':>12} {result['per_op_us']:12.2f} {'new':>8}")
+            continue
+
+        change = (result["per_op_us"] / base["per_op_us"] - 1) * 100
+        regressed = change > threshold
+        if regressed:
+            regressions.append(name)
+        print(f"{name:>26} {base['per_op_us']:12.2f} {result['per_op_us']:12.2f} {change:+7.1f}%"
+              f"{'  REGRESSION' if regressed else ''}")
+
+    return regressions
+
+
+def main():
+    """
+    Benchmark suite entry point
+    :return: exit code
+    """
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    commands = parser.add_subparsers(dest="command", required=True)
+
+    run_parser = commands.add_parser("run", help="run the benchmarks")
+    run_parser.add_argument("--groups", type=int, default=200)
+    run_parser.add_argument("--years", type=int, default=5)
+    run_parser.add_argument("--users", type=int, default=2000)
+    run_parser.add_argument("--reminders", type=int, default=2, help="reminders per user")
+    run_parser.add_argument("--updates", type=int, default=1000, help="user data updates before the flush")
+    run_parser.add_argument("--repeat", type=int, default=5)
+    run_parser.add_argument("--output", help="JSON results file (stdout if not filled)")
+
+    compare_parser = commands.add_parser("compare", help="compare results against a baseline")
+    compare_parser.add_argument("baseline")
+    compare_parser.add_argument("current")
+    compare_parser.add_argument("--threshold", type=float, default=10, help="max slowdown in percent")
+
+    args = parser.parse_args()
+
+    if args.command == "compare":
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        with open(args.current) as f:
+            current = json.load(f)
+
+        regressions = compare(baseline, current, args.threshold)
+        if regressions:
+            print(f"{len(regressions)} regressions over {args.threshold}%: {', '.join(regressions)}")
+            return 1
+        return 0
+
+    output = {
+        "params": {
+            name: getattr(args, name) for name in ("groups", "years", "users", "reminders", "updates", "repeat")
+        },
+        "environment": {
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "date": datetime.datetime.now().isoformat(timespec="seconds"),
+        },
+        "results": run_suite(args),
+    }
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(output, f, indent=2)
+        print(f"Results written to {args.output}", file=sys.stderr)
+    else:
+        print(json.dumps(output, indent=2))
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
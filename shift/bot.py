@@ -1,38 +1,59 @@
 """This module contains the bot main commands."""
 
+import atexit
 import datetime
 import logging
 import re
+import threading
+import time
 
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton, ReplyKeyboardRemove, ParseMode
+from telegram.constants import MAX_MESSAGE_LENGTH
+from telegram.error import TelegramError
 from telegram.ext import (
     CallbackContext,
-    CallbackQueryHandler,
     CommandHandler,
-    Filters,
-    MessageHandler,
     PicklePersistence,
-    Updater, Dispatcher,
+    TypeHandler,
+    Dispatcher,
 )
 
+from . import broadcast
+from . import concurrency
+from . import metrics
 from . import notifications
+from . import outbound
+from . import profiling
+from . import recorder
 from . import shiftsheduling
+from . import sqlitepersistence
+from . import timezones
+from . import webhook
 from .constants import *
 from .datehelper import format_date, DAYS_OF_WEEK
 from .helpers import (
     admin_user,
     callback,
-    callback_pattern,
+    callback_argument,
     command,
+    get_admin_users,
+    get_callback_key,
+    get_index_store,
+    iter_user_data,
     logged_user,
-    make_keyboard, valid_user,
+    make_keyboard,
+    timed,
+    valid_user,
+    verify_callback_data,
 )
+from .reminders import SLOT_KEY_PREFIX
+from .router import UpdateRouter
+from .userindex import USER_INDEX_KEY_PREFIX, USER_INDEX_VERSION, user_index
 
 CANCEL_CALLBACK = "cancel_callback"
 APPROVE_CALLBACK = "approve_callback"
 SHIFTS_PREVIOUS_CALLBACK = "shifts_previous_callback"
 SHIFTS_NEXT_CALLBACK = "shifts_next_callback"
-SHIFTS_DATE = "shifts_date"
 KIND_CREDENTIALS = "credentials"
 PENDING_APPROVAL = "pending_approval"
 
@@ -45,6 +66,7 @@ COMMAND_MESSAGE = (
     "/turni - Per visualizzare i tuoi turni 📅\n"
     "/domani - Per visualizzare il turno di domani 🔜\n"
     "/notifiche - Per impostare gli avvisi 📢\n"
+    "/fuso - Per impostare il tuo fuso orario 🌍\n"
 )
 
 logger = logging.getLogger(__name__)
@@ -61,7 +83,7 @@ def start_command(update: Update, context: CallbackContext):
         f"👋 Ciao! Io sono *{get_bot_name()}*! Con me potrai capire i tuoi turni di presenza senza dover aprire "
         "ogni volta email, excel o altri strumenti ormai obsoleti 🔥\n\n"
         "Ma prima di iniziare devi effettuare il login, digitando il tuo codice gruppo! 😊",
-        reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), context),
+        reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), update.effective_user.id),
     )
 
 
@@ -85,7 +107,7 @@ def help_command(update: Update, context: CallbackContext):
             "Attualmente non hai ancora fatto l'accesso selezionando il tuo gruppo dei turni."
             "Utilizza il comando /login."
         )
-        keyboard = make_keyboard(("Login", LOGIN_CALLBACK), context)
+        keyboard = make_keyboard(("Login", LOGIN_CALLBACK), update.effective_user.id)
 
     message += (
             "\n\n" +
@@ -143,11 +165,12 @@ def get_keyboard_group_markup():
     :return: ReplyKeyboardMarkup with groups
     """
     return ReplyKeyboardMarkup(
-        [[KeyboardButton(text=group.strip(GROUP_PREFIX)) for group in shiftsheduling.shifts_dict]],
+        [[KeyboardButton(text=group.strip(GROUP_PREFIX)) for group in shiftsheduling.get_groups()]],
         resize_keyboard=True
     )
 
 
+@timed("input")
 @valid_user
 def credentials_input(update: Update, context: CallbackContext):
     """
@@ -173,6 +196,7 @@ def credentials_input(update: Update, context: CallbackContext):
 
     context.user_data[LOGGED] = True
     context.user_data[USER_GROUP] = group
+    user_index.set_group(update.effective_user.id, group)
     context.user_data[INPUT_KIND] = None
 
     logger.info(
@@ -196,15 +220,16 @@ def user_input(update: Update, context: CallbackContext):
     :param update: update
     :param context: context
     """
-    input_kinds = [
-                      (KIND_CREDENTIALS, credentials_input)
-                  ] + notifications.user_input_handlers(shift_reminder)
+    input_callback = input_handlers.get(context.user_data.get(INPUT_KIND))
+    if input_callback:
+        input_callback(update, context)
 
-    for input_kind, input_callback in input_kinds:
-        if context.user_data.get(INPUT_KIND) == input_kind:
-            input_callback(update, context)
 
-            return
+# Prebuilt map of input kind -> input handler
+input_handlers = {
+    KIND_CREDENTIALS: credentials_input,
+    **notifications.user_input_handlers(),
+}
 
 
 def get_user_group(update: Update, context: CallbackContext):
@@ -222,7 +247,7 @@ def get_user_group(update: Update, context: CallbackContext):
             f"Scusami tanto, ma mi sono dimenticato il tuo gruppo 😕\n"
             "Devi ri effettuare il login per poter utilizzare questo comando"
         )
-        keyboard = make_keyboard(("Login", LOGIN_CALLBACK), context)
+        keyboard = make_keyboard(("Login", LOGIN_CALLBACK), update.effective_user.id)
 
         if update.callback_query:
             update.callback_query.edit_message_text(
@@ -251,6 +276,7 @@ def shift_command(update: Update, context: CallbackContext):
     if not user_group:
         context.user_data[LOGGED] = False
         context.user_data[USER_GROUP] = None
+        user_index.set_group(update.effective_user.id, None)
         return
 
     if datetime.datetime.today().weekday() < 6:
@@ -258,9 +284,7 @@ def shift_command(update: Update, context: CallbackContext):
     else:
         base_datetime = datetime.datetime.now() + datetime.timedelta(days=2)
 
-    context.user_data[SHIFTS_DATE] = base_datetime
-
-    shifts(update, context, context.user_data[SHIFTS_DATE])
+    shifts(update, context, base_datetime)
 
 
 @command
@@ -276,6 +300,7 @@ def tomorrow_command(update: Update, context: CallbackContext):
     if not user_group:
         context.user_data[LOGGED] = False
         context.user_data[USER_GROUP] = None
+        user_index.set_group(update.effective_user.id, None)
         return
 
     compare_date = datetime.datetime.now() + datetime.timedelta(days=1)
@@ -306,9 +331,10 @@ def shifts(update: Update, context: CallbackContext, date: datetime):
     :param context: context
     :param date: compare date
     """
+    # Navigation dates are carried by the buttons, so flipping pages doesn't touch user data
     buttons = [
-        ("️⬅️ Precedente", SHIFTS_PREVIOUS_CALLBACK),
-        ("Successivo ➡", SHIFTS_NEXT_CALLBACK),
+        ("️⬅️ Precedente", SHIFTS_PREVIOUS_CALLBACK, (date - datetime.timedelta(weeks=1)).toordinal()),
+        ("Successivo ➡", SHIFTS_NEXT_CALLBACK, (date + datetime.timedelta(weeks=1)).toordinal()),
     ]
 
     message = "Ecco i turni della settimana: \n\n" + shiftsheduling.get_week_shifts_message(date, context.user_data)
@@ -316,12 +342,12 @@ def shifts(update: Update, context: CallbackContext, date: datetime):
     if update.message:
         update.message.reply_text(
             text=message,
-            reply_markup=make_keyboard([buttons], context)
+            reply_markup=make_keyboard([buttons], update.effective_user.id)
         )
     else:
         update.callback_query.edit_message_text(
             text=message,
-            reply_markup=make_keyboard([buttons], context)
+            reply_markup=make_keyboard([buttons], update.effective_user.id)
         )
 
 
@@ -340,26 +366,22 @@ def cancel_callback(update: Update, context: CallbackContext):
 def previous_shifts_callback(update: Update, context: CallbackContext):
     """
     Previous shifts' callback.
-    Method remove 1 week from last /turni command
+    Method shows the week before the displayed one
     :param update: update
     :param context: context
     """
-    context.user_data[SHIFTS_DATE] = context.user_data[SHIFTS_DATE] - datetime.timedelta(weeks=1)
-
-    shifts(update, context, context.user_data[SHIFTS_DATE])
+    shifts(update, context, datetime.datetime.fromordinal(int(callback_argument(update))))
 
 
 @callback
 def next_shifts_callback(update: Update, context: CallbackContext):
     """
     Next shifts' callback
-    Method add 1 week from last /turni command
+    Method shows the week after the displayed one
     :param update: update
     :param context: context
     """
-    context.user_data[SHIFTS_DATE] = context.user_data[SHIFTS_DATE] + datetime.timedelta(weeks=1)
-
-    shifts(update, context, context.user_data[SHIFTS_DATE])
+    shifts(update, context, datetime.datetime.fromordinal(int(callback_argument(update))))
 
 
 @command
@@ -374,62 +396,228 @@ def message_command(update: Update, context: CallbackContext):
     if message == "":
         return
 
-    for user_id, _ in context.dispatcher.persistence.get_user_data().items():
-        context.bot.send_message(
-            chat_id=user_id,
-            text=message
-        )
+    if not broadcast.start(context.dispatcher, update.effective_chat.id, message):
+        update.message.reply_text(text="C'è già un invio in corso, riprova al termine ⚠")
 
 
-def shift_reminder(context) -> None:
+@command
+@admin_user
+def profile_command(update: Update, context: CallbackContext):
     """
-    Manage the shift reminder
+    Manage /profila command.
+    Start a profiling session of the given seconds (PROFILE_DEFAULT_WINDOW if not filled), the summary is sent to the
+    admin at the end of the session
+    :param update: update
     :param context: context
     """
-    bot = context.job.context[notifications.BOT_TAG]
-    user_id = context.job.context[notifications.USER_ID_TAG]
-    user_data = context.job.context[notifications.USER_DATA_TAG]
-    schedule_data = context.job.context[notifications.SCHEDULE_DATA_TAG]
+    try:
+        window = int(context.args[0]) if context.args else PROFILE_DEFAULT_WINDOW
+    except ValueError:
+        window = 0
+
+    if not 0 < window <= PROFILE_MAX_WINDOW:
+        update.message.reply_text(text=f"Durata non valida, indica i secondi (massimo {PROFILE_MAX_WINDOW}) ⚠")
+        return
 
-    user_data[INPUT_KIND] = None
+    if not start_profiling(context.job_queue, [update.effective_chat.id], window):
+        update.message.reply_text(text="C'è già una profilazione in corso, riprova al termine ⚠")
+        return
 
-    shift_type = schedule_data[notifications.SHIFT_TYPE]
+    update.message.reply_text(text=f"🔬 Profilazione avviata per {window} secondi")
 
-    # Tomorrow
-    compare_date = datetime.datetime.now() + datetime.timedelta(days=1)
 
-    shift_message = None
+def start_profiling(job_queue, chat_ids: list, window: int):
+    """
+    Start a profiling session, stopped by a job at the end of the window
+    :param job_queue: job queue
+    :param chat_ids: chats where the summary is sent
+    :param window: session seconds
+    :return: True if session is started, False if another session is running
+    """
+    output_dir = os.path.join(os.getenv("DATA_DIR") or os.getcwd(), profiling.PROFILES_DIRNAME)
+    if not profiling.start(output_dir, get_profile_top()):
+        return False
 
-    if shift_type == shiftsheduling.ShiftType.SMART_WORKING.value:
-        send_notify = shiftsheduling.is_smart_working_day(compare_date, user_data)
-        shift_message = shiftsheduling.ShiftType.SMART_WORKING.formatted
-    elif shift_type == shiftsheduling.ShiftType.PRESENCE.value:
-        send_notify = shiftsheduling.is_presence_day(compare_date, user_data)
+    job_queue.run_once(stop_profiling_job, window, context=chat_ids)
+    return True
+
+
+def stop_profiling_job(context: CallbackContext):
+    """
+    Stop the profiling session and send its summary
+    :param context: context (job context is the list of chats where the summary is sent)
+    """
+    summary = profiling.stop()
+    if summary is None:
+        return
+
+    for chat_id in context.job.context:
+        try:
+            context.bot.send_message(chat_id=chat_id, text=summary[:MAX_MESSAGE_LENGTH])
+        except TelegramError as e:
+            logger.warning("Unable to send the profiling summary to %s: %s", chat_id, e)
+
+
+def dispatch_reminders(bot, reminders) -> None:
+    """
+    Dispatch the reminders of a slot.
+    Tomorrow shift is evaluated once per (group, shift type), reminders that don't match are dropped before any
+    per user work. Reminders are sent with REMINDER priority, so they don't delay interactive replies
+    :param bot: bot
+    :param reminders: iterable of (user_id, user_data, schedule_data)
+    """
+    # Tomorrow, in the timezone of every reminder
+    compare_dates = dict()
+    evaluations = dict()
+    sent, skipped, failed = 0, 0, 0
+
+    for user_id, user_data, schedule_data in reminders:
+        timezone = notifications.reminder_timezone(schedule_data)
+        compare_date = compare_dates.get(timezone)
+        if compare_date is None:
+            compare_date = compare_dates[timezone] = timezones.local_now(timezone) + datetime.timedelta(days=1)
+
+        key = (compare_date.date(), user_data.get(USER_GROUP), schedule_data[notifications.SHIFT_TYPE])
+
+        send_notify = evaluations.get(key)
+        if send_notify is None:
+            send_notify = evaluations[key] = shiftsheduling.is_shift_day(compare_date, *key[1:])
+
+        if not send_notify:
+            skipped += 1
+            continue
+
+        try:
+            with concurrency.user_lock(user_id), outbound.priority(outbound.REMINDER):
+                shift_reminder(bot, user_id, user_data, schedule_data, compare_date)
+            sent += 1
+        except Exception:
+            failed += 1
+            logger.exception("Reminder failed for user %s: %s", user_id, schedule_data)
+
+    logger.info(
+        "Reminders for %s: %s sent, %s skipped, %s failed (%s group evaluations)",
+        ", ".join(sorted({compare_date.strftime("%Y-%m-%d") for compare_date in compare_dates.values()})),
+        sent,
+        skipped,
+        failed,
+        len(evaluations),
+    )
+
+
+@profiling.profiled("job")
+def shift_reminder(bot, user_id: int, user_data: dict, schedule_data: dict, compare_date: datetime) -> None:
+    """
+    Send the shift reminder
+    :param bot: bot
+    :param user_id: user id
+    :param user_data: user data
+    :param schedule_data: reminder schedule data
+    :param compare_date: reminder shift date (local date of the reminder timezone)
+    """
+    if user_data.get(INPUT_KIND) is not None:
+        user_data[INPUT_KIND] = None
+        concurrency.mark_user_data_changed(user_id)
+
+    if schedule_data[notifications.SHIFT_TYPE] == shiftsheduling.ShiftType.PRESENCE.value:
         shift_message = shiftsheduling.ShiftType.PRESENCE.formatted
     else:
-        send_notify = False
+        shift_message = shiftsheduling.ShiftType.SMART_WORKING.formatted
 
-    if send_notify:
-        shift_user = user_data[USER_GROUP]
-        if not shift_user:
-            message = f"Hey! Dovrei avvisarti sui turni, ma non ho più il tuo gruppo per poter verificare 😕"
-            bot.send_message(
-                chat_id=user_id,
-                text=message,
-                reply_markup=make_keyboard(("Login", LOGIN_CALLBACK), user_data=user_data),
-            )
-            return
+    if (compare_date - datetime.timedelta(days=1)).weekday() in (5, 6):
+        message = f"Hey. Ricordati che {format_date(compare_date)} sarai in {shift_message}"
+    else:
+        message = f"Hey. Ricordati che domani sarai in {shift_message}"
 
-        if datetime.datetime.now().weekday() == 5 or datetime.datetime.now() == 6:
-            message = f"Hey. Ricordati che {format_date(compare_date)} sarai in {shift_message}"
-        else:
-            message = f"Hey. Ricordati che domani sarai in {shift_message}"
+    bot.send_message(
+        chat_id=user_id,
+        text=message
+    )
+
+
+@profiling.profiled("job")
+def reload_shifts_job(context: CallbackContext):
+    """
+    Reload the shifts file, if changed since last load, and notify the shift changes of the next days
+    :param context: context (job context is the shifts file)
+    """
+    old_store = shiftsheduling.reload_shifts(context.job.context)
+    lookahead = get_shift_changes_lookahead()
+    if old_store is None or lookahead <= 0:
+        return
+
+    today = timezones.local_now(get_default_timezone()).date()
+    changes = shiftsheduling.get_shift_changes(old_store, today, lookahead)
+    if changes:
+        # Sent in background, so the job queue thread doesn't wait for the rate limited sends
+        threading.Thread(
+            target=notify_shift_changes, args=(context.bot, changes), name="shift changes", daemon=True
+        ).start()
+
+
+def notify_shift_changes(bot, changes: dict) -> None:
+    """
+    Send one message with all the shift changes to every user of the changed groups.
+    Recipients are taken from the users index, so only the users of the changed groups are visited. Messages are
+    sent with BULK priority, so they don't delay interactive replies and reminders
+    :param bot: bot
+    :param changes: dict of group -> list of (date, previous shift type, new shift type)
+    """
+    sent, failed = 0, 0
 
-        bot.send_message(
-            chat_id=user_id,
-            text=message
+    for group, group_changes in changes.items():
+        message = "🔄 I tuoi turni sono cambiati:\n\n" + "\n".join(
+            f"{format_date(date)}: {shift_change_description(old_shift)} ➡ {shift_change_description(new_shift)}"
+            for date, old_shift, new_shift in group_changes
         )
 
+        for user_id in user_index.get_group_users(group):
+            try:
+                with outbound.priority(outbound.BULK):
+                    bot.send_message(chat_id=user_id, text=message)
+                sent += 1
+            except TelegramError as e:
+                failed += 1
+                logger.warning("Shift changes notification failed for user %s: %s", user_id, e)
+
+    logger.info("Shift changes of %s groups notified: %s sent, %s failed", len(changes), sent, failed)
+
+
+def shift_change_description(shift_type):
+    """
+    Gets the description of a changed shift
+    :param shift_type: shift type, None for no shift
+    :return: the description
+    """
+    return shift_type.formatted if shift_type else "Nessun turno 😢"
+
+
+@command
+@valid_user
+def timezone_command(update: Update, context: CallbackContext):
+    """
+    Manage /fuso command.
+    Without arguments show the user timezone, otherwise set it and move the user reminders to the new timezone
+    :param update: update
+    :param context: context
+    """
+    if not context.args:
+        update.message.reply_markdown(
+            f"Il tuo fuso orario è *{timezones.user_timezone(context.user_data)}* 🌍\n\n"
+            "Per modificarlo invia /fuso seguito dal nome del fuso orario (es. /fuso Europe/London)"
+        )
+        return
+
+    timezone = context.args[0]
+    if not timezones.is_valid_timezone(timezone):
+        update.message.reply_text(text="Fuso orario non valido, usa il formato Area/Città (es. Europe/London) ⚠️")
+        return
+
+    context.user_data[USER_TIMEZONE] = timezone
+    notifications.set_reminders_timezone(update.effective_user.id, context.user_data, timezone)
+
+    update.message.reply_markdown(f"Fuso orario impostato: *{timezone}* ✅")
+
 
 @command
 def notification_command(update: Update, context: CallbackContext):
@@ -460,14 +648,11 @@ def register_callback(update: Update, context: CallbackContext):
     else:
         update.callback_query.edit_message_text(text=message)
 
-    if context.bot_data.get(PENDING_APPROVAL) is None:
-        context.bot_data[PENDING_APPROVAL] = list()
-    context.bot_data[PENDING_APPROVAL].append(update.effective_user.id)
+    # Ordered set of pending users (dict keys)
+    context.bot_data.setdefault(PENDING_APPROVAL, dict())[update.effective_user.id] = None
 
-    admins = [int(x.strip()) for x in os.getenv("ADMIN_USERS").split(",")]
-
-    for user_id, _ in context.dispatcher.persistence.get_user_data().items():
-        if user_id in admins:
+    for user_id in get_admin_users():
+        try:
             context.bot.send_message(
                 chat_id=user_id,
                 parse_mode=ParseMode.MARKDOWN,
@@ -475,24 +660,35 @@ def register_callback(update: Update, context: CallbackContext):
                     f"L'utente ```{update.effective_user.id}``` ({update.effective_user.full_name}) ha richiesto "
                     f"l'utilizzo di {get_bot_name()}"
                 ),
-                reply_markup=make_keyboard(("Approva", APPROVE_CALLBACK), user_data=context.user_data)
+                reply_markup=make_keyboard(("Approva", APPROVE_CALLBACK), user_id)
             )
+        except TelegramError as e:
+            # E.g. the admin never started the bot
+            logger.warning("Registration request notification failed for admin %s: %s", user_id, e)
 
 
+@timed("callback")
 def approve_callback(update: Update, context: CallbackContext):
     """
     Approve action callback.
-    NOTE: This is a special callback because original message is send to another user. DON'T use @callback decorator
+    NOTE: This is a special callback because the request message isn't deleted when its button is expired (older
+    than CALLBACK_TTL), so the admin still sees the request: the user has to ask the registration again, sending a new
+    button. DON'T use @callback decorator
     :param update: update
     :param context: context
     """
+    if update.callback_query:
+        update.callback_query.answer()
+        if not verify_callback_data(update.callback_query.data, update.effective_user.id, get_callback_ttl()):
+            return
+
     if update.effective_message:
         m = re.search("<pre>(.*?)</pre>", update.effective_message.text_html)
 
         user_id = int(m.group(1))
 
-        if user_id in context.bot_data[PENDING_APPROVAL]:
-            context.bot_data[PENDING_APPROVAL].remove(user_id)
+        if user_id in context.bot_data.get(PENDING_APPROVAL, ()):
+            del context.bot_data[PENDING_APPROVAL][user_id]
             context.bot_data[ENABLED_USERS].add(user_id)
             context.bot.send_message(
                 chat_id=user_id,
@@ -518,9 +714,172 @@ def check_admin_users(dispatcher: Dispatcher):
     if dispatcher.bot_data.get(ENABLED_USERS) is None:
         dispatcher.bot_data[ENABLED_USERS] = set()
 
-        admins = [int(x.strip()) for x in os.getenv("ADMIN_USERS").split(",")]
-        for user_id in admins:
-            dispatcher.bot_data[ENABLED_USERS].add(int(user_id))
+        for user_id in get_admin_users():
+            dispatcher.bot_data[ENABLED_USERS].add(user_id)
+
+
+def check_pending_approval(dispatcher: Dispatcher):
+    """
+    Convert the pending approval list of previous versions in an ordered set (dict keys)
+    :param dispatcher: dispatcher
+    """
+    if isinstance(dispatcher.bot_data.get(PENDING_APPROVAL), list):
+        dispatcher.bot_data[PENDING_APPROVAL] = dict.fromkeys(dispatcher.bot_data[PENDING_APPROVAL])
+
+
+def setup_user_index(dispatcher: Dispatcher):
+    """
+    Load the users index, building it from the user data only when it's missing or has an old version. The index is
+    persisted in bot_data only with SQLitePersistence (see get_index_store)
+    :param dispatcher: dispatcher
+    """
+    if user_index.load(get_index_store(dispatcher, USER_INDEX_KEY_PREFIX, USER_INDEX_VERSION)):
+        logger.info("Loaded the users index with %s users", len(user_index))
+    else:
+        user_index.build(iter_user_data(dispatcher), USER_GROUP)
+        logger.info("Built the users index with %s users", len(user_index))
+
+
+def index_user(update: Update, _: CallbackContext):
+    """
+    Add the update user to the known users index
+    :param update: update
+    :param _: context
+    """
+    if update.effective_user:
+        user_index.add_user(update.effective_user.id)
+
+
+class TimedPicklePersistence(PicklePersistence):
+    """
+    Pickle persistence recording the duration of its writes in the metrics
+    """
+
+    def _dump_singlefile(self) -> None:
+        """
+        Write the pickle file
+        """
+        with metrics.PERSISTENCE_FLUSH_DURATION.time(PERSISTENCE_PICKLE):
+            super()._dump_singlefile()
+
+
+def create_persistence(data_dir):
+    """
+    Create the persistence of the configured backend
+    :param data_dir: data directory
+    :return: the persistence
+    """
+    pickle_filename = os.path.join(data_dir, get_database_name())
+
+    if get_persistence_backend() == PERSISTENCE_SQLITE:
+        return sqlitepersistence.create_persistence(
+            os.path.join(data_dir, get_sqlite_database_name()),
+            pickle_filename=pickle_filename,
+            batch_size=get_persistence_batch_size(),
+            batch_interval=get_persistence_batch_interval(),
+            user_data_cache_size=get_user_data_cache_size(),
+            # Reminder slots and user index sets are replaced on every change, so only the changed ones are serialised
+            # again
+            replaced_key_prefixes=(SLOT_KEY_PREFIX, USER_INDEX_KEY_PREFIX),
+        )
+
+    return TimedPicklePersistence(filename=pickle_filename)
+
+
+def close_persistence(dispatcher):
+    """
+    Write the data changed after the flush of the updater stop (E.g. by the last updates and jobs) and close the
+    persistence
+    :param dispatcher: dispatcher
+    """
+    persistence = dispatcher.persistence
+    dispatcher.update_persistence()
+
+    if isinstance(persistence, sqlitepersistence.SQLitePersistence):
+        persistence.close()
+    else:
+        persistence.flush()
+
+
+def callback_routes():
+    """
+    Define the callback routes
+    :return: dict of callback action -> callback
+    """
+    return {
+        LOGIN_CALLBACK: login_callback,
+        CANCEL_CALLBACK: cancel_callback,
+        SHIFTS_PREVIOUS_CALLBACK: previous_shifts_callback,
+        SHIFTS_NEXT_CALLBACK: next_shifts_callback,
+        REGISTER_CALLBACK: register_callback,
+        APPROVE_CALLBACK: approve_callback,
+        **notifications.callback_routes(),
+    }
+
+
+def build_handlers():
+    """
+    Define the bot handlers
+    :return: bot handlers
+    """
+    return [
+        UpdateRouter(callback_routes(), user_input),
+        CommandHandler("start", start_command),
+        CommandHandler("aiuto", help_command),
+        CommandHandler("login", login_command),
+        CommandHandler("turni", shift_command),
+        CommandHandler("domani", tomorrow_command),
+        CommandHandler("messaggio", message_command),
+        CommandHandler("notifiche", notification_command),
+        CommandHandler("fuso", timezone_command),
+        CommandHandler("profila", profile_command),
+    ]
+
+
+def register_handlers(dispatcher: Dispatcher):
+    """
+    Register the bot handlers
+    :param dispatcher: dispatcher
+    """
+    for handler in build_handlers():
+        dispatcher.add_handler(handler)
+
+    dispatcher.add_handler(TypeHandler(Update, index_user), group=-1)
+
+
+def start_recording(dispatcher: Dispatcher, data_dir):
+    """
+    Record the incoming updates, when RECORD_UPDATES is set
+    :param dispatcher: dispatcher
+    :param data_dir: data directory
+    """
+    if not get_record_updates():
+        return
+
+    key = get_record_key()
+    if not key:
+        logger.warning("RECORD_KEY not set, the recording can't be replayed against a copy of the persistence")
+        key = os.urandom(32).hex()
+
+    update_recorder = recorder.UpdateRecorder(os.path.join(data_dir, get_record_updates()), key.encode())
+    dispatcher.add_handler(TypeHandler(Update, update_recorder.record), group=-2)
+    atexit.register(update_recorder.close)
+
+
+def start_metrics(bot):
+    """
+    Start the metrics endpoint, when METRICS_PORT is set
+    :param bot: bot
+    """
+    if not get_metrics_port():
+        return
+
+    metrics.register_cache("week", lambda: shiftsheduling.week_cache)
+    metrics.register_cache("rule_weeks", lambda: shiftsheduling.shift_store.rule_weeks)
+    if isinstance(bot, outbound.ScheduledBot):
+        metrics.register_cache("outbound_chat_buckets", lambda: bot.scheduler.chat_buckets)
+
+    metrics.start_metrics_server(get_metrics_host(), get_metrics_port())
 
 
 def run() -> None:
@@ -528,40 +887,94 @@ def run() -> None:
     Run method.
     Start bot and add all command handler
     """
+    phases = dict()
+    phase_start = time.perf_counter()
+
+    def end_phase(name):
+        """
+        Record the duration of a startup phase
+        :param name: phase name
+        """
+        nonlocal phase_start
+        now = time.perf_counter()
+        phases[name] = now - phase_start
+        phase_start = now
+
+    # Fail fast when the callback data can't be signed
+    get_callback_key()
+
     data_dir = os.getenv("DATA_DIR") or os.getcwd()
-    persistence = PicklePersistence(filename=os.path.join(data_dir, get_database_name()))
-    updater = Updater(os.getenv("TELEGRAM_TOKEN"), persistence=persistence)
+    persistence = create_persistence(data_dir)
+    bot = outbound.create_bot(
+        os.getenv("TELEGRAM_TOKEN"),
+        con_pool_size=concurrency.get_con_pool_size(get_update_workers()),
+        rate=get_outbound_rate(),
+        chat_rate=get_outbound_chat_rate(),
+        chat_burst=get_outbound_chat_burst(),
+        jitter=get_outbound_jitter(),
+        base_url=get_telegram_base_url(),
+    )
+    updater = concurrency.create_updater(bot, persistence, get_update_workers())
+    start_metrics(bot)
 
     dispatcher = updater.dispatcher
+    end_phase("persistence")
 
-    handlers = [
-                   CommandHandler("start", start_command),
-                   CommandHandler("aiuto", help_command),
-                   CommandHandler("login", login_command),
-                   CommandHandler("turni", shift_command),
-                   CommandHandler("domani", tomorrow_command),
-                   CommandHandler("messaggio", message_command),
-                   CommandHandler("notifiche", notification_command),
-                   CallbackQueryHandler(login_callback, pattern=callback_pattern(LOGIN_CALLBACK)),
-                   CallbackQueryHandler(cancel_callback, pattern=callback_pattern(CANCEL_CALLBACK)),
-                   CallbackQueryHandler(previous_shifts_callback, pattern=callback_pattern(SHIFTS_PREVIOUS_CALLBACK)),
-                   CallbackQueryHandler(next_shifts_callback, pattern=callback_pattern(SHIFTS_NEXT_CALLBACK)),
-                   CallbackQueryHandler(register_callback, pattern=callback_pattern(REGISTER_CALLBACK)),
-                   CallbackQueryHandler(approve_callback, pattern=callback_pattern(APPROVE_CALLBACK)),
-                   MessageHandler(Filters.text & ~Filters.command, user_input),
-               ] + notifications.handlers(shift_reminder)
-
-    notifications.setup_scheduler(updater, shift_reminder)
-
-    for handler in handlers:
-        dispatcher.add_handler(handler)
+    register_handlers(dispatcher)
+    start_recording(dispatcher, data_dir)
 
     # Load shifts
-    shiftsheduling.load_shifts(os.path.join(data_dir, get_shifts_filename()))
+    shiftsheduling.week_cache.resize(get_week_cache_size())
+    shifts_file = os.path.join(data_dir, get_shifts_filename())
+    shiftsheduling.load_shifts(shifts_file)
+
+    if get_shifts_reload_interval() > 0:
+        updater.job_queue.run_repeating(
+            reload_shifts_job,
+            interval=get_shifts_reload_interval(),
+            context=shifts_file,
+        )
+    end_phase("shifts")
+
+    # Slot jobs are armed by the job queue once started
+    notifications.setup_scheduler(updater, dispatch_reminders)
+    end_phase("scheduler")
 
     # Check if all admin users is also in valid users set
     check_admin_users(dispatcher)
+    check_pending_approval(dispatcher)
+
+    # Users index is kept updated by index_user handler and login/logout
+    setup_user_index(dispatcher)
+    end_phase("users index")
+
+    # Resume the broadcast interrupted by a restart
+    broadcast.resume(dispatcher)
+
+    if get_profile_window():
+        start_profiling(updater.job_queue, sorted(get_admin_users()), get_profile_window())
+
+    if get_webhook_url():
+        webhook.start_webhook(
+            updater,
+            url=get_webhook_url(),
+            host=get_webhook_host(),
+            port=get_webhook_port(),
+            path=get_webhook_path(),
+            secret_token=get_webhook_secret(),
+            queue_size=get_webhook_queue_size(),
+        )
+    else:
+        updater.start_polling()
+    end_phase("start")
 
-    updater.start_polling()
+    logger.info(
+        "Startup completed in %.3fs (%s)",
+        sum(phases.values()),
+        ", ".join(f"{name} {elapsed:.3f}s" for name, elapsed in phases.items()),
+    )
 
-    updater.idle()
+    try:
+        updater.idle()
+    finally:
+        close_persistence(dispatcher)
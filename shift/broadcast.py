@@ -0,0 +1,278 @@
+"""Broadcast campaigns module."""
+
+import bisect
+import logging
+import threading
+import time
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from telegram.error import TelegramError, Unauthorized
+from telegram.ext import Dispatcher
+
+from . import outbound
+from .constants import get_broadcast_rate, get_broadcast_senders
+from .ratelimit import TokenBucket
+from .userindex import user_index
+
+BROADCAST_CAMPAIGN = "broadcast_campaign"
+
+(
+    CAMPAIGN_ID,
+    ADMIN_CHAT_ID,
+    TEXT,
+    CURSOR,
+    SENT,
+    FAILED,
+    BLOCKED,
+) = ("id", "admin_chat_id", "text", "cursor", "sent", "failed", "blocked")
+
+SEND_SENT, SEND_FAILED, SEND_BLOCKED = SENT, FAILED, BLOCKED
+
+CHECKPOINT_INTERVAL = 5
+PROGRESS_INTERVAL = 30
+
+logger = logging.getLogger(__name__)
+
+running_campaign = None
+running_campaign_lock = threading.Lock()
+# Serialise the checkpoints of the sender threads
+checkpoint_lock = threading.Lock()
+
+
+class BroadcastCampaign:
+    """
+    Background broadcast campaign.
+    Messages are sent by a pool of senders sharing a token bucket to the known users, in user id order. Only the
+    campaign state is kept in bot_data, without the recipients: the cursor is the user id of the first recipient not
+    yet completed, and it's periodically flushed to the persistence, so a restart rebuilds the recipients from the user
+    index and resumes the campaign from the cursor (recipients after the cursor, already completed, are sent again)
+    """
+
+    def __init__(self, dispatcher: Dispatcher, state: dict):
+        """
+        Init method
+        :param dispatcher: dispatcher
+        :param state: campaign state
+        """
+        self.dispatcher = dispatcher
+        self.bot = dispatcher.bot
+        self.state = state
+        self.recipients = user_index.get_users()
+        self.cursor = bisect.bisect_left(self.recipients, state[CURSOR])
+        self.bucket = TokenBucket(get_broadcast_rate())
+        self.completed = set()
+        self._lock = threading.Lock()
+        self._last_checkpoint = time.monotonic()
+        self._last_progress = time.monotonic()
+        self._progress_message = None
+
+    def run(self):
+        """
+        Run the campaign until all recipients are completed
+        """
+        start = self.cursor
+
+        logger.info(
+            "Broadcast %s started from %s/%s recipients",
+            self.state[CAMPAIGN_ID],
+            start,
+            len(self.recipients),
+        )
+        self._progress_message = self._notify_admin(self._progress_text(), None)
+
+        senders = get_broadcast_senders()
+        # Bound the submitted tasks, so completed indexes don't pile up too far from the cursor
+        pending = threading.BoundedSemaphore(senders * 2)
+
+        with ThreadPoolExecutor(max_workers=senders, thread_name_prefix="broadcast") as executor:
+            for index in range(start, len(self.recipients)):
+                pending.acquire()
+                future = executor.submit(self._send, self.recipients[index])
+                future.add_done_callback(lambda f, i=index: self._complete(i, f, pending))
+
+        self._checkpoint(force=True)
+
+        logger.info(
+            "Broadcast %s completed: %s sent, %s failed, %s blocked",
+            self.state[CAMPAIGN_ID],
+            self.state[SENT],
+            self.state[FAILED],
+            self.state[BLOCKED],
+        )
+        self._notify_admin(self._progress_text(completed=True), self._progress_message)
+
+    def _send(self, user_id: int):
+        """
+        Send the message to a recipient. Flood limits are retried by the outbound bot
+        :param user_id: recipient
+        :return: send result (SEND_SENT, SEND_FAILED or SEND_BLOCKED)
+        """
+        self.bucket.acquire()
+        try:
+            with outbound.priority(outbound.BULK):
+                self.bot.send_message(chat_id=user_id, text=self.state[TEXT])
+            return SEND_SENT
+        except Unauthorized:
+            return SEND_BLOCKED
+        except TelegramError as e:
+            logger.warning("Broadcast to user %s failed: %s", user_id, e)
+            return SEND_FAILED
+
+    def _complete(self, index: int, future, pending: threading.BoundedSemaphore):
+        """
+        Record a completed recipient and advance the cursor
+        :param index: recipient index
+        :param future: send future
+        :param pending: pending tasks semaphore
+        """
+        try:
+            result = future.result()
+        except Exception:
+            logger.exception("Broadcast to user %s failed", self.recipients[index])
+            result = SEND_FAILED
+
+        with self._lock:
+            self.state[result] += 1
+            self.completed.add(index)
+            while self.cursor in self.completed:
+                self.completed.remove(self.cursor)
+                self.cursor += 1
+            if self.cursor < len(self.recipients):
+                self.state[CURSOR] = self.recipients[self.cursor]
+
+        pending.release()
+
+        self._checkpoint()
+        if time.monotonic() - self._last_progress >= PROGRESS_INTERVAL:
+            self._last_progress = time.monotonic()
+            self._notify_admin(self._progress_text(), self._progress_message)
+
+    def _checkpoint(self, force: bool = False):
+        """
+        Flush the campaign state to the persistence. Only bot_data is written, with a copy of the state replacing the
+        stored one, so the persistence updates of the dispatcher never see the state while senders update it.
+        A failed checkpoint is logged: the campaign goes on and it's retried by the next one
+        :param force: True to flush regardless of the checkpoint interval
+        """
+        with self._lock:
+            if not force and time.monotonic() - self._last_checkpoint < CHECKPOINT_INTERVAL:
+                return
+            self._last_checkpoint = time.monotonic()
+
+        persistence = self.dispatcher.persistence
+        if not persistence or not persistence.store_bot_data:
+            return
+
+        try:
+            with checkpoint_lock:
+                with self._lock:
+                    completed = self.cursor >= len(self.recipients)
+                    state = dict(self.state)
+
+                if completed:
+                    self.dispatcher.bot_data.pop(BROADCAST_CAMPAIGN, None)
+                else:
+                    self.dispatcher.bot_data[BROADCAST_CAMPAIGN] = state
+                persistence.update_bot_data(self.dispatcher.bot_data)
+        except Exception:
+            logger.exception("Broadcast %s checkpoint failed", self.state[CAMPAIGN_ID])
+
+    def _progress_text(self, completed: bool = False):
+        """
+        Gets the progress text
+        :param completed: True if campaign is completed
+        :return: the progress text
+        """
+        title = "Invio completato ✅" if completed else "Invio in corso 📤"
+        done = self.state[SENT] + self.state[FAILED] + self.state[BLOCKED]
+        return (
+            f"{title}\n\n"
+            f"Destinatari: {done}/{len(self.recipients)}\n"
+            f"Inviati: {self.state[SENT]}\n"
+            f"Falliti: {self.state[FAILED]}\n"
+            f"Bloccati: {self.state[BLOCKED]}"
+        )
+
+    def _notify_admin(self, text: str, message):
+        """
+        Send or edit the admin progress message
+        :param text: text
+        :param message: message to edit, None to send a new one
+        :return: the sent message, None on failure
+        """
+        try:
+            if message:
+                return message.edit_text(text=text)
+            return self.bot.send_message(chat_id=self.state[ADMIN_CHAT_ID], text=text)
+        except TelegramError as e:
+            logger.warning("Unable to notify broadcast progress: %s", e)
+            return message
+
+
+def start(dispatcher: Dispatcher, admin_chat_id: int, text: str):
+    """
+    Start a new broadcast campaign to all the known users in background
+    :param dispatcher: dispatcher
+    :param admin_chat_id: admin chat to notify progress
+    :param text: message text
+    :return: True if campaign is started, False if another campaign is running
+    """
+    state = {
+        CAMPAIGN_ID: str(uuid.uuid4()),
+        ADMIN_CHAT_ID: admin_chat_id,
+        TEXT: text,
+        CURSOR: 0,
+        SENT: 0,
+        FAILED: 0,
+        BLOCKED: 0,
+    }
+
+    return run_campaign(dispatcher, state)
+
+
+def resume(dispatcher: Dispatcher):
+    """
+    Resume the interrupted campaign, if any
+    :param dispatcher: dispatcher
+    """
+    state = dispatcher.bot_data.get(BROADCAST_CAMPAIGN)
+    if state:
+        run_campaign(dispatcher, dict(state))
+
+
+def run_campaign(dispatcher: Dispatcher, state: dict):
+    """
+    Run the campaign in a background thread
+    :param dispatcher: dispatcher
+    :param state: campaign state
+    :return: True if campaign is started, False if another campaign is running
+    """
+    global running_campaign
+
+    with running_campaign_lock:
+        if running_campaign is not None:
+            return False
+
+        dispatcher.bot_data[BROADCAST_CAMPAIGN] = dict(state)
+        running_campaign = BroadcastCampaign(dispatcher, state)
+
+    threading.Thread(target=run_and_release, args=(running_campaign,), name="broadcast", daemon=True).start()
+
+    return True
+
+
+def run_and_release(campaign: BroadcastCampaign):
+    """
+    Run the campaign, releasing the running campaign slot at the end
+    :param campaign: campaign
+    """
+    global running_campaign
+
+    try:
+        campaign.run()
+    except Exception:
+        logger.exception("Broadcast %s failed", campaign.state[CAMPAIGN_ID])
+    finally:
+        with running_campaign_lock:
+            running_campaign = None
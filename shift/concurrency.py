@@ -0,0 +1,290 @@
+"""Concurrent update processing module."""
+
+import collections
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from queue import Queue
+
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, JobQueue, Updater
+
+from .sqlitepersistence import pinned_user_data
+
+USER_LOCK_STRIPES = 256
+# Users with submitted updates per worker, before the dispatcher blocks
+PENDING_UPDATES_PER_WORKER = 4
+# Updates of a user waiting for the running one, before the next ones are dropped
+PENDING_UPDATES_PER_USER = 16
+
+logger = logging.getLogger(__name__)
+
+# Striped per user locks: bounded memory, users sharing a stripe are just serialised together
+user_locks = tuple(threading.RLock() for _ in range(USER_LOCK_STRIPES))
+# Users whose user data was changed outside the update processing, written by the next persistence update
+changed_user_ids = set()
+changed_user_ids_lock = threading.Lock()
+
+
+def user_lock(user_id):
+    """
+    Gets the lock of the user. Every code mutating the user data outside the update processing (E.g. jobs) must hold
+    it, so it is serialised with the updates of the user, and must mark the change with mark_user_data_changed
+    :param user_id: user id
+    :return: the user lock
+    """
+    return user_locks[hash(user_id) % USER_LOCK_STRIPES]
+
+
+def mark_user_data_changed(user_id):
+    """
+    Mark the user data as changed outside the update processing, so the next persistence update writes it
+    :param user_id: user id
+    """
+    with changed_user_ids_lock:
+        changed_user_ids.add(user_id)
+
+
+def pop_changed_user_ids():
+    """
+    Gets and clears the users marked by mark_user_data_changed
+    :return: set of user ids
+    """
+    global changed_user_ids
+
+    with changed_user_ids_lock:
+        user_ids, changed_user_ids = changed_user_ids, set()
+
+    return user_ids
+
+
+class UserSerialExecutor:
+    """
+    Worker pool executor serialising the tasks with the same key.
+    Tasks of different keys run in parallel, tasks of the same key run one at a time in submission order. After every
+    task the worker is released, so a busy key doesn't starve the others.
+    Keys handed to the pool are bounded: when max_pending keys have tasks running or waiting in the pool, submit blocks
+    until one completes, so the backlog stays in the bounded update queue (and the webhook refuses updates when it's
+    full). A task of a key with a task already submitted doesn't take a slot: it waits in the key queue, and when
+    max_pending_per_key tasks are waiting the new ones are dropped, so a flooding key can't block the other keys
+    """
+
+    def __init__(self, workers: int, max_pending: int, max_pending_per_key: int = PENDING_UPDATES_PER_USER):
+        """
+        Init method
+        :param workers: number of worker threads
+        :param max_pending: max keys (or tasks without key) handed to the pool and not completed yet
+        :param max_pending_per_key: max tasks of a key waiting for the running one
+        """
+        self._pool = ThreadPoolExecutor(workers, thread_name_prefix="update-worker")
+        self._slots = threading.BoundedSemaphore(max_pending)
+        self.max_pending_per_key = max_pending_per_key
+        self._pending = dict()
+        self._lock = threading.Lock()
+        self._drained = threading.Condition(self._lock)
+
+    def submit(self, key, fn, *args):
+        """
+        Submit a task. A task of a new key waits when max_pending keys are not completed yet, a task of a key already
+        submitted is queued behind it, or dropped when max_pending_per_key tasks are already waiting
+        :param key: serialisation key (None to run without serialisation)
+        :param fn: function
+        :param args: function args
+        :return: True if the task is submitted, False if it's dropped
+        """
+        if key is not None:
+            with self._lock:
+                pending = self._pending.get(key)
+                if pending is not None:
+                    if len(pending) >= self.max_pending_per_key:
+                        logger.warning("Task of %s dropped, %s tasks already waiting", key, len(pending))
+                        return False
+
+                    pending.append((fn, args))
+                    return True
+
+                self._pending[key] = collections.deque()
+
+        self._slots.acquire()
+        self._pool.submit(self._run, key, fn, args)
+        return True
+
+    def _run(self, key, fn, args):
+        """
+        Run a task, then schedule the next task of the same key
+        :param key: serialisation key
+        :param fn: function
+        :param args: function args
+        """
+        try:
+            if key is None:
+                fn(*args)
+            else:
+                with user_lock(key):
+                    fn(*args)
+        except Exception:
+            logger.exception("Task of %s failed", key)
+
+        if key is not None:
+            with self._lock:
+                pending = self._pending[key]
+                next_task = pending.popleft() if pending else None
+                if next_task is None:
+                    del self._pending[key]
+                    self._drained.notify_all()
+
+            if next_task is not None:
+                # The slot passes to the next task of the key
+                self._pool.submit(self._run, key, *next_task)
+                return
+
+        self._slots.release()
+
+    def shutdown(self):
+        """
+        Wait the completion of all the submitted tasks and release the workers
+        """
+        with self._lock:
+            self._drained.wait_for(lambda: not self._pending)
+
+        self._pool.shutdown(wait=True)
+
+
+class UserDataDispatcher(Dispatcher):
+    """
+    Dispatcher pinning the user data of the update user while the update is processed, so a bounded user data cache
+    doesn't evict it (E.g. for a reminder burst) while the handlers are still using it.
+    Persistence updates without an update (E.g. after every job) write only the user data marked as changed, instead
+    of serialising all the cached users
+    """
+
+    def process_update(self, update: object) -> None:
+        """
+        Process the update with the user data of its user pinned
+        :param update: update
+        """
+        user_ids = ()
+        if isinstance(update, Update) and update.effective_user:
+            user_ids = (update.effective_user.id,)
+
+        with pinned_user_data(self.user_data, user_ids):
+            super().process_update(update)
+
+    def update_persistence(self, update: object = None) -> None:
+        """
+        Update the persistence. With an update only its user and chat data are written, otherwise bot_data, chat_data
+        and the user data marked by mark_user_data_changed. User data written after every update and on eviction is
+        already up to date, so it isn't serialised again
+        :param update: processed update (None after jobs and on stop)
+        """
+        if isinstance(update, Update) or not self.persistence:
+            super().update_persistence(update)
+            return
+
+        if self.persistence.store_bot_data:
+            self._persist(self.persistence.update_bot_data, self.bot_data)
+        if self.persistence.store_chat_data:
+            for chat_id in list(self.chat_data):
+                self._persist(self.persistence.update_chat_data, chat_id, self.chat_data[chat_id])
+        if self.persistence.store_user_data:
+            for user_id in pop_changed_user_ids():
+                # Serialised with the updates and the jobs of the user, so its user data isn't pickled while it's
+                # changed
+                with user_lock(user_id):
+                    # Evicted user data (not cached anymore) is written back by the eviction
+                    data = dict.get(self.user_data, user_id)
+                    if data is not None:
+                        self._persist(self.persistence.update_user_data, user_id, data)
+
+    def _persist(self, update_method, *args):
+        """
+        Call a persistence update method, dispatching its error to the error handlers
+        :param update_method: persistence update method
+        :param args: method args
+        """
+        try:
+            update_method(*args)
+        except Exception as e:
+            try:
+                self.dispatch_error(None, e)
+            except Exception:
+                logger.exception("Persistence update failed")
+
+
+class ConcurrentDispatcher(UserDataDispatcher):
+    """
+    Dispatcher processing updates on a worker pool.
+    Updates of different users are processed in parallel, updates of the same user are processed in order, holding
+    the user lock, and the updates of a user exceeding PENDING_UPDATES_PER_USER waiting ones are dropped. Handlers still
+    run synchronously on the worker, so the persistence is updated after every update
+    """
+
+    def __init__(self, *args, executor: UserSerialExecutor, **kwargs):
+        """
+        Init method
+        :param args: Dispatcher args
+        :param executor: update executor
+        :param kwargs: Dispatcher kwargs
+        """
+        super().__init__(*args, **kwargs)
+        self.executor = executor
+
+    def process_update(self, update: object) -> None:
+        """
+        Submit the update to the executor, serialised by user (or chat when the update has no user)
+        :param update: update
+        """
+        if not isinstance(update, Update):
+            super().process_update(update)
+            return
+
+        key = None
+        if update.effective_user:
+            key = update.effective_user.id
+        elif update.effective_chat:
+            key = update.effective_chat.id
+
+        self.executor.submit(key, super().process_update, update)
+
+    def stop(self) -> None:
+        """
+        Stop the dispatcher, waiting the updates already submitted
+        """
+        super().stop()
+        self.executor.shutdown()
+
+
+def get_con_pool_size(workers: int):
+    """
+    Gets the connection pool size needed by the given number of update workers
+    :param workers: number of update workers
+    :return: the connection pool size
+    """
+    # One connection for every update worker, plus the default ones of Updater (4 async workers, dispatcher,
+    # updater, job queue and main thread)
+    return workers + 8
+
+
+def create_updater(bot: Bot, persistence, workers: int) -> Updater:
+    """
+    Create the updater
+    :param bot: bot (its connection pool must fit the update workers, see get_con_pool_size)
+    :param persistence: persistence
+    :param workers: number of update workers (0 to process updates on the dispatcher thread)
+    :return: the updater
+    """
+    job_queue = JobQueue()
+    if workers <= 0:
+        dispatcher = UserDataDispatcher(bot, Queue(), job_queue=job_queue, persistence=persistence)
+    else:
+        dispatcher = ConcurrentDispatcher(
+            bot,
+            Queue(),
+            job_queue=job_queue,
+            persistence=persistence,
+            executor=UserSerialExecutor(workers, workers * PENDING_UPDATES_PER_WORKER),
+        )
+        logger.info("Processing updates with %s workers", workers)
+    job_queue.set_dispatcher(dispatcher)
+
+    return Updater(dispatcher=dispatcher, workers=None)
@@ -7,12 +7,40 @@ REGISTER_CALLBACK = "register_callback"
 INPUT_KIND = "input_kind"
 LOGGED = "logged"
 USER_GROUP = "user_group"
+USER_TIMEZONE = "timezone"
 ENABLED_USERS = "enabled_users"
 REGISTRATION = "registration"
 BOT_DEFAULT_NAME = "shift-scheduling-bot"
 DB_DEFAULT_NAME = "bot.db"
+SQLITE_DB_DEFAULT_NAME = "bot.sqlite3"
+PERSISTENCE_PICKLE = "pickle"
+PERSISTENCE_SQLITE = "sqlite"
+PERSISTENCE_DEFAULT_BATCH_SIZE = 100
+PERSISTENCE_DEFAULT_BATCH_INTERVAL = 1.0
 SHIFTS_DEFAULT_FILENAME = "shifts.json"
 GROUP_PREFIX = "GROUP_"
+SHIFTS_RELOAD_DEFAULT_INTERVAL = 60
+WEEK_CACHE_DEFAULT_SIZE = 1024
+SHIFT_CHANGES_DEFAULT_LOOKAHEAD = 14
+BROADCAST_DEFAULT_RATE = 25
+BROADCAST_DEFAULT_SENDERS = 4
+UPDATE_DEFAULT_WORKERS = 0
+DEFAULT_TIMEZONE = "Europe/Rome"
+# Inline keyboards older than a week are refused, approval requests included
+CALLBACK_DEFAULT_TTL = 7 * 24 * 60 * 60
+OUTBOUND_DEFAULT_RATE = 28
+OUTBOUND_DEFAULT_CHAT_RATE = 1
+OUTBOUND_DEFAULT_CHAT_BURST = 3
+OUTBOUND_DEFAULT_JITTER = 1.0
+REMINDER_DEFAULT_SPREAD = 60
+WEBHOOK_DEFAULT_HOST = "0.0.0.0"
+WEBHOOK_DEFAULT_PORT = 8443
+WEBHOOK_DEFAULT_PATH = "/telegram"
+WEBHOOK_DEFAULT_QUEUE_SIZE = 1000
+METRICS_DEFAULT_HOST = "127.0.0.1"
+PROFILE_DEFAULT_WINDOW = 60
+PROFILE_MAX_WINDOW = 600
+PROFILE_DEFAULT_TOP = 10
 
 
 def get_bot_name():
@@ -33,6 +61,42 @@ def get_database_name():
     return os.getenv("DB_NAME") or DB_DEFAULT_NAME
 
 
+def get_sqlite_database_name():
+    """
+    Returns the SQLite database name, using the following logic:
+    SQLITE_DB_NAME env if variable is filled, otherwise, SQLITE_DB_DEFAULT_NAME
+    :return: the SQLite database name
+    """
+    return os.getenv("SQLITE_DB_NAME") or SQLITE_DB_DEFAULT_NAME
+
+
+def get_persistence_backend():
+    """
+    Returns the persistence backend (PERSISTENCE_PICKLE or PERSISTENCE_SQLITE), using the following logic:
+    PERSISTENCE env if variable is filled, otherwise, PERSISTENCE_PICKLE
+    :return: the persistence backend
+    """
+    return (os.getenv("PERSISTENCE") or PERSISTENCE_PICKLE).strip().lower()
+
+
+def get_persistence_batch_size():
+    """
+    Returns the max pending persistence changes before commit, using the following logic:
+    PERSISTENCE_BATCH_SIZE env if variable is filled, otherwise, PERSISTENCE_DEFAULT_BATCH_SIZE
+    :return: the persistence batch size
+    """
+    return int(os.getenv("PERSISTENCE_BATCH_SIZE") or PERSISTENCE_DEFAULT_BATCH_SIZE)
+
+
+def get_persistence_batch_interval():
+    """
+    Returns the max seconds before committing pending persistence changes, using the following logic:
+    PERSISTENCE_BATCH_INTERVAL env if variable is filled, otherwise, PERSISTENCE_DEFAULT_BATCH_INTERVAL
+    :return: the persistence batch interval
+    """
+    return float(os.getenv("PERSISTENCE_BATCH_INTERVAL") or PERSISTENCE_DEFAULT_BATCH_INTERVAL)
+
+
 def get_shifts_filename():
     """
     Returns the shifts file name, using the following logic:
@@ -40,3 +104,277 @@ def get_shifts_filename():
     :return: the shifts file name
     """
     return os.getenv("SHIFTS_FILENAME") or SHIFTS_DEFAULT_FILENAME
+
+
+def get_shifts_reload_interval():
+    """
+    Returns the shifts file reload interval in seconds, using the following logic:
+    SHIFTS_RELOAD_INTERVAL env if variable is filled, otherwise, SHIFTS_RELOAD_DEFAULT_INTERVAL.
+    A value of 0 disables the reload
+    :return: the shifts file reload interval
+    """
+    return int(os.getenv("SHIFTS_RELOAD_INTERVAL") or SHIFTS_RELOAD_DEFAULT_INTERVAL)
+
+
+def get_shifts_streaming():
+    """
+    Returns if the shifts file must be loaded with the streaming parser, using the following logic:
+    SHIFTS_STREAMING env if variable is filled (true/1/yes), otherwise, False
+    :return: True if streaming parser must be used, False otherwise
+    """
+    return (os.getenv("SHIFTS_STREAMING") or "").strip().lower() in ("1", "true", "yes")
+
+
+def get_week_cache_size():
+    """
+    Returns the max number of rendered weeks to cache, using the following logic:
+    WEEK_CACHE_SIZE env if variable is filled, otherwise, WEEK_CACHE_DEFAULT_SIZE.
+    A value of 0 disables the cache
+    :return: the week cache size
+    """
+    return int(os.getenv("WEEK_CACHE_SIZE") or WEEK_CACHE_DEFAULT_SIZE)
+
+
+def get_shift_changes_lookahead():
+    """
+    Returns the days, starting from today, whose shift changes are notified to the users, using the following logic:
+    SHIFT_CHANGES_LOOKAHEAD env if variable is filled, otherwise, SHIFT_CHANGES_DEFAULT_LOOKAHEAD.
+    0 disables the notifications
+    :return: the shift changes lookahead
+    """
+    return int(os.getenv("SHIFT_CHANGES_LOOKAHEAD") or SHIFT_CHANGES_DEFAULT_LOOKAHEAD)
+
+
+def get_broadcast_rate():
+    """
+    Returns the max broadcast messages per second, using the following logic:
+    BROADCAST_RATE env if variable is filled, otherwise, BROADCAST_DEFAULT_RATE
+    :return: the broadcast rate
+    """
+    return float(os.getenv("BROADCAST_RATE") or BROADCAST_DEFAULT_RATE)
+
+
+def get_broadcast_senders():
+    """
+    Returns the number of concurrent broadcast senders, using the following logic:
+    BROADCAST_SENDERS env if variable is filled, otherwise, BROADCAST_DEFAULT_SENDERS
+    :return: the number of broadcast senders
+    """
+    return int(os.getenv("BROADCAST_SENDERS") or BROADCAST_DEFAULT_SENDERS)
+
+
+def get_user_data_cache_size():
+    """
+    Returns the max number of user data kept in memory by the SQLite persistence, using the following logic:
+    USER_DATA_CACHE_SIZE env if variable is filled, otherwise, 0 (all user data loaded at startup)
+    :return: the user data cache size
+    """
+    return int(os.getenv("USER_DATA_CACHE_SIZE") or 0)
+
+
+def get_telegram_base_url():
+    """
+    Returns the Bot API base URL, using the following logic:
+    TELEGRAM_BASE_URL env if variable is filled (E.g. http://127.0.0.1:8081/bot, the token is appended),
+    otherwise, None to use the Telegram servers
+    :return: the Bot API base URL
+    """
+    return os.getenv("TELEGRAM_BASE_URL") or None
+
+
+def get_record_updates():
+    """
+    Returns the file where the incoming updates are recorded, using the following logic:
+    RECORD_UPDATES env if variable is filled (relative to DATA_DIR, E.g. updates.jsonl.gz), otherwise, None to
+    disable the recording
+    :return: the recording file
+    """
+    return os.getenv("RECORD_UPDATES") or None
+
+
+def get_record_key():
+    """
+    Returns the key of the pseudonymous ids of the recorded updates, using the following logic:
+    RECORD_KEY env if variable is filled, otherwise, None to use a random key
+    :return: the record key
+    """
+    return os.getenv("RECORD_KEY") or None
+
+
+def get_metrics_port():
+    """
+    Returns the metrics endpoint port, using the following logic:
+    METRICS_PORT env if variable is filled, otherwise, None to disable the metrics endpoint
+    :return: the metrics port
+    """
+    return int(os.getenv("METRICS_PORT") or 0) or None
+
+
+def get_metrics_host():
+    """
+    Returns the metrics endpoint listen host, using the following logic:
+    METRICS_HOST env if variable is filled, otherwise, METRICS_DEFAULT_HOST
+    :return: the metrics listen host
+    """
+    return os.getenv("METRICS_HOST") or METRICS_DEFAULT_HOST
+
+
+def get_profile_window():
+    """
+    Returns the seconds of the profiling session started with the bot, using the following logic:
+    PROFILE_WINDOW env if variable is filled (capped to PROFILE_MAX_WINDOW), otherwise, None to start the bot without
+    profiling (sessions can be started with the /profila command)
+    :return: the profiling window
+    """
+    window = int(os.getenv("PROFILE_WINDOW") or 0)
+    return min(window, PROFILE_MAX_WINDOW) if window > 0 else None
+
+
+def get_profile_top():
+    """
+    Returns the number of entries of the profiling summary lists, using the following logic:
+    PROFILE_TOP env if variable is filled, otherwise, PROFILE_DEFAULT_TOP
+    :return: the number of summary entries
+    """
+    return int(os.getenv("PROFILE_TOP") or PROFILE_DEFAULT_TOP)
+
+
+def get_webhook_url():
+    """
+    Returns the public webhook URL, using the following logic:
+    WEBHOOK_URL env if variable is filled, otherwise, None (long polling is used)
+    :return: the webhook URL
+    """
+    return os.getenv("WEBHOOK_URL") or None
+
+
+def get_webhook_host():
+    """
+    Returns the webhook listen host, using the following logic:
+    WEBHOOK_HOST env if variable is filled, otherwise, WEBHOOK_DEFAULT_HOST
+    :return: the webhook listen host
+    """
+    return os.getenv("WEBHOOK_HOST") or WEBHOOK_DEFAULT_HOST
+
+
+def get_webhook_port():
+    """
+    Returns the webhook listen port, using the following logic:
+    WEBHOOK_PORT env if variable is filled, otherwise, WEBHOOK_DEFAULT_PORT
+    :return: the webhook listen port
+    """
+    return int(os.getenv("WEBHOOK_PORT") or WEBHOOK_DEFAULT_PORT)
+
+
+def get_webhook_path():
+    """
+    Returns the webhook path, using the following logic:
+    WEBHOOK_PATH env if variable is filled, otherwise, WEBHOOK_DEFAULT_PATH
+    :return: the webhook path
+    """
+    return os.getenv("WEBHOOK_PATH") or WEBHOOK_DEFAULT_PATH
+
+
+def get_webhook_secret():
+    """
+    Returns the webhook secret token, using the following logic:
+    WEBHOOK_SECRET env if variable is filled, otherwise, None (requests aren't checked)
+    :return: the webhook secret token
+    """
+    return os.getenv("WEBHOOK_SECRET") or None
+
+
+def get_webhook_queue_size():
+    """
+    Returns the max number of updates waiting for the dispatcher in webhook mode, using the following logic:
+    WEBHOOK_QUEUE_SIZE env if variable is filled, otherwise, WEBHOOK_DEFAULT_QUEUE_SIZE
+    :return: the webhook queue size
+    """
+    return int(os.getenv("WEBHOOK_QUEUE_SIZE") or WEBHOOK_DEFAULT_QUEUE_SIZE)
+
+
+def get_update_workers():
+    """
+    Returns the number of concurrent update workers, using the following logic:
+    UPDATE_WORKERS env if variable is filled, otherwise, UPDATE_DEFAULT_WORKERS.
+    A value of 0 processes the updates sequentially on the dispatcher thread
+    :return: the number of update workers
+    """
+    return int(os.getenv("UPDATE_WORKERS") or UPDATE_DEFAULT_WORKERS)
+
+
+def get_outbound_rate():
+    """
+    Returns the max outbound requests per second, using the following logic:
+    OUTBOUND_RATE env if variable is filled, otherwise, OUTBOUND_DEFAULT_RATE
+    :return: the outbound rate
+    """
+    return float(os.getenv("OUTBOUND_RATE") or OUTBOUND_DEFAULT_RATE)
+
+
+def get_outbound_chat_rate():
+    """
+    Returns the max outbound requests per second for a single chat, using the following logic:
+    OUTBOUND_CHAT_RATE env if variable is filled, otherwise, OUTBOUND_DEFAULT_CHAT_RATE
+    :return: the outbound chat rate
+    """
+    return float(os.getenv("OUTBOUND_CHAT_RATE") or OUTBOUND_DEFAULT_CHAT_RATE)
+
+
+def get_outbound_chat_burst():
+    """
+    Returns the max burst of outbound requests for a single chat, using the following logic:
+    OUTBOUND_CHAT_BURST env if variable is filled, otherwise, OUTBOUND_DEFAULT_CHAT_BURST
+    :return: the outbound chat burst
+    """
+    return float(os.getenv("OUTBOUND_CHAT_BURST") or OUTBOUND_DEFAULT_CHAT_BURST)
+
+
+def get_outbound_jitter():
+    """
+    Returns the max random delay in seconds added to the flood waits, using the following logic:
+    OUTBOUND_JITTER env if variable is filled, otherwise, OUTBOUND_DEFAULT_JITTER
+    :return: the outbound jitter
+    """
+    return float(os.getenv("OUTBOUND_JITTER") or OUTBOUND_DEFAULT_JITTER)
+
+
+def get_reminder_spread():
+    """
+    Returns the window in seconds over which the reminders of a slot are staggered, using the following logic:
+    REMINDER_SPREAD env if variable is filled, otherwise, REMINDER_DEFAULT_SPREAD
+    :return: the reminder spread
+    """
+    return float(os.getenv("REMINDER_SPREAD") or REMINDER_DEFAULT_SPREAD)
+
+
+def get_callback_secret():
+    """
+    Returns the secret used to sign the callback data, using the following logic:
+    CALLBACK_SECRET env if variable is filled, otherwise, TELEGRAM_TOKEN env
+    :return: the callback secret
+    :raise ValueError: if neither variable is filled
+    """
+    secret = os.getenv("CALLBACK_SECRET") or os.getenv("TELEGRAM_TOKEN")
+    if not secret:
+        raise ValueError("CALLBACK_SECRET or TELEGRAM_TOKEN must be set to sign the callback data")
+
+    return secret
+
+
+def get_callback_ttl():
+    """
+    Returns the max age in seconds of the inline keyboard buttons (also the admin approval ones), using the following
+    logic: CALLBACK_TTL env if variable is filled, otherwise, CALLBACK_DEFAULT_TTL (7 days)
+    :return: the callback TTL
+    """
+    return int(os.getenv("CALLBACK_TTL") or CALLBACK_DEFAULT_TTL)
+
+
+def get_default_timezone():
+    """
+    Returns the timezone of the users that haven't set it, using the following logic:
+    DEFAULT_TIMEZONE env if variable is filled, otherwise, DEFAULT_TIMEZONE
+    :return: the default timezone name
+    """
+    return os.getenv("DEFAULT_TIMEZONE") or DEFAULT_TIMEZONE
@@ -1,62 +1,137 @@
 """Helper module."""
 
+import base64
+import contextlib
+import functools
+import hashlib
+import hmac
 import logging
 import re
-import uuid
+import time
 from typing import Union
 
-from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove
-from telegram.ext import CallbackContext
+from telegram import InlineKeyboardButton, InlineKeyboardMarkup, ReplyKeyboardRemove, Update
+from telegram.ext import CallbackContext, Dispatcher
 
+from . import metrics
+from . import profiling
 from .constants import *
+from .sqlitepersistence import SQLitePersistence
 
-CALLBACK_SESSION = "callback_session"
+# Signed callback data: action#argument.issued.signature
+CALLBACK_SIGNATURE_SIZE = 9
+CALLBACK_TOKEN_PATTERN = r"\w*\.[0-9a-f]+\.[\w-]+"
+CALLBACK_DATA_REGEX = re.compile(r"^(\w+)#(\w*)\.([0-9a-f]+)\.([\w-]+)$")
 
 logger = logging.getLogger(__name__)
 
 
-def make_keyboard(buttons: Union[list, tuple], context: CallbackContext = None, user_data: dict = None):
+def make_keyboard(buttons: Union[list, tuple], user_id: int):
     """
-    Create inline keyboard markup
-    :param buttons: buttons to add (Supported type are List of Tuple)
-    :param context: context
-    :param user_data: user_data
+    Create inline keyboard markup. Callback data of every button is signed for the user (see sign_callback_data)
+    :param buttons: buttons to add (Supported type are List of Tuple). A button is a tuple of text, callback and,
+    optionally, a callback argument
+    :param user_id: id of the user allowed to press the buttons
     :return: inline keyboard markup
     """
-    keyboard = []
-
-    session = str(uuid.uuid4())
-    if context:
-        context.user_data[CALLBACK_SESSION] = session
-    else:
-        user_data[CALLBACK_SESSION] = session
-
     if isinstance(buttons, list):
-        for row in buttons:
-            keyboard.append(
-                [
-                    InlineKeyboardButton(
-                        text=button[0],
-                        callback_data=f"{button[1]}#{session}"
-                    )
-                    for button in row
-                ]
-            )
-    elif isinstance(buttons, tuple):
         keyboard = [
             [
-                InlineKeyboardButton(
-                    text=buttons[0],
-                    callback_data=f"{buttons[1]}#{session}"
-                )
+                InlineKeyboardButton(text=button[0], callback_data=sign_callback_data(user_id, *button[1:]))
+                for button in row
             ]
+            for row in buttons
         ]
+    elif isinstance(buttons, tuple):
+        keyboard = [[InlineKeyboardButton(text=buttons[0], callback_data=sign_callback_data(user_id, *buttons[1:]))]]
     else:
         raise Exception("Invalid buttons type")
 
     return InlineKeyboardMarkup(keyboard)
 
 
+@functools.lru_cache(maxsize=None)
+def get_callback_key():
+    """
+    Gets the key of the callback data signatures, derived from CALLBACK_SECRET env
+    :return: the key
+    :raise ValueError: if no callback secret is set
+    """
+    return hashlib.sha256(get_callback_secret().encode()).digest()
+
+
+def callback_signature(user_id: int, action: str, argument: str, issued: str):
+    """
+    Compute the callback data signature: truncated HMAC-SHA256 of user, action, argument and issue time
+    :param user_id: user id
+    :param action: callback action
+    :param argument: callback argument
+    :param issued: issue time (hex seconds)
+    :return: the URL safe signature
+    """
+    message = f"{user_id}|{action}|{argument}|{issued}".encode()
+    digest = hmac.new(get_callback_key(), message, hashlib.sha256).digest()[:CALLBACK_SIGNATURE_SIZE]
+    return base64.urlsafe_b64encode(digest).decode()
+
+
+def sign_callback_data(user_id: int, action: str, argument="") -> str:
+    """
+    Create the signed callback data, in the format action#argument.issued.signature
+    :param user_id: id of the user allowed to press the button
+    :param action: callback action
+    :param argument: callback argument (word characters only)
+    :return: the callback data
+    """
+    issued = format(int(time.time()), "x")
+    return f"{action}#{argument}.{issued}.{callback_signature(user_id, action, argument, issued)}"
+
+
+def verify_callback_data(data: str, user_id: int, ttl: int = None):
+    """
+    Verify the signed callback data. Check doesn't need any user state
+    :param data: callback data
+    :param user_id: id of the user that pressed the button
+    :param ttl: max age in seconds of the callback data (None to accept any age)
+    :return: True if callback data is valid, False if it's forged, signed for another user or expired
+    """
+    match = CALLBACK_DATA_REGEX.match(data or "")
+    if not match:
+        return False
+
+    action, argument, issued, signature = match.groups()
+    if not hmac.compare_digest(signature, callback_signature(user_id, action, argument, issued)):
+        return False
+
+    return ttl is None or time.time() - int(issued, 16) <= ttl
+
+
+def callback_action(update: Update) -> str:
+    """
+    Gets the action of the pressed button
+    :param update: update
+    :return: the callback action
+    """
+    return update.callback_query.data.partition("#")[0]
+
+
+def callback_argument(update: Update) -> str:
+    """
+    Gets the argument of the pressed button
+    :param update: update
+    :return: the callback argument (empty string if button has no argument)
+    """
+    return update.callback_query.data.partition("#")[2].partition(".")[0]
+
+
+@functools.lru_cache(maxsize=None)
+def get_admin_users():
+    """
+    Gets the admin users, parsed once from ADMIN_USERS env
+    :return: frozenset of admin user ids
+    """
+    return frozenset(int(x.strip()) for x in os.getenv("ADMIN_USERS").split(","))
+
+
 def logged_user(func):
     """
     Logged user checks
@@ -64,6 +139,7 @@ def logged_user(func):
     :return: wrapper
     """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
         Effective checks
@@ -76,7 +152,7 @@ def logged_user(func):
             func(*args, **kwargs)
         else:
             message = "Devi prima comunicare il tuo gruppo per utilizzare questo comando! ⛔"
-            keyboard = make_keyboard(("Login", LOGIN_CALLBACK), context)
+            keyboard = make_keyboard(("Login", LOGIN_CALLBACK), update.effective_user.id)
             if update.callback_query:
                 update.callback_query.answer()
                 update.callback_query.edit_message_text(
@@ -99,6 +175,7 @@ def valid_user(func):
     :return: wrapper
     """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
         Effective checks
@@ -122,7 +199,7 @@ def valid_user(func):
             if not context.user_data.get(REGISTRATION):
                 message = ("Il tuo utente non risulta abilitato all'utilizzo di questo comando\n\n"
                            f"Per utilizzare {get_bot_name()} richiedi la registrazione attraverso l'apposita opzione.")
-                keyboard = make_keyboard(("Registrami", REGISTER_CALLBACK), context)
+                keyboard = make_keyboard(("Registrami", REGISTER_CALLBACK), update.effective_user.id)
             else:
                 message = "Richiesta di registrazione in attesa di approvazione."
                 keyboard = ReplyKeyboardRemove()
@@ -153,6 +230,7 @@ def admin_user(func):
     :return: wrapper
     """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
         Effective checks
@@ -161,9 +239,7 @@ def admin_user(func):
         """
         update = args[0]
 
-        admins = [int(x.strip()) for x in os.getenv("ADMIN_USERS").split(",")]
-
-        if update.message.from_user.id not in admins:
+        if update.message.from_user.id not in get_admin_users():
             logger.warning(
                 "User %s (%s) try to use an admin command",
                 update.effective_user.id,
@@ -176,6 +252,46 @@ def admin_user(func):
     return wrapper
 
 
+@contextlib.contextmanager
+def handler_timer(kind: str, name: str):
+    """
+    Context manager recording the duration of a handler in the metrics, profiling it when a session is running
+    :param kind: handler kind (E.g. command, callback, input)
+    :param name: handler name
+    """
+    with metrics.HANDLER_DURATION.time(kind, name), profiling.profile(kind, name):
+        yield
+
+
+def timed(kind: str):
+    """
+    Record the duration of the decorated handler, for the handlers without @command or @callback
+    :param kind: handler kind (E.g. callback, input)
+    :return: decorator
+    """
+
+    def decorator(func):
+        """
+        Decorator
+        :param func: func
+        :return: wrapper
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """
+            Timed call
+            :param args: args
+            :param kwargs: kwargs
+            """
+            with handler_timer(kind, func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
 def callback(func):
     """
     Callback preliminary checks
@@ -183,30 +299,27 @@ def callback(func):
     :return: wrapper
     """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
         Effective checks
         :param args: args
         :param kwargs: kwargs
         """
-        update, context = args[0], args[1]
+        update = args[0]
 
-        if not update.callback_query:
-            func(*args, **kwargs)
-            return
+        with handler_timer("callback", func.__name__):
+            if not update.callback_query:
+                func(*args, **kwargs)
+                return
 
-        update.callback_query.answer()
+            update.callback_query.answer()
 
-        match = re.match(r"^([\w]+)#([\w-]+)$", update.callback_query.data)
-        if not match:
-            update.callback_query.delete_message()
-            return
+            if not verify_callback_data(update.callback_query.data, update.effective_user.id, get_callback_ttl()):
+                update.callback_query.delete_message()
+                return
 
-        if match[2] != context.user_data.get(CALLBACK_SESSION):
-            update.callback_query.delete_message()
-            return
-
-        func(*args, **kwargs)
+            func(*args, **kwargs)
 
     return wrapper
 
@@ -218,6 +331,7 @@ def command(func):
     :return: wrapper
     """
 
+    @functools.wraps(func)
     def wrapper(*args, **kwargs):
         """
         Effective checks
@@ -226,9 +340,10 @@ def command(func):
         """
         context = args[1]
 
-        context.user_data[INPUT_KIND] = None
+        with handler_timer("command", func.__name__):
+            context.user_data[INPUT_KIND] = None
 
-        func(*args, **kwargs)
+            func(*args, **kwargs)
 
     return wrapper
 
@@ -239,4 +354,39 @@ def callback_pattern(key):
     :param key: key to use
     :return: callback pattern
     """
-    return "^" + key + "#[\\w-]+$"
+    return "^" + key + "#" + CALLBACK_TOKEN_PATTERN + "$"
+
+
+def iter_user_data(dispatcher: Dispatcher):
+    """
+    Iterate all the user data, streaming them from the persistence when supported
+    :param dispatcher: dispatcher
+    :return: iterator of (user id, user data)
+    """
+    if isinstance(dispatcher.persistence, SQLitePersistence):
+        return dispatcher.persistence.iter_user_data()
+
+    return iter(list(dispatcher.user_data.items()))
+
+
+def get_index_store(dispatcher: Dispatcher, key_prefix: str, version_key: str) -> dict:
+    """
+    Gets the mapping where an index (E.g. reminder slots, users index) is stored.
+    The index is persisted in bot_data only with SQLitePersistence, which writes only the changed keys: the other
+    persistences copy and compare the whole bot_data on every update, so with them the index is kept in memory and
+    rebuilt at every start, and the index keys left in bot_data are removed
+    :param dispatcher: dispatcher
+    :param key_prefix: prefix of the index keys
+    :param version_key: key of the index version
+    :return: bot_data with SQLitePersistence, a new dict otherwise
+    """
+    if isinstance(dispatcher.persistence, SQLitePersistence):
+        return dispatcher.bot_data
+
+    bot_data = dispatcher.bot_data
+    for key in [key for key in bot_data if isinstance(key, str) and key.startswith(key_prefix)]:
+        del bot_data[key]
+    bot_data.pop(version_key, None)
+
+    return dict()
+
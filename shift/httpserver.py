@@ -0,0 +1,61 @@
+"""Background HTTP server module."""
+
+import logging
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+logger = logging.getLogger(__name__)
+
+
+class BackgroundRequestHandler(BaseHTTPRequestHandler):
+    """
+    Request handler logging the requests to the logger of its server, at debug level
+    """
+
+    server: "BackgroundHTTPServer"
+
+    def log_message(self, format, *args):
+        """
+        Redirect the request log to the server logger
+        :param format: format
+        :param args: args
+        """
+        self.server.logger.debug("%s - " + format, self.client_address[0], *args)
+
+
+class BackgroundHTTPServer(ThreadingHTTPServer):
+    """
+    Threaded HTTP listener serving requests in a background thread.
+    Request threads are daemon, so a stuck client doesn't block the bot stop
+    """
+
+    daemon_threads = True
+    # Name of the serving thread
+    name = "http"
+    logger = logger
+
+    def __init__(self, host: str, port: int, handler_class):
+        """
+        Init method
+        :param host: listen host
+        :param port: listen port (0 to pick a free port)
+        :param handler_class: request handler class
+        """
+        super().__init__((host, port), handler_class)
+        self._thread = None
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        self._thread = threading.Thread(target=self.serve_forever, name=self.name, daemon=True)
+        self._thread.start()
+
+    def shutdown(self):
+        """
+        Stop serving requests and close the listener
+        """
+        super().shutdown()
+        self.server_close()
+        if self._thread:
+            self._thread.join()
@@ -0,0 +1,144 @@
+"""Incremental JSON reader module."""
+
+import json
+
+JSON_WHITESPACE = " \t\r\n"
+JSON_NUMBER_CHARS = "0123456789+-.eE"
+DEFAULT_CHUNK_SIZE = 64 * 1024
+
+
+class JsonStream:
+    """
+    Incremental JSON reader.
+    The document is read in chunks and walked through objects and arrays, decoding only the values explicitly
+    requested, so memory stays proportional to the largest decoded value instead of the whole document
+    """
+
+    def __init__(self, f, chunk_size: int = DEFAULT_CHUNK_SIZE):
+        """
+        Init method
+        :param f: text file object
+        :param chunk_size: read chunk size
+        """
+        self.f = f
+        self.chunk_size = chunk_size
+        self.buffer = ""
+        self.pos = 0
+        self.eof = False
+        self.decoder = json.JSONDecoder()
+
+    def _fill(self, size: int = None):
+        """
+        Read another chunk, discarding the already consumed part of the buffer
+        :param size: chunk size (chunk_size if not filled)
+        :return: True if something was read, False at end of file
+        """
+        if self.eof:
+            return False
+
+        chunk = self.f.read(size or self.chunk_size)
+        if not chunk:
+            self.eof = True
+            return False
+
+        self.buffer = self.buffer[self.pos:] + chunk
+        self.pos = 0
+        return True
+
+    def peek(self):
+        """
+        Skip whitespaces and return the next character, without consuming it
+        :return: next character, empty string at end of file
+        """
+        while True:
+            while self.pos < len(self.buffer) and self.buffer[self.pos] in JSON_WHITESPACE:
+                self.pos += 1
+
+            if self.pos < len(self.buffer):
+                return self.buffer[self.pos]
+
+            if not self._fill():
+                return ""
+
+    def expect(self, char: str):
+        """
+        Consume the given character
+        :param char: expected character
+        :raise ValueError: if next character is different
+        """
+        found = self.peek()
+        if found != char:
+            raise ValueError(f"Expected {char!r} but found {found!r}")
+
+        self.pos += 1
+
+    def value(self):
+        """
+        Decode the next value
+        :return: decoded value
+        :raise ValueError: if value isn't valid JSON
+        """
+        self.peek()
+        size = self.chunk_size
+
+        while True:
+            try:
+                value, end = self.decoder.raw_decode(self.buffer, self.pos)
+            except json.JSONDecodeError:
+                # Value truncated by the chunk boundary. Read more data, doubling chunk size on large values
+                if self._fill(size):
+                    size *= 2
+                    continue
+                raise
+
+            # Numbers can be truncated by the chunk boundary without raising errors (E.g. "1" of "12" or "1." of "1.5")
+            if not self.buffer[end:].strip(JSON_NUMBER_CHARS) and self._fill(size):
+                continue
+
+            self.pos = end
+            return value
+
+    def items(self):
+        """
+        Walk an object. Every yielded key must be followed by the consumption of its value
+        (value() or another walk method)
+        :return: keys iterator
+        """
+        self.expect("{")
+        if self.peek() == "}":
+            self.pos += 1
+            return
+
+        while True:
+            key = self.value()
+            if not isinstance(key, str):
+                raise ValueError(f"Invalid object key {key!r}")
+            self.expect(":")
+
+            yield key
+
+            if self.peek() == "}":
+                self.pos += 1
+                return
+            self.expect(",")
+
+    def elements(self):
+        """
+        Walk an array. Every iteration must be followed by the consumption of the element
+        (value() or another walk method)
+        :return: iterator of element indexes
+        """
+        self.expect("[")
+        if self.peek() == "]":
+            self.pos += 1
+            return
+
+        index = 0
+        while True:
+            yield index
+            index += 1
+
+            if self.peek() == "]":
+                self.pos += 1
+                return
+            self.expect(",")
@@ -0,0 +1,91 @@
+"""LRU cache module."""
+
+import threading
+from collections import OrderedDict
+
+
+class LRUCache:
+    """
+    Thread safe LRU cache with hit/miss counters
+    """
+
+    def __init__(self, maxsize: int):
+        """
+        Init method
+        :param maxsize: max number of entries (0 disables the cache)
+        """
+        self.maxsize = maxsize
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, key):
+        """
+        Return if key is cached, without updating counters and recency
+        :param key: key
+        :return: True if key is cached, False otherwise
+        """
+        return key in self._entries
+
+    def __len__(self):
+        """
+        Number of cached entries
+        :return: number of cached entries
+        """
+        return len(self._entries)
+
+    def get(self, key):
+        """
+        Get the cached value
+        :param key: key
+        :return: cached value, None if key isn't cached
+        """
+        with self._lock:
+            try:
+                self._entries.move_to_end(key)
+            except KeyError:
+                self.misses += 1
+                return None
+
+            self.hits += 1
+            return self._entries[key]
+
+    def put(self, key, value):
+        """
+        Cache a value, evicting the least recently used entry when cache is full
+        :param key: key
+        :param value: value
+        """
+        if self.maxsize <= 0:
+            return
+
+        with self._lock:
+            self._entries[key] = value
+            self._entries.move_to_end(key)
+            if len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+
+    def resize(self, maxsize: int):
+        """
+        Change the max number of entries, evicting the least recently used entries that don't fit anymore
+        :param maxsize: max number of entries (0 disables the cache)
+        """
+        with self._lock:
+            self.maxsize = maxsize
+            while self._entries and len(self._entries) > max(maxsize, 0):
+                self._entries.popitem(last=False)
+
+    def clear(self):
+        """
+        Remove all cached entries. Counters are kept
+        """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        Cache statistics
+        :return: dict with size, maxsize, hits and misses
+        """
+        return {"size": len(self._entries), "maxsize": self.maxsize, "hits": self.hits, "misses": self.misses}
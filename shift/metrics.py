@@ -0,0 +1,352 @@
+"""Metrics module."""
+
+import bisect
+import contextlib
+import logging
+import threading
+import time
+from http import HTTPStatus
+
+from .httpserver import BackgroundHTTPServer, BackgroundRequestHandler
+
+CONTENT_TYPE = "text/plain; version=0.0.4; charset=utf-8"
+METRICS_PATH = "/metrics"
+DEFAULT_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+DELAY_BUCKETS = (0.01, 0.05, 0.1, 0.5, 1.0, 2.0, 5.0, 10.0, 30.0, 60.0, 300.0)
+
+logger = logging.getLogger(__name__)
+
+
+def escape_label_value(value) -> str:
+    """
+    Escape a label value for the Prometheus text format
+    :param value: label value
+    :return: the escaped value
+    """
+    return str(value).replace("\\", "\\\\").replace("\n", "\\n").replace('"', '\\"')
+
+
+def format_labels(names, values, extra: str = "") -> str:
+    """
+    Format the labels of a sample
+    :param names: label names
+    :param values: label values
+    :param extra: already formatted label appended to the others (E.g. le="0.1")
+    :return: the formatted labels, empty string when there are no labels
+    """
+    labels = [f'{name}="{escape_label_value(value)}"' for name, value in zip(names, values)]
+    if extra:
+        labels.append(extra)
+
+    return "{" + ",".join(labels) + "}" if labels else ""
+
+
+def format_value(value) -> str:
+    """
+    Format a sample value
+    :param value: value
+    :return: the formatted value
+    """
+    if value == float("inf"):
+        return "+Inf"
+
+    return repr(float(value)) if isinstance(value, float) else str(value)
+
+
+class Metric:
+    """
+    Base metric, with a value for every combination of label values
+    """
+
+    kind = "untyped"
+
+    def __init__(self, name: str, description: str, labels=()):
+        """
+        Init method
+        :param name: metric name
+        :param description: metric help
+        :param labels: label names
+        """
+        self.name = name
+        self.description = description
+        self.labels = tuple(labels)
+        self._values = dict()
+        self._lock = threading.Lock()
+
+    def render(self):
+        """
+        Render the metric in the Prometheus text format
+        :return: list of lines
+        """
+        with self._lock:
+            values = sorted(self._values.items())
+
+        lines = [f"# HELP {self.name} {self.description}", f"# TYPE {self.name} {self.kind}"]
+        for label_values, value in values:
+            lines.extend(self.render_samples(label_values, value))
+
+        return lines
+
+    def render_samples(self, label_values: tuple, value):
+        """
+        Render the samples of a combination of label values
+        :param label_values: label values
+        :param value: metric value
+        :return: list of lines
+        """
+        return [f"{self.name}{format_labels(self.labels, label_values)} {format_value(value)}"]
+
+
+class Counter(Metric):
+    """
+    Monotonic counter
+    """
+
+    kind = "counter"
+
+    def inc(self, *label_values, amount: float = 1):
+        """
+        Increment the counter
+        :param label_values: label values
+        :param amount: increment
+        """
+        with self._lock:
+            self._values[label_values] = self._values.get(label_values, 0) + amount
+
+
+class Gauge(Metric):
+    """
+    Value that can go up and down
+    """
+
+    kind = "gauge"
+
+    def set(self, value: float, *label_values):
+        """
+        Set the gauge
+        :param value: value
+        :param label_values: label values
+        """
+        with self._lock:
+            self._values[label_values] = value
+
+
+class Histogram(Metric):
+    """
+    Histogram of observed values, with cumulative buckets
+    """
+
+    kind = "histogram"
+
+    def __init__(self, name: str, description: str, labels=(), buckets=DEFAULT_BUCKETS):
+        """
+        Init method
+        :param name: metric name
+        :param description: metric help
+        :param labels: label names
+        :param buckets: upper bounds of the buckets (+Inf is added)
+        """
+        super().__init__(name, description, labels)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value: float, *label_values):
+        """
+        Observe a value
+        :param value: value
+        :param label_values: label values
+        """
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(label_values)
+            if state is None:
+                # Bucket counts (last is +Inf), sum
+                state = self._values[label_values] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    @contextlib.contextmanager
+    def time(self, *label_values):
+        """
+        Context manager observing the duration of its block, also when the block raises
+        :param label_values: label values
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(time.perf_counter() - start, *label_values)
+
+    def render_samples(self, label_values: tuple, value):
+        """
+        Render the buckets, sum and count of a combination of label values
+        :param label_values: label values
+        :param value: bucket counts and sum
+        :return: list of lines
+        """
+        counts, total = value
+        lines = []
+        cumulative = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            cumulative += count
+            labels = format_labels(self.labels, label_values, f'le="{format_value(float(bound))}"')
+            lines.append(f"{self.name}_bucket{labels} {cumulative}")
+
+        labels = format_labels(self.labels, label_values)
+        lines.append(f"{self.name}_sum{labels} {format_value(total)}")
+        lines.append(f"{self.name}_count{labels} {cumulative}")
+        return lines
+
+
+HANDLER_DURATION = Histogram(
+    "shift_handler_duration_seconds", "Duration of the command, callback and input handlers", ("kind", "handler"),
+)
+OUTBOUND_DURATION = Histogram(
+    "shift_outbound_request_duration_seconds", "Duration of the Bot API requests, flood waits excluded", ("method",),
+)
+OUTBOUND_ERRORS = Counter(
+    "shift_outbound_errors_total", "Failed Bot API requests", ("method", "error"),
+)
+OUTBOUND_GRANTED = Counter(
+    "shift_outbound_granted_total", "Flood limited requests granted by the outbound scheduler", ("priority",),
+)
+OUTBOUND_WAITING = Gauge(
+    "shift_outbound_waiting", "Flood limited requests waiting for an outbound scheduler slot", (),
+)
+OUTBOUND_FLOOD_WAITS = Counter(
+    "shift_outbound_flood_waits_total", "Flood errors pausing the outbound scheduler", (),
+)
+REMINDER_DELAY = Histogram(
+    "shift_reminder_delay_seconds", "Delay of the reminder slot jobs from their scheduled instant", (),
+    buckets=DELAY_BUCKETS,
+)
+PERSISTENCE_FLUSH_DURATION = Histogram(
+    "shift_persistence_flush_duration_seconds", "Duration of the persistence writes", ("backend",),
+)
+SHIFTS_LOAD_DURATION = Histogram(
+    "shift_shifts_load_duration_seconds", "Duration of the shifts loads and reloads", ("kind",),
+)
+
+metrics = [
+    HANDLER_DURATION,
+    OUTBOUND_DURATION,
+    OUTBOUND_ERRORS,
+    OUTBOUND_GRANTED,
+    OUTBOUND_WAITING,
+    OUTBOUND_FLOOD_WAITS,
+    REMINDER_DELAY,
+    PERSISTENCE_FLUSH_DURATION,
+    SHIFTS_LOAD_DURATION,
+]
+
+# Cache name -> function returning the LRU cache (None when the cache doesn't exist)
+caches = dict()
+
+
+def register_cache(name: str, get_cache):
+    """
+    Expose the statistics of an LRU cache
+    :param name: cache name
+    :param get_cache: function returning the cache, called on every scrape since the cache may be replaced
+    """
+    caches[name] = get_cache
+
+
+def render_caches():
+    """
+    Render the statistics of the registered caches
+    :return: list of lines
+    """
+    stats = dict()
+    for name, get_cache in sorted(caches.items()):
+        cache = get_cache()
+        if cache is not None:
+            stats[name] = cache.stats()
+
+    lines = []
+    for metric, kind, description, value in (
+            ("shift_cache_hits_total", "counter", "Cache hits", lambda s: s["hits"]),
+            ("shift_cache_misses_total", "counter", "Cache misses", lambda s: s["misses"]),
+            ("shift_cache_hit_ratio", "gauge", "Cache hits over lookups",
+             lambda s: s["hits"] / (s["hits"] + s["misses"]) if s["hits"] + s["misses"] else 0.0),
+            ("shift_cache_size", "gauge", "Cached entries", lambda s: s["size"]),
+    ):
+        lines.extend((f"# HELP {metric} {description}", f"# TYPE {metric} {kind}"))
+        lines.extend(
+            f"{metric}{format_labels(('cache',), (name,))} {format_value(value(cache_stats))}"
+            for name, cache_stats in stats.items()
+        )
+
+    return lines
+
+
+def render():
+    """
+    Render all the metrics in the Prometheus text format
+    :return: the metrics text
+    """
+    lines = []
+    for metric in metrics:
+        lines.extend(metric.render())
+    lines.extend(render_caches())
+
+    return "\n".join(lines) + "\n"
+
+
+class MetricsRequestHandler(BackgroundRequestHandler):
+    """
+    Metrics request handler, serving the metrics on GET /metrics
+    """
+
+    def do_GET(self):
+        """
+        Serve the metrics
+        """
+        if self.path.partition("?")[0] != METRICS_PATH:
+            self.send_response_only(HTTPStatus.NOT_FOUND)
+            self.end_headers()
+            return
+
+        body = render().encode()
+        self.send_response(HTTPStatus.OK)
+        self.send_header("Content-Type", CONTENT_TYPE)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+
+class MetricsServer(BackgroundHTTPServer):
+    """
+    Metrics HTTP listener
+    """
+
+    name = "metrics"
+    logger = logger
+
+    def __init__(self, host: str, port: int):
+        """
+        Init method
+        :param host: listen host
+        :param port: listen port (0 to pick a free port)
+        """
+        super().__init__(host, port, MetricsRequestHandler)
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        super().start()
+
+        logger.info("Metrics listening on %s:%s%s", *self.server_address[:2], METRICS_PATH)
+
+
+def start_metrics_server(host: str, port: int):
+    """
+    Start the metrics endpoint
+    :param host: listen host
+    :param port: listen port
+    :return: the metrics server
+    """
+    server = MetricsServer(host, port)
+    server.start()
+
+    return server
@@ -2,18 +2,26 @@
 
 import logging
 import re
-from datetime import datetime
 from typing import Tuple
 
-from dateutil import tz
 from telegram import Update
-from telegram.ext import CallbackContext, CallbackQueryHandler
+from telegram.ext import CallbackContext
 from telegram.ext.updater import Updater
 
 from . import shiftsheduling
+from . import timezones
 from .constants import *
 from .datehelper import DAYS_OF_WEEK
-from .helpers import callback, callback_pattern, logged_user, make_keyboard
+from .helpers import (
+    callback,
+    callback_action,
+    get_index_store,
+    iter_user_data,
+    logged_user,
+    make_keyboard,
+    timed,
+)
+from .reminders import SLOT_KEY_PREFIX, ReminderEngine
 from .shiftsheduling import ShiftType
 
 (
@@ -37,16 +45,18 @@ from .shiftsheduling import ShiftType
 SHIFT_REMINDERS = "shift_reminders"
 TMP_NOTIFICATION = "tmp_notification"
 
+# Schedule index version in bot_data: a different version rebuilds the index from the user data
+REMINDER_INDEX_VERSION = "reminder_index_version"
+REMINDER_INDEX_CURRENT_VERSION = 3
+
 KIND_NOTIFICATION_INDEX = "notification_index"
 KIND_NOTIFICATION_TIME = "notification_time"
 
-SHIFT_TYPE, WHEN_DAYS, WHEN_TIME = "shift_type", "when_days", "when_time"
-
-BOT_TAG, USER_ID_TAG, USER_DATA_TAG, SCHEDULE_DATA_TAG = "bot", "user_id", "user_data", "schedule_data"
+SHIFT_TYPE, WHEN_DAYS, WHEN_TIME, WHEN_TIMEZONE = "shift_type", "when_days", "when_time", "when_timezone"
 
 logger = logging.getLogger(__name__)
 
-notification_jobs = dict()
+reminder_engine: ReminderEngine = None
 
 
 @logged_user
@@ -63,7 +73,7 @@ def main_menu(update: Update, context: CallbackContext):
         buttons.append(("Rimuovi 🔕", NOTIFICATION_REMOVE_CALLBACK))
 
     buttons.append(("Aggiungi 🔔", NOTIFICATION_ADD_CALLBACK))
-    keyboard = make_keyboard([buttons], context)
+    keyboard = make_keyboard([buttons], update.effective_user.id)
 
     message = "Attraverso le notifiche ti posso avvertire sui turni che dovrai effettuare 🚨"
 
@@ -121,7 +131,7 @@ def remove_callback(update: Update, context: CallbackContext):
 
         message += f"{i + 1}: {shift_type} alle ore {when_time} nei giorni {when_days}\n"
 
-    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), context)
+    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), update.effective_user.id)
     update.callback_query.edit_message_text(
         text=message,
         reply_markup=keyboard
@@ -130,6 +140,7 @@ def remove_callback(update: Update, context: CallbackContext):
     context.user_data[INPUT_KIND] = KIND_NOTIFICATION_INDEX
 
 
+@timed("input")
 def remove_action(update: Update, context: CallbackContext):
     """
     Manage remove action.
@@ -154,12 +165,14 @@ def remove_action(update: Update, context: CallbackContext):
         )
         return
 
-    notification_jobs[
-        (update.effective_user.id, notification_key(shift_reminders[index]))
-    ].schedule_removal()
-    context.user_data[SHIFT_REMINDERS].remove(shift_reminders[index])
+    schedule_data = shift_reminders[index]
+    shift_reminders.remove(schedule_data)
 
-    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), context)
+    # Keep the reminder scheduled if user has another identical reminder
+    if not any(notification_key(reminder) == notification_key(schedule_data) for reminder in shift_reminders):
+        remove_reminder(update.effective_user.id, schedule_data)
+
+    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), update.effective_user.id)
     update.message.reply_text(
         text="Notifica rimossa! ✅",
         reply_markup=keyboard
@@ -187,7 +200,7 @@ def add_callback(update: Update, context: CallbackContext):
         "Scegli il tipo di notifica da aggiungere 📢 \n"
         "Attenzione ⚠ La notifica verrà mandata solo se il giorno successivo sarai in Smart o Ufficio, a seconda del "
         "tipo selezionato",
-        reply_markup=make_keyboard([buttons], context),
+        reply_markup=make_keyboard([buttons], update.effective_user.id),
     )
 
 
@@ -199,11 +212,14 @@ def choose_days(update: Update, context: CallbackContext):
     :param update: update
     :param context: context
     """
-    tmp_notification = context.user_data[TMP_NOTIFICATION]
+    tmp_notification = context.user_data.get(TMP_NOTIFICATION)
+    if tmp_notification is None:
+        notification_expired(update, context)
+        return
 
     current = None
 
-    callback_data = update.callback_query.data[: update.callback_query.data.index("#")]
+    callback_data = callback_action(update)
     if callback_data == REMIND_SMART_CALLBACK:
         tmp_notification[SHIFT_TYPE] = ShiftType.SMART_WORKING.value
         tmp_notification[WHEN_TIME] = "19:00"
@@ -239,163 +255,223 @@ def choose_days(update: Update, context: CallbackContext):
     ]
     update.callback_query.edit_message_text(
         text=message,
-        reply_markup=make_keyboard(buttons, context)
+        reply_markup=make_keyboard(buttons, update.effective_user.id)
     )
 
 
-def choose_time_wrapper(shift_reminder_callback):
+@callback
+def choose_time(update: Update, context: CallbackContext):
     """
-    Choose time wrapper
-    :param shift_reminder_callback: shift reminder callback
-    :return: wrapper
+    Choose time
+    :param update: update
+    :param context: context
     """
+    tmp_notification = context.user_data.get(TMP_NOTIFICATION)
+    if tmp_notification is None:
+        notification_expired(update, context)
+        return
 
-    @callback
-    def choose_time(update: Update, context: CallbackContext):
-        """
-        Choose time
-        :param update: update
-        :param context: context
-        """
-        keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), context)
+    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), update.effective_user.id)
 
-        if update.callback_query:
-            message = "Inserisci l'orario in cui inviare la notifica, nel formato HH:MM 🕐"
-            update.callback_query.edit_message_text(
-                text=message,
-                reply_markup=keyboard
-            )
+    if update.callback_query:
+        message = "Inserisci l'orario in cui inviare la notifica, nel formato HH:MM 🕐"
+        update.callback_query.edit_message_text(
+            text=message,
+            reply_markup=keyboard
+        )
+
+        context.user_data[INPUT_KIND] = KIND_NOTIFICATION_TIME
+        return
+
+    input_time = update.message.text.strip()
+    if re.match(r"^(0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]$", input_time):
+        tmp_notification[WHEN_TIME] = input_time
+        tmp_notification[WHEN_TIMEZONE] = timezones.user_timezone(context.user_data)
+
+        user_id = update.effective_user.id
+        schedule_data = tmp_notification
+        del context.user_data[TMP_NOTIFICATION]
+
+        reminders = context.user_data.get(SHIFT_REMINDERS) or []
+        reminders.append(schedule_data)
+        context.user_data[SHIFT_REMINDERS] = reminders
+
+        if len(schedule_data[WHEN_DAYS]) > 0:
+            add_reminder(user_id, schedule_data)
 
-            context.user_data[INPUT_KIND] = KIND_NOTIFICATION_TIME
-            return
-
-        input_time = update.message.text.strip()
-        if re.match(r"^(0[0-9]|1[0-9]|2[0-3]):[0-5][0-9]$", input_time):
-            context.user_data[TMP_NOTIFICATION][WHEN_TIME] = input_time
-
-            user_id = update.effective_user.id
-            schedule_data = context.user_data[TMP_NOTIFICATION]
-            del context.user_data[TMP_NOTIFICATION]
-
-            reminders = context.user_data.get(SHIFT_REMINDERS) or []
-            reminders.append(schedule_data)
-            context.user_data[SHIFT_REMINDERS] = reminders
-
-            if len(schedule_data[WHEN_DAYS]) > 0:
-                job = context.job_queue.run_daily(
-                    shift_reminder_callback,
-                    time=job_time(schedule_data[WHEN_TIME]),
-                    days=schedule_data[WHEN_DAYS],
-                    context={
-                        BOT_TAG: context.bot,
-                        USER_ID_TAG: user_id,
-                        USER_DATA_TAG: context.user_data,
-                        SCHEDULE_DATA_TAG: schedule_data,
-                    },
-                )
-
-                logger.info(
-                    "Added reminder for user %s (%s): %s",
-                    user_id,
-                    update.effective_user.first_name,
-                    schedule_data,
-                )
-                notification_jobs[(user_id, notification_key(schedule_data))] = job
-
-                message = "Notifica aggiunta! ✅"
-            else:
-                message = "È necessario selezionare almeno un giorno ⚠"
-
-            update.message.reply_text(
-                text=message,
-                reply_markup=keyboard
+            logger.info(
+                "Added reminder for user %s (%s): %s",
+                user_id,
+                update.effective_user.first_name,
+                schedule_data,
             )
 
-            context.user_data[INPUT_KIND] = None
-            return
+            message = "Notifica aggiunta! ✅"
+        else:
+            message = "È necessario selezionare almeno un giorno ⚠"
 
-        message = "L'orario deve essere nel formato HH:MM ⚠️"
         update.message.reply_text(
             text=message,
             reply_markup=keyboard
         )
 
-    return choose_time
+        context.user_data[INPUT_KIND] = None
+        return
+
+    message = "L'orario deve essere nel formato HH:MM ⚠️"
+    update.message.reply_text(
+        text=message,
+        reply_markup=keyboard
+    )
 
 
-def setup_scheduler(updater: Updater, shift_reminder_callback):
+def notification_expired(update: Update, context: CallbackContext):
+    """
+    Answer a step of a notification setup already completed or never started (E.g. a button of an old message)
+    :param update: update
+    :param context: context
     """
-    Setup notification scheduler
+    keyboard = make_keyboard(("Indietro", NOTIFICATION_BACK_CALLBACK), update.effective_user.id)
+    message = "Sessione scaduta, riparti da /notifiche ⚠️"
+
+    if update.callback_query:
+        update.callback_query.edit_message_text(text=message, reply_markup=keyboard)
+    else:
+        update.message.reply_text(text=message, reply_markup=keyboard)
+
+    context.user_data[INPUT_KIND] = None
+
+
+def setup_scheduler(updater: Updater, shift_reminder_callback, store: dict = None):
+    """
+    Setup notification scheduler.
+    Reminders are loaded from the schedule index, rebuilt from the user data only when the index is missing or has an
+    old version. The index is persisted in bot_data only with SQLitePersistence (see get_index_store), with the other
+    persistences it's rebuilt at every start. Slot jobs are armed by a job, so they don't delay the bot start
     :param updater: updater
-    :param shift_reminder_callback: shift reminder callback
-    """
-    for user_id, user_values in updater.dispatcher.user_data.items():
-        if SHIFT_REMINDERS in user_values:
-            for schedule_data in user_values[SHIFT_REMINDERS]:
-                # Discard invalid notification (Prevent internal exception)
-                if len(schedule_data[WHEN_DAYS]) > 0:
-                    job = updater.job_queue.run_daily(
-                        shift_reminder_callback,
-                        time=job_time(schedule_data[WHEN_TIME]),
-                        days=schedule_data[WHEN_DAYS],
-                        context={
-                            BOT_TAG: updater.bot,
-                            USER_ID_TAG: user_id,
-                            USER_DATA_TAG: user_values,
-                            SCHEDULE_DATA_TAG: schedule_data,
-                        },
-                    )
-
-                    logger.info("Setup reminder for user %s: %s", user_id, schedule_data)
-
-                    notification_jobs[(user_id, notification_key(schedule_data))] = job
-
-
-def handlers(shift_reminder_callback):
-    """
-    Define the notifications handlers
-    :param shift_reminder_callback: shift reminder callback
-    :return: notifications handlers
-    """
-    choose_time_handler = choose_time_wrapper(shift_reminder_callback)
-
-    return [
-        CallbackQueryHandler(
-            exit_callback, pattern=callback_pattern(NOTIFICATION_EXIT_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            back_callback, pattern=callback_pattern(NOTIFICATION_BACK_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            remove_callback, pattern=callback_pattern(NOTIFICATION_REMOVE_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            add_callback, pattern=callback_pattern(NOTIFICATION_ADD_CALLBACK)
-        ),
-        CallbackQueryHandler(
-            choose_days,
-            pattern=callback_pattern(
-                f'({REMIND_SMART_CALLBACK}|{REMIND_OFFICE_CALLBACK}|{"|".join(DAYS_OF_WEEK.values())})'
-            ),
-        ),
-        CallbackQueryHandler(
-            choose_time_handler, pattern=callback_pattern(CHOOSE_TIME_CALLBACK)
-        ),
-    ]
+    :param shift_reminder_callback: shift reminder callback, called with (bot, reminders) for every fired slot
+    :param store: mapping where the index is stored (by default the one of the persistence)
+    """
+    global reminder_engine
+
+    if store is None:
+        store = get_index_store(updater.dispatcher, SLOT_KEY_PREFIX, REMINDER_INDEX_VERSION)
+    reminder_engine = ReminderEngine(
+        updater.job_queue,
+        updater.dispatcher.user_data,
+        shift_reminder_callback,
+        timezones.next_weekly_time,
+        store,
+        get_reminder_spread(),
+    )
+
+    if store.get(REMINDER_INDEX_VERSION) == REMINDER_INDEX_CURRENT_VERSION:
+        reminders = reminder_engine.load()
+        logger.info("Loaded %s reminders in %s slots from the schedule index", reminders, len(reminder_engine))
+    else:
+        reminder_engine.clear()
+
+        reminders = 0
+        for user_id, user_values in iter_user_data(updater.dispatcher):
+            if SHIFT_REMINDERS in user_values:
+                for schedule_data in user_values[SHIFT_REMINDERS]:
+                    # Discard invalid notification (Prevent internal exception)
+                    if len(schedule_data[WHEN_DAYS]) > 0:
+                        add_reminder(user_id, schedule_data)
+                        reminders += 1
+
+        store[REMINDER_INDEX_VERSION] = REMINDER_INDEX_CURRENT_VERSION
+        logger.info("Rebuilt the schedule index with %s reminders in %s slots", reminders, len(reminder_engine))
 
+    updater.job_queue.run_once(reminder_engine.arm, 0, name="arm reminders")
 
-def user_input_handlers(shift_reminder_callback):
+
+def add_reminder(user_id: int, schedule_data: dict):
     """
-    User input handlers
-    :param shift_reminder_callback: shift reminder callback
-    :return: the user input handlers
+    Add the reminder to the reminder engine
+    :param user_id: user id
+    :param schedule_data: schedule data
     """
-    choose_time_handler = choose_time_wrapper(shift_reminder_callback)
+    reminder_engine.add(
+        user_id,
+        notification_key(schedule_data),
+        schedule_data,
+        schedule_data[WHEN_DAYS],
+        schedule_data[WHEN_TIME],
+        reminder_timezone(schedule_data),
+    )
 
-    return [
-        (KIND_NOTIFICATION_TIME, choose_time_handler),
-        (KIND_NOTIFICATION_INDEX, remove_action),
-    ]
+
+def remove_reminder(user_id: int, schedule_data: dict):
+    """
+    Remove the reminder from the reminder engine
+    :param user_id: user id
+    :param schedule_data: schedule data
+    """
+    reminder_engine.remove(
+        user_id,
+        notification_key(schedule_data),
+        schedule_data[WHEN_DAYS],
+        schedule_data[WHEN_TIME],
+        reminder_timezone(schedule_data),
+    )
+
+
+def set_reminders_timezone(user_id: int, user_data: dict, timezone: str):
+    """
+    Move all the reminders of the user to the given timezone, keeping their local time
+    :param user_id: user id
+    :param user_data: user data
+    :param timezone: timezone name
+    """
+    for schedule_data in user_data.get(SHIFT_REMINDERS) or []:
+        active = len(schedule_data[WHEN_DAYS]) > 0
+        if active:
+            remove_reminder(user_id, schedule_data)
+
+        schedule_data[WHEN_TIMEZONE] = timezone
+
+        if active:
+            add_reminder(user_id, schedule_data)
+
+
+def reminder_timezone(schedule_data: dict):
+    """
+    Gets the timezone of the reminder
+    :param schedule_data: schedule data
+    :return: the timezone name (default timezone for reminders created before per user timezones)
+    """
+    return schedule_data.get(WHEN_TIMEZONE) or get_default_timezone()
+
+
+def callback_routes():
+    """
+    Define the notifications callback routes
+    :return: dict of callback action -> callback
+    """
+    routes = {
+        NOTIFICATION_EXIT_CALLBACK: exit_callback,
+        NOTIFICATION_BACK_CALLBACK: back_callback,
+        NOTIFICATION_REMOVE_CALLBACK: remove_callback,
+        NOTIFICATION_ADD_CALLBACK: add_callback,
+        REMIND_SMART_CALLBACK: choose_days,
+        REMIND_OFFICE_CALLBACK: choose_days,
+        CHOOSE_TIME_CALLBACK: choose_time,
+    }
+    routes.update(dict.fromkeys(DAYS_OF_WEEK.values(), choose_days))
+
+    return routes
+
+
+def user_input_handlers():
+    """
+    User input handlers
+    :return: dict of input kind -> handler
+    """
+    return {
+        KIND_NOTIFICATION_TIME: choose_time,
+        KIND_NOTIFICATION_INDEX: remove_action,
+    }
 
 
 def notification_key(notification: dict) -> Tuple:
@@ -408,16 +484,5 @@ def notification_key(notification: dict) -> Tuple:
         notification[SHIFT_TYPE],
         ",".join([str(d) for d in notification[WHEN_DAYS]]),
         notification[WHEN_TIME],
-    )
-
-
-def job_time(time):
-    """
-    Manage the time user input, and return the UTF corresponding time
-    :param time: user time
-    :return: normalized time
-    """
-    return (
-        datetime.strptime(datetime.now().strftime("%Y-%m-%d") + " " + time, "%Y-%m-%d %H:%M").replace(
-            tzinfo=tz.gettz("Europe/Rome")).astimezone(tz.gettz("UTC")).time()
+        reminder_timezone(notification),
     )
@@ -0,0 +1,237 @@
+"""Outbound requests scheduler module."""
+
+import contextlib
+import heapq
+import itertools
+import logging
+import random
+import threading
+import time
+
+from telegram.error import RetryAfter, TelegramError
+from telegram.ext import ExtBot
+from telegram.utils.request import Request
+
+from . import metrics
+from .lrucache import LRUCache
+from .ratelimit import TokenBucket
+
+# Priority classes, lower values are served first
+INTERACTIVE, REMINDER, BULK = 0, 1, 2
+PRIORITY_NAMES = {INTERACTIVE: "interactive", REMINDER: "reminder", BULK: "bulk"}
+
+# Bot API methods subject to flood limits
+RATE_LIMITED_PREFIXES = ("send", "edit", "copy", "forward")
+# Bot API methods not timed, their duration is the long polling timeout
+UNTIMED_METHODS = ("getUpdates",)
+
+MAX_RETRY_ATTEMPTS = 3
+CHAT_BUCKETS_SIZE = 10000
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+def current_priority():
+    """
+    Gets the priority of the requests of the current thread
+    :return: the priority (INTERACTIVE if not set)
+    """
+    return getattr(_local, "priority", INTERACTIVE)
+
+
+@contextlib.contextmanager
+def priority(level: int):
+    """
+    Context manager setting the priority of the requests made by the current thread
+    :param level: priority (INTERACTIVE, REMINDER or BULK)
+    """
+    previous = current_priority()
+    _local.priority = level
+    try:
+        yield
+    finally:
+        _local.priority = previous
+
+
+class OutboundScheduler:
+    """
+    Outbound requests scheduler.
+    Every request first waits the rate limit of its chat, then it's queued for a global slot: slots are granted at
+    the global rate, to the waiting request with the highest priority (FIFO within the same priority).
+    A flood error pauses all the requests for the given time.
+    Granted requests, waiting requests and flood errors are exposed in the metrics
+    """
+
+    def __init__(self, rate: float, chat_rate: float, chat_burst: float, jitter: float):
+        """
+        Init method
+        :param rate: max requests per second
+        :param chat_rate: max requests per second for a single chat
+        :param chat_burst: max burst of requests for a single chat
+        :param jitter: max random delay added to the flood waits, so waiting requests don't retry together
+        """
+        self.interval = 1 / rate
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.jitter = jitter
+        self.chat_buckets = LRUCache(CHAT_BUCKETS_SIZE)
+        self.waiting = []
+        self.counter = itertools.count()
+        self.next_slot = 0
+        self.paused_until = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, chat_id=None, level: int = None):
+        """
+        Wait until the request can be sent
+        :param chat_id: chat of the request (None if the request isn't related to a chat)
+        :param level: priority (current thread priority if not filled)
+        """
+        if level is None:
+            level = current_priority()
+
+        if chat_id is not None:
+            self._chat_bucket(chat_id).acquire()
+
+        entry = (level, next(self.counter))
+        with self._condition:
+            heapq.heappush(self.waiting, entry)
+            metrics.OUTBOUND_WAITING.set(len(self.waiting))
+            try:
+                while True:
+                    if self.waiting[0] != entry:
+                        self._condition.wait()
+                        continue
+
+                    now = time.monotonic()
+                    wait = max(self.next_slot, self.paused_until) - now
+                    if wait <= 0:
+                        break
+                    self._condition.wait(wait)
+
+                self.next_slot = max(now, self.next_slot) + self.interval
+                metrics.OUTBOUND_GRANTED.inc(PRIORITY_NAMES[level])
+            finally:
+                self.waiting.remove(entry)
+                heapq.heapify(self.waiting)
+                metrics.OUTBOUND_WAITING.set(len(self.waiting))
+                self._condition.notify_all()
+
+    def pause(self, seconds: float):
+        """
+        Pause all the requests after a flood error
+        :param seconds: pause duration
+        :return: the wait of the caller (pause plus jitter)
+        """
+        metrics.OUTBOUND_FLOOD_WAITS.inc()
+        with self._condition:
+            self.paused_until = max(self.paused_until, time.monotonic() + seconds)
+            self._condition.notify_all()
+
+        return seconds + random.uniform(0, self.jitter)
+
+    def _chat_bucket(self, chat_id) -> TokenBucket:
+        """
+        Gets the rate limiter of the chat
+        :param chat_id: chat id
+        :return: the chat token bucket
+        """
+        bucket = self.chat_buckets.get(chat_id)
+        if bucket is None:
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self.chat_buckets.put(chat_id, bucket)
+
+        return bucket
+
+
+class ScheduledBot(ExtBot):
+    """
+    Bot sending all the flood limited requests through the outbound scheduler, retrying them after flood errors
+    """
+
+    def __init__(self, *args, scheduler: OutboundScheduler, **kwargs):
+        """
+        Init method
+        :param args: ExtBot args
+        :param scheduler: outbound scheduler
+        :param kwargs: ExtBot kwargs
+        """
+        super().__init__(*args, **kwargs)
+        self.scheduler = scheduler
+
+    def _post(self, endpoint: str, data: dict = None, *args, **kwargs):
+        """
+        Post the request, waiting the scheduler for flood limited methods
+        :param endpoint: Bot API method
+        :param data: request data
+        :param args: other args
+        :param kwargs: other kwargs
+        :return: the result
+        """
+        if not endpoint.startswith(RATE_LIMITED_PREFIXES):
+            return self._timed_post(endpoint, data, *args, **kwargs)
+
+        chat_id = data.get("chat_id") if data else None
+
+        for attempt in range(1, MAX_RETRY_ATTEMPTS + 1):
+            self.scheduler.acquire(chat_id)
+            try:
+                return self._timed_post(endpoint, data, *args, **kwargs)
+            except RetryAfter as e:
+                wait = self.scheduler.pause(e.retry_after)
+                if attempt == MAX_RETRY_ATTEMPTS:
+                    raise
+
+                logger.warning("Flood limit reached on %s, retrying in %.1fs", endpoint, wait)
+                time.sleep(wait)
+
+    def _timed_post(self, endpoint: str, data: dict = None, *args, **kwargs):
+        """
+        Post the request, recording its duration and errors in the metrics
+        :param endpoint: Bot API method
+        :param data: request data
+        :param args: other args
+        :param kwargs: other kwargs
+        :return: the result
+        """
+        if endpoint in UNTIMED_METHODS:
+            return super()._post(endpoint, data, *args, **kwargs)
+
+        start = time.perf_counter()
+        try:
+            return super()._post(endpoint, data, *args, **kwargs)
+        except TelegramError as e:
+            metrics.OUTBOUND_ERRORS.inc(endpoint, type(e).__name__)
+            raise
+        finally:
+            metrics.OUTBOUND_DURATION.observe(time.perf_counter() - start, endpoint)
+
+
+def create_bot(
+    token: str,
+    con_pool_size: int,
+    rate: float,
+    chat_rate: float,
+    chat_burst: float,
+    jitter: float,
+    base_url: str = None,
+):
+    """
+    Create the bot
+    :param token: bot token
+    :param con_pool_size: connection pool size
+    :param rate: max requests per second
+    :param chat_rate: max requests per second for a single chat
+    :param chat_burst: max burst of requests for a single chat
+    :param jitter: max random delay added to the flood waits
+    :param base_url: Bot API base URL (Telegram servers if not filled)
+    :return: the bot
+    """
+    return ScheduledBot(
+        token,
+        base_url=base_url,
+        request=Request(con_pool_size=con_pool_size),
+        scheduler=OutboundScheduler(rate, chat_rate, chat_burst, jitter),
+    )
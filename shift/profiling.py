@@ -0,0 +1,255 @@
+"""On-demand profiling module."""
+
+import contextlib
+import cProfile
+import functools
+import logging
+import os
+import pstats
+import threading
+import time
+import tracemalloc
+
+PROFILES_DIRNAME = "profiles"
+TRACEMALLOC_FRAMES = 1
+# Allocations of the tracing and of the collected profiles aren't reported
+TRACEMALLOC_FILTERS = (
+    tracemalloc.Filter(False, tracemalloc.__file__),
+    tracemalloc.Filter(False, cProfile.__file__),
+    tracemalloc.Filter(False, pstats.__file__),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap>"),
+    tracemalloc.Filter(False, "<frozen importlib._bootstrap_external>"),
+)
+
+logger = logging.getLogger(__name__)
+
+session = None
+_session_lock = threading.Lock()
+_local = threading.local()
+
+
+class ProfilingSession:
+    """
+    Profiling session.
+    Every profiled call (command, callback or job) runs under its own cProfile profiler, so the profile is attributed
+    to the call even when updates are processed concurrently, and the result is merged in the stats of its label.
+    Allocations are traced with tracemalloc for the whole session
+    """
+
+    def __init__(self, output_dir: str, top: int):
+        """
+        Init method
+        :param output_dir: directory of the session dumps
+        :param top: number of entries of the summary lists
+        """
+        self.output_dir = output_dir
+        self.top = top
+        self.stats = dict()
+        self.timings = dict()
+        self.skipped = 0
+        self.start = time.monotonic()
+        self._lock = threading.Lock()
+
+        # Tracing started by someone else (E.g. PYTHONTRACEMALLOC) is left running at the end of the session
+        self._stop_tracing = not tracemalloc.is_tracing()
+        if self._stop_tracing:
+            tracemalloc.start(TRACEMALLOC_FRAMES)
+        self._snapshot = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+
+    @contextlib.contextmanager
+    def profile(self, label: str):
+        """
+        Context manager profiling its block
+        :param label: label of the profiled call (E.g. "command shift_command")
+        """
+        profiler = cProfile.Profile()
+        try:
+            profiler.enable()
+        except ValueError:
+            # Another profiler is already active (Python 3.12+ allows a single one for all the threads)
+            with self._lock:
+                self.skipped += 1
+            yield
+            return
+
+        _local.profiling = True
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            profiler.disable()
+            elapsed = time.perf_counter() - start
+            _local.profiling = False
+
+            with self._lock:
+                if label in self.stats:
+                    self.stats[label].add(profiler)
+                else:
+                    self.stats[label] = pstats.Stats(profiler)
+                calls, total = self.timings.get(label, (0, 0.0))
+                self.timings[label] = (calls + 1, total + elapsed)
+
+    def finish(self):
+        """
+        Stop the allocations tracing and write the dumps: a .prof file for every label (readable with pstats or
+        snakeviz), the tracemalloc snapshot and the summary
+        :return: the summary
+        """
+        snapshot = tracemalloc.take_snapshot().filter_traces(TRACEMALLOC_FILTERS)
+        if self._stop_tracing:
+            tracemalloc.stop()
+
+        directory = os.path.join(self.output_dir, time.strftime("%Y%m%d-%H%M%S"))
+        os.makedirs(directory, exist_ok=True)
+
+        with self._lock:
+            stats = dict(self.stats)
+            timings = dict(self.timings)
+            skipped = self.skipped
+
+        for label, label_stats in stats.items():
+            label_stats.dump_stats(os.path.join(directory, label.replace(" ", ".") + ".prof"))
+        snapshot.dump(os.path.join(directory, "tracemalloc.snapshot"))
+
+        summary = self.summary(stats, timings, skipped, snapshot.compare_to(self._snapshot, "lineno"), directory)
+        with open(os.path.join(directory, "summary.txt"), "w", encoding="utf-8") as f:
+            f.write(summary + "\n")
+
+        logger.info("Profiling session dumped in %s", directory)
+        return summary
+
+    def summary(self, stats: dict, timings: dict, skipped: int, allocations: list, directory: str):
+        """
+        Build the session summary: profiled calls by total time, functions by own time and allocations grown since
+        the session start
+        :param stats: dict of label -> stats
+        :param timings: dict of label -> (calls, total seconds)
+        :param skipped: calls not profiled
+        :param allocations: tracemalloc statistic diffs
+        :param directory: dumps directory
+        :return: the summary
+        """
+        lines = [f"🔬 Profilazione di {time.monotonic() - self.start:.0f}s completata"]
+
+        if not timings:
+            lines.append("\nNessun comando o job eseguito durante la profilazione")
+        else:
+            lines.append("\nChiamate (numero, tempo totale, tempo medio):")
+            for label, (calls, total) in sorted(timings.items(), key=lambda item: -item[1][1])[:self.top]:
+                lines.append(f"• {label}: {calls}, {total:.3f}s, {total / calls * 1000:.1f}ms")
+
+            merged = pstats.Stats()
+            merged.add(*stats.values()).sort_stats(pstats.SortKey.TIME)
+            lines.append("\nFunzioni con più tempo proprio:")
+            for function in merged.fcn_list[:self.top]:
+                _, calls, own_time, _, _ = merged.stats[function]
+                lines.append(f"• {format_function(function)}: {own_time:.3f}s, {calls} chiamate")
+
+        if skipped:
+            lines.append(f"\n{skipped} chiamate non profilate (profiler già attivo)")
+
+        grown = [allocation for allocation in allocations if allocation.size_diff > 0][:self.top]
+        if grown:
+            lines.append("\nAllocazioni cresciute dall'avvio:")
+            for allocation in grown:
+                frame = allocation.traceback[0]
+                lines.append(
+                    f"• {os.path.basename(frame.filename)}:{frame.lineno}: "
+                    f"+{allocation.size_diff / 1024:.1f} KiB ({allocation.count_diff:+d} blocchi)"
+                )
+
+        lines.append(f"\nDump salvati in {directory}")
+        return "\n".join(lines)
+
+
+def format_function(function: tuple) -> str:
+    """
+    Format a pstats function key
+    :param function: tuple of (file, line, function name)
+    :return: the formatted function
+    """
+    filename, line, name = function
+    if filename == "~":
+        # Built-in function
+        return name
+
+    return f"{os.path.basename(filename)}:{line}({name})"
+
+
+def start(output_dir: str, top: int):
+    """
+    Start a profiling session
+    :param output_dir: directory of the session dumps
+    :param top: number of entries of the summary lists
+    :return: True if session is started, False if another session is running
+    """
+    global session
+
+    with _session_lock:
+        if session is not None:
+            return False
+
+        session = ProfilingSession(output_dir, top)
+
+    logger.info("Profiling session started")
+    return True
+
+
+def stop():
+    """
+    Stop the running profiling session, writing its dumps
+    :return: the session summary, None if no session is running
+    """
+    global session
+
+    with _session_lock:
+        current, session = session, None
+
+    if current is None:
+        return None
+
+    return current.finish()
+
+
+def profile(kind: str, name: str):
+    """
+    Context manager profiling its block when a session is running.
+    Nested calls are profiled as part of the outermost one
+    :param kind: kind of the call (E.g. command, callback, job)
+    :param name: name of the call
+    :return: the context manager
+    """
+    current = session
+    if current is None or getattr(_local, "profiling", False):
+        return contextlib.nullcontext()
+
+    return current.profile(f"{kind} {name}")
+
+
+def profiled(kind: str):
+    """
+    Profile the decorated function when a session is running
+    :param kind: kind of the call (E.g. job)
+    :return: decorator
+    """
+
+    def decorator(func):
+        """
+        Decorator
+        :param func: func
+        :return: wrapper
+        """
+
+        @functools.wraps(func)
+        def wrapper(*args, **kwargs):
+            """
+            Profiled call
+            :param args: args
+            :param kwargs: kwargs
+            """
+            with profile(kind, func.__name__):
+                return func(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
@@ -0,0 +1,48 @@
+"""Rate limit module."""
+
+import threading
+import time
+
+
+class TokenBucket:
+    """
+    Thread safe token bucket rate limiter
+    """
+
+    def __init__(self, rate: float, capacity: float = None):
+        """
+        Init method
+        :param rate: tokens added per second
+        :param capacity: max tokens (rate if not filled)
+        """
+        self.rate = rate
+        self.capacity = capacity or rate
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        self._lock = threading.Lock()
+
+    def _refill(self, now: float):
+        """
+        Add the tokens accrued since last refill
+        :param now: current monotonic time
+        """
+        self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+        self._updated = now
+
+    def delay(self):
+        """
+        Take a token, reserving it in advance if bucket is empty
+        :return: seconds to wait before using the token
+        """
+        with self._lock:
+            self._refill(time.monotonic())
+            self._tokens -= 1
+            return 0 if self._tokens >= 0 else -self._tokens / self.rate
+
+    def acquire(self):
+        """
+        Take a token, waiting until it's available
+        """
+        wait = self.delay()
+        if wait > 0:
+            time.sleep(wait)
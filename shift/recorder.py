@@ -0,0 +1,179 @@
+"""Update recorder module."""
+
+import gzip
+import hashlib
+import hmac
+import json
+import logging
+import re
+import threading
+import time
+
+from telegram import Update
+from telegram.ext import CallbackContext
+
+from .helpers import CALLBACK_DATA_REGEX
+
+# User inputs kept as they are: group codes, HH:MM times, reminder indexes, timezone names
+SAFE_INPUT_REGEX = re.compile(r"^[\w:/+-]{1,32}$")
+# Digit runs long enough to be a user id (E.g. the user to approve in the registration message)
+ID_DIGITS_REGEX = re.compile(r"\d{5,}")
+# Personal fields of users and chats, dropped from the recorded updates
+PERSONAL_FIELDS = ("last_name", "username", "title", "phone_number", "bio", "description")
+ANONYMOUS_NAME = "anonymous"
+FLUSH_INTERVAL = 100
+
+logger = logging.getLogger(__name__)
+
+
+def pseudonym(value: int, key: bytes):
+    """
+    Gets the pseudonym of a user or chat id: a keyed hash with the same sign and number of digits, so the same id has
+    the same pseudonym in every update (and in the persistence remapped with the same key)
+    :param value: user or chat id
+    :param key: pseudonyms key
+    :return: the pseudonymous id
+    """
+    digits = len(str(abs(value)))
+    digest = int.from_bytes(hmac.new(key, str(value).encode(), hashlib.sha256).digest()[:8], "big")
+    low = 10 ** (digits - 1) if digits > 1 else 1
+    result = low + digest % (10 ** digits - low)
+
+    return -result if value < 0 else result
+
+
+def mask_text(text: str, key: bytes):
+    """
+    Mask a text keeping its UTF-16 length, so message entities stay valid: id digits are replaced with their
+    pseudonym, spaces and other digits are kept, every other character is replaced with x
+    :param text: text
+    :param key: pseudonyms key
+    :return: the masked text
+    """
+    masked = "".join(
+        char if char.isspace() or char.isdigit() else "x" * (2 if ord(char) > 0xFFFF else 1)
+        for char in text
+    )
+
+    return ID_DIGITS_REGEX.sub(lambda match: str(pseudonym(int(match.group(0)), key)), masked)
+
+
+def anonymise_text(text: str, key: bytes):
+    """
+    Anonymise a message text. Commands keep the command, the arguments are masked. Short single word inputs are kept,
+    so replayed inputs take the same paths, any other text is masked
+    :param text: text
+    :param key: pseudonyms key
+    :return: the anonymised text
+    """
+    if text.startswith("/"):
+        command, separator, arguments = text.partition(" ")
+        return command + separator + mask_text(arguments, key)
+
+    if SAFE_INPUT_REGEX.match(text) and not ID_DIGITS_REGEX.search(text):
+        return text
+
+    return mask_text(text, key)
+
+
+def anonymise(data, key: bytes):
+    """
+    Anonymise an update dict.
+    Users and chats (objects with an id and a first name or a type) get a pseudonymous id and lose the personal
+    fields, texts are anonymised and the signature of the callback data is dropped (replay signs it again for the
+    pseudonymous user)
+    :param data: update dict, or a part of it
+    :param key: pseudonyms key
+    :return: the anonymised data
+    """
+    if isinstance(data, list):
+        return [anonymise(item, key) for item in data]
+
+    if not isinstance(data, dict):
+        return data
+
+    result = dict()
+    is_user_or_chat = isinstance(data.get("id"), int) and ("first_name" in data or "type" in data)
+
+    for name, value in data.items():
+        if is_user_or_chat and name == "id":
+            result[name] = pseudonym(value, key)
+        elif is_user_or_chat and name in PERSONAL_FIELDS:
+            continue
+        elif is_user_or_chat and name == "first_name":
+            result[name] = ANONYMOUS_NAME
+        elif name in ("text", "caption") and isinstance(value, str):
+            result[name] = anonymise_text(value, key)
+        elif name == "data" and isinstance(value, str) and CALLBACK_DATA_REGEX.match(value):
+            result[name] = value.partition(".")[0]
+        else:
+            result[name] = anonymise(value, key)
+
+    return result
+
+
+class UpdateRecorder:
+    """
+    Record the incoming updates, anonymised, in a gzip compressed JSONL file.
+    Every line has the update and its time (seconds since the start of the recording)
+    """
+
+    def __init__(self, filename: str, key: bytes):
+        """
+        Init method
+        :param filename: recording file (appended if it exists)
+        :param key: pseudonyms key
+        """
+        self.filename = filename
+        self.key = key
+        self.start = time.monotonic()
+        self.recorded = 0
+        self._file = gzip.open(filename, "at", encoding="utf-8")
+        self._lock = threading.Lock()
+
+        logger.info("Recording updates in %s", filename)
+
+    def record(self, update: object, _: CallbackContext = None):
+        """
+        Record the update. Used as TypeHandler callback
+        :param update: update
+        :param _: context
+        """
+        if not isinstance(update, Update):
+            return
+
+        line = json.dumps({
+            "t": round(time.monotonic() - self.start, 3),
+            "update": anonymise(update.to_dict(), self.key),
+        }, ensure_ascii=False)
+
+        with self._lock:
+            if self._file.closed:
+                return
+
+            self._file.write(line + "\n")
+            self.recorded += 1
+            if self.recorded % FLUSH_INTERVAL == 0:
+                self._file.flush()
+
+    def close(self):
+        """
+        Flush and close the recording
+        """
+        with self._lock:
+            if not self._file.closed:
+                self._file.close()
+                logger.info("Recorded %s updates in %s", self.recorded, self.filename)
+
+
+def read_recording(filename: str):
+    """
+    Read a recording
+    :param filename: recording file
+    :return: iterator of (time, update dict)
+    """
+    with gzip.open(filename, "rt", encoding="utf-8") as f:
+        for line in f:
+            if line.strip():
+                entry = json.loads(line)
+                yield entry["t"], entry["update"]
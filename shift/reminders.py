@@ -0,0 +1,252 @@
+"""Reminder engine module."""
+
+import copy
+import datetime
+import logging
+import threading
+import time
+
+from telegram.ext import CallbackContext, JobQueue
+
+from . import metrics
+from .sqlitepersistence import pinned_user_data
+
+SLOT_KEY_PREFIX = "reminders "
+# Subscribers whose user data is pinned at once while their reminders are dispatched
+REMINDER_CHUNK_SIZE = 100
+
+logger = logging.getLogger(__name__)
+
+
+class ReminderEngine:
+    """
+    Time bucketed reminder engine.
+    Reminders are indexed by slot (local weekday, local HH:MM, timezone) and a single job is scheduled for the next
+    instant of every occupied slot. When the job fires, all the subscribers of the slot are notified and the job is
+    scheduled again for the next instant, computed with the timezone offset of that date. Large slots are notified in
+    chunks staggered over the spread window, so a popular time doesn't queue all its sends at once.
+    The index is kept in the store (E.g. bot_data) with a key for every slot, so it's persisted together with the
+    other data, and every change rewrites only the changed slot. Slot dicts are replaced, never mutated, and hold a
+    copy of the schedule data, so the persistence can serialise them while they're updated and can skip the slots
+    still bound to the object it last wrote (see SQLitePersistence replaced_key_prefixes)
+    """
+
+    def __init__(self, job_queue: JobQueue, user_data, reminder_callback, next_time, store: dict = None,
+                 spread: float = 0):
+        """
+        Init method
+        :param job_queue: job queue
+        :param user_data: mapping of user id -> user data
+        :param reminder_callback: callback called for every chunk of a fired slot with (bot, reminders), where
+        reminders is an iterable of (user_id, user_data, schedule_data), to be consumed once by the callback
+        :param next_time: function that returns the next UTC instant of (weekday, HH:MM, timezone)
+        :param store: mapping where the slots are stored (a new dict if not filled)
+        :param spread: seconds over which the chunks of a slot are staggered (0 to notify all the chunks at once)
+        """
+        self.job_queue = job_queue
+        self.user_data = user_data
+        self.reminder_callback = reminder_callback
+        self.next_time = next_time
+        self.store = dict() if store is None else store
+        self.spread = spread
+        self.slots = dict()
+        self.jobs = dict()
+        self.armed = False
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        """
+        Number of occupied slots
+        :return: number of occupied slots
+        """
+        return len(self.slots)
+
+    def load(self):
+        """
+        Load the slots of the store, without arming them
+        :return: number of loaded reminders
+        """
+        with self._lock:
+            self.slots = {
+                slot_of_key(key): subscribers
+                for key, subscribers in self.store.items()
+                if isinstance(key, str) and key.startswith(SLOT_KEY_PREFIX)
+            }
+
+            return sum(len(subscribers) for subscribers in self.slots.values())
+
+    def clear(self):
+        """
+        Remove all the slots from the store, also the ones of older index versions
+        """
+        with self._lock:
+            for key in [key for key in self.store if isinstance(key, str) and key.startswith(SLOT_KEY_PREFIX)]:
+                del self.store[key]
+            for job in self.jobs.values():
+                job.schedule_removal()
+
+            self.slots = dict()
+            self.jobs = dict()
+
+    def arm(self, _: CallbackContext = None):
+        """
+        Schedule the jobs of all the loaded slots. Usable as a job callback, so slots can be armed after the bot start
+        """
+        start = time.perf_counter()
+        with self._lock:
+            for slot in self.slots:
+                if slot not in self.jobs:
+                    self._arm(slot)
+            self.armed = True
+
+        logger.info("Armed %s reminder slots in %.3fs", len(self.jobs), time.perf_counter() - start)
+
+    def add(self, user_id: int, key, schedule_data: dict, days, when_time: str, timezone: str):
+        """
+        Add a reminder to the index, arming the slot job when slot was empty
+        :param user_id: user id
+        :param key: reminder key (unique for the user)
+        :param schedule_data: schedule data
+        :param days: local weekdays of the reminder
+        :param when_time: local time of the reminder in HH:MM format
+        :param timezone: timezone of the reminder
+        """
+        # Later changes of the user schedule data don't reach the stored slots
+        schedule_data = copy.deepcopy(schedule_data)
+        with self._lock:
+            for weekday in days:
+                slot = (weekday, when_time, timezone)
+                subscribers = dict(self.slots.get(slot, ()))
+                subscribers[(user_id, key)] = schedule_data
+                self._store_slot(slot, subscribers)
+
+                if self.armed and slot not in self.jobs:
+                    self._arm(slot)
+
+    def remove(self, user_id: int, key, days, when_time: str, timezone: str):
+        """
+        Remove a reminder from the index, removing the slot job when slot becomes empty
+        :param user_id: user id
+        :param key: reminder key (unique for the user)
+        :param days: local weekdays of the reminder
+        :param when_time: local time of the reminder in HH:MM format
+        :param timezone: timezone of the reminder
+        """
+        with self._lock:
+            for weekday in days:
+                slot = (weekday, when_time, timezone)
+                if (user_id, key) not in self.slots.get(slot, ()):
+                    continue
+
+                subscribers = dict(self.slots[slot])
+                del subscribers[(user_id, key)]
+                self._store_slot(slot, subscribers)
+
+                if not subscribers and slot in self.jobs:
+                    self.jobs.pop(slot).schedule_removal()
+
+    def _store_slot(self, slot, subscribers: dict):
+        """
+        Replace the subscribers of the slot, removing the slot when empty
+        :param slot: slot
+        :param subscribers: new subscribers
+        """
+        if subscribers:
+            self.slots[slot] = self.store[slot_key(slot)] = subscribers
+        else:
+            self.slots.pop(slot, None)
+            self.store.pop(slot_key(slot), None)
+
+    def _arm(self, slot, after: datetime.datetime = None):
+        """
+        Schedule the slot job at the next instant of the slot
+        :param slot: slot
+        :param after: UTC instant after which the job must run (now if not filled)
+        """
+        when = self.next_time(*slot, after)
+        self.jobs[slot] = self.job_queue.run_once(
+            self._fire,
+            when=when,
+            context=(slot, when),
+            name=slot_key(slot),
+        )
+
+    def _fire(self, context: CallbackContext):
+        """
+        Slot job callback. Schedule the next instant of the slot and notify all the subscribers: the first chunk is
+        notified immediately, the next ones by jobs evenly spaced over the spread window
+        :param context: context
+        """
+        slot, when = context.job.context
+        now = datetime.datetime.now(datetime.timezone.utc)
+        metrics.REMINDER_DELAY.observe(max(0.0, (now - when).total_seconds()))
+
+        with self._lock:
+            if self.jobs.get(slot) is context.job:
+                # Next instant strictly after the fired one, even if the job runs early
+                after = max(now, when)
+                self._arm(slot, after + datetime.timedelta(minutes=1))
+            subscribers = list(self.slots.get(slot, dict()).items())
+
+        chunks = [
+            subscribers[start:start + REMINDER_CHUNK_SIZE]
+            for start in range(0, len(subscribers), REMINDER_CHUNK_SIZE)
+        ] or [[]]
+        for index, chunk in enumerate(chunks[1:], 1):
+            self.job_queue.run_once(
+                self._notify_chunk,
+                when=self.spread * index / len(chunks),
+                context=(slot, chunk),
+                name=f"{slot_key(slot)} chunk {index}",
+            )
+
+        self._notify(context.bot, slot, chunks[0])
+
+    def _notify_chunk(self, context: CallbackContext):
+        """
+        Staggered chunk job callback
+        :param context: context
+        """
+        self._notify(context.bot, *context.job.context)
+
+    def _notify(self, bot, slot, chunk: list):
+        """
+        Notify a chunk of the subscribers of the slot
+        :param bot: bot
+        :param slot: slot
+        :param chunk: list of ((user_id, notification key), schedule_data)
+        """
+        try:
+            self.reminder_callback(bot, self._reminders(chunk))
+        except Exception:
+            logger.exception("Reminders dispatch failed for slot %s", slot)
+
+    def _reminders(self, chunk: list):
+        """
+        Iterate the reminders of a chunk. The user data of the chunk is pinned while its reminders are dispatched, so
+        loading a large slot doesn't evict the user data still in use from a bounded user data cache
+        :param chunk: list of ((user_id, notification key), schedule_data)
+        :return: iterator of (user_id, user_data, schedule_data)
+        """
+        with pinned_user_data(self.user_data, {user_id for (user_id, _), _ in chunk}):
+            for (user_id, _), schedule_data in chunk:
+                yield user_id, self.user_data[user_id], schedule_data
+
+
+def slot_key(slot) -> str:
+    """
+    Gets the store key of the slot
+    :param slot: slot (weekday, HH:MM, timezone)
+    :return: the store key
+    """
+    return f"{SLOT_KEY_PREFIX}{slot[0]} {slot[1]} {slot[2]}"
+
+
+def slot_of_key(key: str):
+    """
+    Gets the slot of the store key
+    :param key: store key
+    :return: the slot (weekday, HH:MM, timezone)
+    """
+    weekday, when_time, timezone = key[len(SLOT_KEY_PREFIX):].split(" ")
+    return int(weekday), when_time, timezone
@@ -0,0 +1,70 @@
+"""Update router module."""
+
+from telegram import Update
+from telegram.ext import CallbackContext, Filters, Handler
+
+# Same updates of MessageHandler(Filters.text & ~Filters.command)
+TEXT_INPUT_FILTER = Filters.update & Filters.text & ~Filters.command
+
+
+class UpdateRouter(Handler):
+    """
+    Single handler routing callback queries and text inputs.
+    Callback data is split once on the action separator and the action is looked up in a hash table, instead of
+    matching the regex of every CallbackQueryHandler in order
+    """
+
+    def __init__(self, callback_routes: dict, input_callback):
+        """
+        Init method
+        :param callback_routes: dict of callback action -> callback
+        :param input_callback: callback of the text messages that aren't commands
+        """
+        super().__init__(self.route)
+        self.callback_routes = callback_routes
+        self.input_callback = input_callback
+
+    def check_update(self, update: object):
+        """
+        Find the callback of the update
+        :param update: update
+        :return: the callback, None if update isn't routed
+        """
+        if not isinstance(update, Update):
+            return None
+
+        if update.callback_query:
+            data = update.callback_query.data
+            if not data:
+                return None
+
+            return self.callback_routes.get(data.partition("#")[0])
+
+        if TEXT_INPUT_FILTER(update):
+            return self.input_callback
+
+        return None
+
+    def handle_update(self, update: Update, dispatcher, check_result, context: CallbackContext = None):
+        """
+        Call the routed callback
+        :param update: update
+        :param dispatcher: dispatcher
+        :param check_result: routed callback
+        :param context: context
+        :return: callback result
+        """
+        return check_result(update, context)
+
+    def route(self, update: Update, context: CallbackContext):
+        """
+        Route the update. Used only when the router is called as a plain callback
+        :param update: update
+        :param context: context
+        :return: callback result
+        """
+        callback = self.check_update(update)
+        if callback:
+            return callback(update, context)
+
+        return None
@@ -2,12 +2,25 @@
 
 import datetime
 import json
+import logging
+import os
+import time
 from enum import Enum
 
-from .constants import USER_GROUP
+from . import metrics
+from .constants import USER_GROUP, WEEK_CACHE_DEFAULT_SIZE, get_shifts_streaming
 from .datehelper import DAYS_OF_WEEK
+from .jsonstream import JsonStream
+from .lrucache import LRUCache
+from .snapshot import get_snapshot_filename, load_snapshot, source_hash, write_snapshot
+from .shiftstore import NO_SHIFT, ShiftRule, ShiftStore
 
-shifts_dict = dict()
+shift_store = ShiftStore()
+shifts_file_signature = None
+# Resized to WEEK_CACHE_SIZE by the bot startup, once the environment is loaded
+week_cache = LRUCache(WEEK_CACHE_DEFAULT_SIZE)
+
+logger = logging.getLogger(__name__)
 
 
 class ShiftType(Enum):
@@ -74,13 +87,364 @@ def load_shifts(file):
     Load shifts json file
     :param file: file
     """
+    signature = get_file_signature(file)
+    with metrics.SHIFTS_LOAD_DURATION.time("load"):
+        store = read_shifts(file)
+    swap_shift_store(store, signature)
+
+
+def read_shifts(file):
+    """
+    Read the shifts, mapping the compiled snapshot when it's up to date with the shifts file,
+    and falling back to parse the shifts file otherwise
+    :param file: shifts file
+    :return: the loaded shift store
+    :raise ValueError: if file content isn't valid
+    """
+    snapshot_file = get_snapshot_filename(file)
+    if os.path.exists(snapshot_file):
+        store = load_snapshot(snapshot_file, source_hash(file))
+        if store is not None:
+            logger.info("Loaded shifts snapshot %s", snapshot_file)
+            return store
+
+        logger.warning("Shifts snapshot %s is stale or invalid, loading %s", snapshot_file, file)
+
+    return parse_shifts(file)
+
+
+def compile_snapshot(source, target=None):
+    """
+    Compile the shifts file in a binary snapshot
+    :param source: shifts file
+    :param target: snapshot file (get_snapshot_filename(source) if not filled)
+    :return: the snapshot file
+    """
+    target = target or get_snapshot_filename(source)
+    digest = source_hash(source)
+    write_snapshot(parse_shifts(source), target, digest)
+
+    return target
+
+
+def parse_shifts(file, streaming: bool = None):
+    """
+    Parse and validate shifts json file
+    :param file: file
+    :param streaming: True to use the streaming parser, None to use the SHIFTS_STREAMING setting
+    :return: the loaded shift store
+    :raise ValueError: if file content isn't valid
+    """
+    if streaming is None:
+        streaming = get_shifts_streaming()
+
+    if streaming:
+        return parse_shifts_stream(file)
+
     with open(file) as f:
         loaded_json = json.load(f)
 
-        for group in loaded_json["groups"]:
-            shifts_dict[group["name"]] = dict()
-            for shift in group["shifts"]:
-                shifts_dict[group["name"]][shift["date"]] = shift["presence"]
+    if not isinstance(loaded_json, dict) or not isinstance(loaded_json.get("groups"), list):
+        raise ValueError("Shifts file must contain a groups list")
+
+    store = ShiftStore()
+    for group in loaded_json["groups"]:
+        try:
+            name = validate_group_name(group["name"])
+            store.add_group(name)
+            for shift in group.get("shifts", []):
+                add_shift(store, name, shift)
+            for rule in validate_rules(group.get("rules", [])):
+                add_rule(store, name, rule)
+        except (KeyError, TypeError) as e:
+            raise ValueError(f"Invalid group definition: {e!r}") from e
+
+    store.compact()
+    return store
+
+
+def parse_shifts_stream(file):
+    """
+    Parse and validate shifts json file with the streaming parser.
+    groups[] is walked incrementally and every group is added to the store as soon as it's decoded, so peak memory is
+    proportional to the loaded store (plus a single group) and not to the file size
+    :param file: file
+    :return: the loaded shift store
+    :raise ValueError: if file content isn't valid
+    """
+    store = ShiftStore()
+    groups_found = False
+
+    with open(file) as f:
+        stream = JsonStream(f)
+
+        for key in stream.items():
+            if key != "groups":
+                stream.value()
+                continue
+
+            if stream.peek() != "[":
+                raise ValueError("Shifts file must contain a groups list")
+
+            groups_found = True
+            for _ in stream.elements():
+                parse_group_stream(stream, store)
+
+    if not groups_found:
+        raise ValueError("Shifts file must contain a groups list")
+
+    store.compact()
+    return store
+
+
+def parse_group_stream(stream: JsonStream, store: ShiftStore):
+    """
+    Parse a single group with the streaming parser
+    :param stream: json stream, positioned on the group object
+    :param store: shift store to fill
+    :raise ValueError: if group isn't valid
+    """
+    name = None
+    pending_shifts = []
+    pending_rules = []
+
+    if stream.peek() != "{":
+        raise ValueError("Invalid group definition")
+
+    try:
+        for key in stream.items():
+            if key == "name":
+                name = validate_group_name(stream.value())
+                store.add_group(name)
+                for shift in pending_shifts:
+                    add_shift(store, name, shift)
+                for rule in pending_rules:
+                    add_rule(store, name, rule)
+                pending_shifts = []
+                pending_rules = []
+            elif key == "shifts":
+                shifts = stream.value()
+                if not isinstance(shifts, list):
+                    raise ValueError("Group shifts must be a list")
+
+                if name is None:
+                    # Shifts before group name, keep them until name is found
+                    pending_shifts = shifts
+                else:
+                    for shift in shifts:
+                        add_shift(store, name, shift)
+            elif key == "rules":
+                rules = validate_rules(stream.value())
+                if name is None:
+                    # Rules before group name, keep them until name is found
+                    pending_rules = rules
+                else:
+                    for rule in rules:
+                        add_rule(store, name, rule)
+            else:
+                stream.value()
+    except (KeyError, TypeError) as e:
+        raise ValueError(f"Invalid group definition: {e!r}") from e
+
+    if name is None:
+        raise ValueError("Invalid group definition: missing name")
+
+
+def validate_group_name(name):
+    """
+    Validate the group name
+    :param name: group name
+    :return: group name
+    :raise ValueError: if name isn't valid
+    """
+    if not isinstance(name, str):
+        raise ValueError(f"Invalid group name {name!r}")
+
+    return name
+
+
+def add_shift(store: ShiftStore, group: str, shift: dict):
+    """
+    Validate a shift definition and add it to the store
+    :param store: shift store
+    :param group: group name
+    :param shift: shift definition
+    :raise ValueError: if shift isn't valid
+    """
+    if not isinstance(shift["presence"], bool):
+        raise ValueError(f"Invalid presence {shift['presence']!r} for group {group}")
+
+    store.set_ordinal(group, datetime.date.fromisoformat(shift["date"]).toordinal(), encode_presence(shift["presence"]))
+
+
+def validate_rules(rules):
+    """
+    Validate the rules list of a group
+    :param rules: rules
+    :return: rules
+    :raise ValueError: if rules isn't a list
+    """
+    if not isinstance(rules, list):
+        raise ValueError("Group rules must be a list")
+
+    return rules
+
+
+def add_rule(store: ShiftStore, group: str, rule: dict):
+    """
+    Validate a recurring rule definition and add it to the store.
+    A rule has the weekdays (0 is Monday) and the presence, and optionally:
+    - from / until: first and last date of the rule
+    - weeks: "odd" or "even", to match only the odd or even ISO weeks
+    - every: match one week every N, starting from the week of "from"
+    :param store: shift store
+    :param group: group name
+    :param rule: rule definition
+    :raise ValueError: if rule isn't valid
+    """
+    if not isinstance(rule["presence"], bool):
+        raise ValueError(f"Invalid presence {rule['presence']!r} for group {group}")
+
+    weekdays = rule["weekdays"]
+    if not weekdays or any(weekday not in range(7) or isinstance(weekday, bool) for weekday in weekdays):
+        raise ValueError(f"Invalid weekdays {weekdays!r} for group {group}")
+
+    start_ordinal = datetime.date.fromisoformat(rule["from"]).toordinal() if "from" in rule else None
+    end_ordinal = datetime.date.fromisoformat(rule["until"]).toordinal() if "until" in rule else None
+
+    weeks = rule.get("weeks")
+    if weeks not in (None, "odd", "even"):
+        raise ValueError(f"Invalid weeks {weeks!r} for group {group}")
+
+    every = rule.get("every", 1)
+    if not isinstance(every, int) or isinstance(every, bool) or not 1 <= every <= 52:
+        raise ValueError(f"Invalid every {every!r} for group {group}")
+    if every > 1 and start_ordinal is None:
+        raise ValueError(f"Rule with every {every} needs a from date for group {group}")
+
+    store.add_rule(group, ShiftRule(
+        code=encode_presence(rule["presence"]),
+        weekdays=sum(1 << weekday for weekday in set(weekdays)),
+        start_ordinal=start_ordinal,
+        end_ordinal=end_ordinal,
+        every=every,
+        parity=None if weeks is None else int(weeks == "odd"),
+    ))
+
+
+def swap_shift_store(store: ShiftStore, signature=None):
+    """
+    Atomically replace the current shift store
+    :param store: new shift store
+    :param signature: signature of the loaded file
+    :return: the replaced shift store
+    """
+    global shift_store, shifts_file_signature
+
+    old_store = shift_store
+    store.generation = old_store.generation + 1
+    shift_store = store
+    shifts_file_signature = signature
+    week_cache.clear()
+
+    return old_store
+
+
+def get_file_signature(file):
+    """
+    Gets the file signature used to detect changes
+    :param file: file
+    :return: tuple of (inode, mtime, size)
+    """
+    stat = os.stat(file)
+    return stat.st_ino, stat.st_mtime_ns, stat.st_size
+
+
+def reload_shifts(file):
+    """
+    Reload the shifts file, if changed since last load.
+    File is parsed and validated before replacing the current shift store, so an invalid file is discarded
+    :param file: shifts file
+    :return: the replaced shift store, None if shifts weren't reloaded
+    """
+    global shifts_file_signature
+
+    try:
+        signature = get_file_signature(file)
+    except OSError as e:
+        logger.warning("Unable to check shifts file %s: %s", file, e)
+        return None
+
+    if signature == shifts_file_signature:
+        return None
+
+    start = time.perf_counter()
+    try:
+        store = read_shifts(file)
+    except (OSError, ValueError) as e:
+        logger.error("Invalid shifts file %s, keeping previous shifts: %s", file, e)
+        # Don't retry until the file changes again
+        shifts_file_signature = signature
+        return None
+
+    old_store = swap_shift_store(store, signature)
+    elapsed = time.perf_counter() - start
+    metrics.SHIFTS_LOAD_DURATION.observe(elapsed, "reload")
+    changed_groups, changed_dates = store.count_changes(old_store)
+
+    logger.info(
+        "Reloaded shifts file %s in %.3fs: %s groups, %s changed groups, %s changed dates",
+        file,
+        elapsed,
+        len(store),
+        changed_groups,
+        changed_dates,
+    )
+
+    return old_store
+
+
+def get_shift_changes(old_store: ShiftStore, start_date: datetime.date, days: int):
+    """
+    Gets the shift changes of the current store from a previous one, in a date window
+    :param old_store: previous shift store
+    :param start_date: first date of the window
+    :param days: window length
+    :return: dict of group -> list of (date, previous shift type, new shift type), shift type is None for no shift
+    """
+    return {
+        group: [
+            (datetime.date.fromordinal(ordinal), decode_shift(old_code), decode_shift(new_code))
+            for ordinal, old_code, new_code in group_changes
+        ]
+        for group, group_changes in shift_store.diff(old_store, start_date.toordinal(), days).items()
+    }
+
+
+def decode_shift(code: int):
+    """
+    Decode the shift code
+    :param code: shift code
+    :return: the shift type, None for NO_SHIFT
+    """
+    return None if code == NO_SHIFT else ShiftType(code)
+
+
+def encode_presence(presence: bool):
+    """
+    Encode presence flag in the shift code
+    :param presence: presence
+    :return: shift code
+    """
+    return ShiftType.PRESENCE.value if presence else ShiftType.SMART_WORKING.value
+
+
+def get_groups():
+    """
+    Return the loaded groups
+    :return: group names
+    """
+    return list(shift_store)
 
 
 def is_valid_group(group):
@@ -89,7 +453,7 @@ def is_valid_group(group):
     :param group: group to validate
     :return: True if group is valid, False otherwise
     """
-    return group in shifts_dict
+    return group in shift_store
 
 
 def get_decoded_description(presence: bool):
@@ -106,24 +470,76 @@ def get_decoded_description(presence: bool):
 
 def get_week_shifts_message(date: datetime, user_data: dict):
     """
-    Get the week shifts message
+    Get the week shifts message.
+    Rendered weeks are cached by (group, ISO year, ISO week)
     :param date: date
     :param user_data: user date
     :return: the week shifts message
     """
+    store = shift_store
+    group = user_data.get(USER_GROUP)
+
+    key = week_cache_key(store, group, date)
+    message = week_cache.get(key)
+    if message is None:
+        message = render_week_shifts(store, group, date)
+        week_cache.put(key, message)
+
+    return message
+
+
+def week_cache_key(store: ShiftStore, group: str, date: datetime):
+    """
+    Gets the week cache key
+    :param store: shift store
+    :param group: group
+    :param date: date
+    :return: the week cache key
+    """
+    iso_year, iso_week, _ = date.isocalendar()
+    return store.generation, group, iso_year, iso_week
+
+
+def render_week_shifts(store: ShiftStore, group: str, date: datetime):
+    """
+    Render the week shifts message
+    :param store: shift store
+    :param group: group
+    :param date: date
+    :return: the week shifts message
+    """
     message = ""
 
     for date in get_working_date_of_week(date):
-        date_string = date.strftime("%d-%m-%Y")
-        message += f"{DAYS_OF_WEEK[date.weekday()][0:3]} {date_string} - "
-        try:
-            message += f"{get_decoded_description(shifts_dict[user_data[USER_GROUP]][date.strftime('%Y-%m-%d')])} \n"
-        except KeyError:
+        message += f"{DAYS_OF_WEEK[date.weekday()][0:3]} {date.day:02d}-{date.month:02d}-{date.year} - "
+        code = store.get(group, date)
+        if code == NO_SHIFT:
             message += "Nessun turno 😢\n"
+        else:
+            message += f"{get_decoded_description(code == ShiftType.PRESENCE.value)} \n"
 
     return message
 
 
+def get_week_cache_stats():
+    """
+    Gets the week cache statistics
+    :return: dict with size, maxsize, hits and misses
+    """
+    return week_cache.stats()
+
+
+def is_shift_day(date: datetime, group: str, shift_type: int):
+    """
+    Return if the given date is a shift_type day for the group or not
+    :param date: date
+    :param group: group
+    :param shift_type: shift type value
+    :return: True if date is a shift_type day, False otherwise
+    """
+    return group is not None and shift_store.get(group, date) == shift_type
+
+
 def is_presence_day(date: datetime, user_data: dict):
     """
     Return if the given date is a presence day or not
@@ -131,11 +547,7 @@ def is_presence_day(date: datetime, user_data: dict):
     :param user_data: user data
     :return: True if date is a presence day, False otherwise
     """
-    try:
-        date_string = date.strftime("%Y-%m-%d")
-        return shifts_dict[user_data[USER_GROUP]][date_string] is True
-    except KeyError:
-        return False
+    return shift_store.get(user_data.get(USER_GROUP), date) == ShiftType.PRESENCE.value
 
 
 def is_smart_working_day(date: datetime, user_data: dict):
@@ -145,11 +557,7 @@ def is_smart_working_day(date: datetime, user_data: dict):
     :param user_data: user data
     :return: True if date is a smart working day, False otherwise
     """
-    try:
-        date_string = date.strftime("%Y-%m-%d")
-        return shifts_dict[user_data[USER_GROUP]][date_string] is False
-    except KeyError:
-        return False
+    return shift_store.get(user_data.get(USER_GROUP), date) == ShiftType.SMART_WORKING.value
 
 
 def get_working_date_of_week(date: datetime):
@@ -0,0 +1,352 @@
+"""Shift store module."""
+
+import datetime
+from array import array
+from typing import NamedTuple, Optional
+
+from .lrucache import LRUCache
+
+NO_SHIFT = -1
+NO_SHIFT_BYTE = array("b", [NO_SHIFT]).tobytes()
+RULE_WEEKS_CACHE_SIZE = 4096
+
+
+def weekday_of(ordinal: int):
+    """
+    Gets the weekday of a date ordinal (ordinal 1 is a Monday)
+    :param ordinal: date ordinal
+    :return: the weekday (0 is Monday)
+    """
+    return (ordinal - 1) % 7
+
+
+class ShiftRule(NamedTuple):
+    """
+    Recurring shift: the shift code of the matching weekdays, optionally limited to a date range, to odd or even
+    ISO weeks and to one week every N (counted from the week of the range start)
+    """
+    code: int
+    weekdays: int
+    start_ordinal: Optional[int] = None
+    end_ordinal: Optional[int] = None
+    every: int = 1
+    parity: Optional[int] = None
+
+    def matches(self, ordinal: int, iso_week: int):
+        """
+        Return if the rule matches the date
+        :param ordinal: date ordinal
+        :param iso_week: ISO week number of the date
+        :return: True if rule matches, False otherwise
+        """
+        if self.start_ordinal is not None and ordinal < self.start_ordinal:
+            return False
+
+        if self.end_ordinal is not None and ordinal > self.end_ordinal:
+            return False
+
+        if not self.weekdays >> weekday_of(ordinal) & 1:
+            return False
+
+        if self.parity is not None and iso_week % 2 != self.parity:
+            return False
+
+        if self.every > 1:
+            first_monday = self.start_ordinal - weekday_of(self.start_ordinal)
+            return (ordinal - first_monday) // 7 % self.every == 0
+
+        return True
+
+
+class ShiftStore:
+    """
+    Compact shift store shared by all groups.
+    Every group keeps an int8 array of shift codes indexed on a single date axis (date ordinals starting from
+    start_ordinal). Codes are the ShiftType values, NO_SHIFT marks a day without shift.
+    Groups can also have recurring rules, evaluated on demand for the days without an explicit shift: the first
+    matching rule wins, and evaluated weeks are memoised by (group, week)
+    """
+
+    def __init__(self, start_ordinal: int = 0, groups: dict = None, rules: dict = None):
+        """
+        Init method
+        :param start_ordinal: ordinal of the first date of the axis
+        :param groups: dict of group name -> codes array
+        :param rules: dict of group name -> tuple of shift rules
+        """
+        self.start_ordinal = start_ordinal
+        self.groups = groups if groups is not None else dict()
+        self.rules = rules if rules is not None else dict()
+        self.rule_weeks = LRUCache(RULE_WEEKS_CACHE_SIZE)
+        self.generation = 0
+
+    def __contains__(self, group):
+        """
+        Return if group is present or not
+        :param group: group
+        :return: True if group is present, False otherwise
+        """
+        return group in self.groups
+
+    def __iter__(self):
+        """
+        Iterate over group names
+        :return: group names iterator
+        """
+        return iter(self.groups)
+
+    def __len__(self):
+        """
+        Number of groups
+        :return: number of groups
+        """
+        return len(self.groups)
+
+    @property
+    def days(self):
+        """
+        Length of the date axis
+        :return: number of days of the date axis
+        """
+        return max((len(codes) for codes in self.groups.values()), default=0)
+
+    def add_group(self, group: str):
+        """
+        Add an empty group. If group already exists, the existing one is kept
+        :param group: group name
+        """
+        if group not in self.groups:
+            self.groups[group] = array("b")
+
+    def add_rule(self, group: str, rule: ShiftRule):
+        """
+        Add a recurring rule to the group, after the existing ones
+        :param group: group name
+        :param rule: shift rule
+        """
+        self.add_group(group)
+        self.rules[group] = self.rules.get(group, ()) + (rule,)
+        self.rule_weeks.clear()
+
+    def set(self, group: str, date: datetime.date, code: int):
+        """
+        Set the shift code of group on the given date
+        :param group: group name
+        :param date: date
+        :param code: shift code
+        """
+        self.set_ordinal(group, date.toordinal(), code)
+
+    def set_ordinal(self, group: str, ordinal: int, code: int):
+        """
+        Set the shift code of group on the given date ordinal, extending the date axis when needed
+        :param group: group name
+        :param ordinal: date ordinal
+        :param code: shift code
+        """
+        self.add_group(group)
+
+        if not any(self.groups.values()):
+            self.start_ordinal = ordinal
+        elif ordinal < self.start_ordinal:
+            # Grow the front geometrically like the tail, so dates in descending order don't pad every group at
+            # every date. The unused front is removed by compact
+            growth = max(self.start_ordinal - ordinal, self.days)
+            padding = array("b", [NO_SHIFT]) * growth
+            for name, codes in self.groups.items():
+                if codes:
+                    self.groups[name] = padding + codes
+            self.start_ordinal -= growth
+
+        codes = self.groups[group]
+        index = ordinal - self.start_ordinal
+        if index >= len(codes):
+            codes.extend(array("b", [NO_SHIFT]) * (index - len(codes) + 1))
+        codes[index] = code
+
+    def compact(self):
+        """
+        Remove the leading days without shift in every group from the date axis
+        """
+        leading = min(
+            (len(codes) - len(codes.tobytes().lstrip(NO_SHIFT_BYTE)) for codes in self.groups.values() if codes),
+            default=0,
+        )
+        if not leading:
+            return
+
+        for name, codes in self.groups.items():
+            if codes:
+                self.groups[name] = codes[leading:]
+        self.start_ordinal += leading
+
+    def get(self, group: str, date: datetime.date):
+        """
+        Get the shift code of group on the given date
+        :param group: group name
+        :param date: date
+        :return: shift code, NO_SHIFT if group or shift isn't present
+        """
+        return self.get_ordinal(group, date.toordinal())
+
+    def get_ordinal(self, group: str, ordinal: int):
+        """
+        Get the shift code of group on the given date ordinal
+        :param group: group name
+        :param ordinal: date ordinal
+        :return: shift code, NO_SHIFT if group or shift isn't present
+        """
+        codes = self.groups.get(group)
+        if codes is None:
+            return NO_SHIFT
+
+        index = ordinal - self.start_ordinal
+        if 0 <= index < len(codes) and codes[index] != NO_SHIFT:
+            return codes[index]
+
+        if group in self.rules:
+            return self.rule_code(group, ordinal)
+
+        return NO_SHIFT
+
+    def rule_code(self, group: str, ordinal: int):
+        """
+        Evaluate the rules of group on the given date ordinal
+        :param group: group name
+        :param ordinal: date ordinal
+        :return: shift code of the first matching rule, NO_SHIFT if no rule matches
+        """
+        weekday = weekday_of(ordinal)
+        return self.rule_week(group, ordinal - weekday)[weekday]
+
+    def rule_week(self, group: str, monday_ordinal: int):
+        """
+        Evaluate the rules of group on a week, memoised by (group, week)
+        :param group: group name
+        :param monday_ordinal: ordinal of the Monday of the week
+        :return: the shift codes of the week
+        """
+        key = (group, monday_ordinal)
+        week = self.rule_weeks.get(key)
+        if week is None:
+            rules = self.rules.get(group, ())
+            iso_week = datetime.date.fromordinal(monday_ordinal).isocalendar()[1]
+            week = array("b", [
+                next((rule.code for rule in rules if rule.matches(ordinal, iso_week)), NO_SHIFT)
+                for ordinal in range(monday_ordinal, monday_ordinal + 7)
+            ])
+            self.rule_weeks.put(key, week)
+
+        return week
+
+    def explicit_window(self, group: str, start_ordinal: int, days: int):
+        """
+        Gets the explicit shift codes of group in a date window, without the rules, padded with NO_SHIFT outside the
+        date axis
+        :param group: group name
+        :param start_ordinal: ordinal of the first date of the window
+        :param days: window length
+        :return: the window codes
+        """
+        codes = self.groups.get(group)
+        if codes is None:
+            return array("b", [NO_SHIFT]) * days
+
+        start = start_ordinal - self.start_ordinal
+        end = start + days
+        window = array("b", codes[max(start, 0):max(min(end, len(codes)), 0)])
+        if start < 0:
+            window = array("b", [NO_SHIFT]) * min(-start, days) + window
+        if len(window) < days:
+            window.extend(array("b", [NO_SHIFT]) * (days - len(window)))
+
+        return window
+
+    def window(self, group: str, start_ordinal: int, days: int):
+        """
+        Gets the shift codes of group in a date window, padded with NO_SHIFT outside the date axis
+        :param group: group name
+        :param start_ordinal: ordinal of the first date of the window
+        :param days: window length
+        :return: the window codes
+        """
+        window = self.explicit_window(group, start_ordinal, days)
+
+        if group in self.rules:
+            for i, code in enumerate(window):
+                if code == NO_SHIFT:
+                    window[i] = self.rule_code(group, start_ordinal + i)
+
+        return window
+
+    def diff(self, other, start_ordinal: int, days: int):
+        """
+        Find the changes from another store in a date window, rules included.
+        When a group has the same rules in both stores, only the dates whose explicit shift changed can change: the
+        explicit windows are compared as a whole (a single comparison for unchanged groups) and the rules are evaluated
+        only on the changed dates. Groups with changed rules, added or removed are evaluated on the whole window
+        :param other: previous store
+        :param start_ordinal: ordinal of the first date of the window
+        :param days: window length
+        :return: dict of group -> list of (date ordinal, previous code, new code)
+        """
+        changes = dict()
+
+        for group in self.groups.keys() | other.groups.keys():
+            if group in self.groups and group in other.groups and self.rules.get(group) == other.rules.get(group):
+                codes = self.explicit_window(group, start_ordinal, days)
+                other_codes = other.explicit_window(group, start_ordinal, days)
+                if codes == other_codes:
+                    continue
+
+                ordinals = [
+                    start_ordinal + i
+                    for i, (other_code, code) in enumerate(zip(other_codes, codes))
+                    if code != other_code
+                ]
+            else:
+                ordinals = range(start_ordinal, start_ordinal + days)
+
+            group_changes = [
+                (ordinal, other_code, code)
+                for ordinal, other_code, code in (
+                    (ordinal, other.get_ordinal(group, ordinal), self.get_ordinal(group, ordinal))
+                    for ordinal in ordinals
+                )
+                if code != other_code
+            ]
+            if group_changes:
+                changes[group] = group_changes
+
+        return changes
+
+    def count_changes(self, other):
+        """
+        Count the differences between this store and another one.
+        Dates are compared on the explicit date axis only, a group with changed rules always counts as changed
+        :param other: other store
+        :return: tuple of (changed groups, changed dates)
+        """
+        changed_groups = 0
+        changed_dates = 0
+
+        for group in self.groups.keys() | other.groups.keys():
+            codes, other_codes = self.groups.get(group), other.groups.get(group)
+            if codes is None or other_codes is None:
+                changed_groups += 1
+                changed_dates += sum(1 for code in (other_codes if codes is None else codes) if code != NO_SHIFT)
+                continue
+
+            rules_changed = self.rules.get(group) != other.rules.get(group)
+            if self.start_ordinal == other.start_ordinal and codes == other_codes and not rules_changed:
+                continue
+
+            start = min(self.start_ordinal, other.start_ordinal)
+            end = max(self.start_ordinal + len(codes), other.start_ordinal + len(other_codes))
+            dates = sum(1 for ordinal in range(start, end)
+                        if self.get_ordinal(group, ordinal) != other.get_ordinal(group, ordinal))
+            if dates or rules_changed:
+                changed_groups += 1
+                changed_dates += dates
+
+        return changed_groups, changed_dates
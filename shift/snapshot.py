@@ -0,0 +1,207 @@
+"""
+Binary shifts snapshot module.
+
+A snapshot is a precompiled, memory-mappable copy of the shifts file. Layout (little endian):
+- header: magic, format version, start ordinal, number of days, number of groups, SHA-256 of the source file
+- group name table: for every group, name length (uint16) followed by the UTF-8 name
+- padding up to 8 bytes alignment
+- day arrays: for every group (same order of name table), a fixed width int8 array of shift codes
+- rules table: for every group (same order of name table), rules count (uint16) followed by the rules
+
+Compile a snapshot with: python -m shift.snapshot compile [shifts.json] [snapshot]
+"""
+
+import hashlib
+import logging
+import mmap
+import os
+import struct
+import sys
+
+from .constants import get_shifts_filename
+from .shiftstore import NO_SHIFT, ShiftRule, ShiftStore
+
+SNAPSHOT_MAGIC = b"SHFT"
+SNAPSHOT_VERSION = 2
+SNAPSHOT_EXTENSION = ".snapshot"
+SNAPSHOT_ALIGNMENT = 8
+
+HEADER = struct.Struct("<4sHHiII32s")
+NAME_LENGTH = struct.Struct("<H")
+RULES_COUNT = struct.Struct("<H")
+# code, weekdays mask, start ordinal, end ordinal, every, parity (0 is no limit for ordinals, -1 for parity)
+RULE = struct.Struct("<bBiiHb")
+
+logger = logging.getLogger(__name__)
+
+
+def get_snapshot_filename(source):
+    """
+    Gets the snapshot file name of the given shifts file (E.g. shifts.json -> shifts.snapshot)
+    :param source: shifts file
+    :return: the snapshot file name
+    """
+    return os.path.splitext(source)[0] + SNAPSHOT_EXTENSION
+
+
+def source_hash(source):
+    """
+    Compute the SHA-256 of the shifts file
+    :param source: shifts file
+    :return: the digest
+    """
+    digest = hashlib.sha256()
+    with open(source, "rb") as f:
+        for chunk in iter(lambda: f.read(1024 * 1024), b""):
+            digest.update(chunk)
+
+    return digest.digest()
+
+
+def write_snapshot(store: ShiftStore, target, digest: bytes):
+    """
+    Write the store in a snapshot file.
+    File is written in a temporary file and then renamed, so running processes keep their mapping of the old file
+    :param store: shift store
+    :param target: snapshot file
+    :param digest: SHA-256 of the source file
+    """
+    names = list(store)
+    days = store.days
+
+    tmp_target = f"{target}.{os.getpid()}.tmp"
+    with open(tmp_target, "wb") as f:
+        f.write(HEADER.pack(SNAPSHOT_MAGIC, SNAPSHOT_VERSION, 0, store.start_ordinal, days, len(names), digest))
+        for name in names:
+            encoded = name.encode()
+            f.write(NAME_LENGTH.pack(len(encoded)))
+            f.write(encoded)
+
+        f.write(b"\0" * (-f.tell() % SNAPSHOT_ALIGNMENT))
+
+        for name in names:
+            codes = store.groups[name]
+            f.write(bytes(codes))
+            f.write(bytes([NO_SHIFT & 0xFF]) * (days - len(codes)))
+
+        for name in names:
+            rules = store.rules.get(name, ())
+            f.write(RULES_COUNT.pack(len(rules)))
+            for rule in rules:
+                f.write(RULE.pack(
+                    rule.code,
+                    rule.weekdays,
+                    rule.start_ordinal or 0,
+                    rule.end_ordinal or 0,
+                    rule.every,
+                    -1 if rule.parity is None else rule.parity,
+                ))
+
+    os.replace(tmp_target, target)
+
+
+def load_snapshot(file, digest: bytes = None):
+    """
+    Map a snapshot file. Lookups are answered directly from the read-only mapped buffer
+    :param file: snapshot file
+    :param digest: expected SHA-256 of the source file, None to skip the check
+    :return: the mapped shift store, None if snapshot is missing, stale or invalid
+    """
+    try:
+        with open(file, "rb") as f:
+            buffer = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+    except (OSError, ValueError):
+        return None
+
+    view = memoryview(buffer)
+    try:
+        return parse_snapshot(view, digest)
+    except (struct.error, ValueError) as e:
+        logger.warning("Invalid snapshot %s: %s", file, e)
+        return None
+
+
+def parse_snapshot(view: memoryview, digest: bytes = None):
+    """
+    Parse the snapshot buffer
+    :param view: snapshot buffer
+    :param digest: expected SHA-256 of the source file, None to skip the check
+    :return: the shift store, None if snapshot is stale
+    :raise ValueError: if snapshot isn't valid
+    """
+    magic, version, _, start_ordinal, days, group_count, snapshot_digest = HEADER.unpack_from(view)
+    if magic != SNAPSHOT_MAGIC or version != SNAPSHOT_VERSION:
+        raise ValueError(f"Unsupported snapshot format {magic!r} version {version}")
+
+    if digest is not None and digest != snapshot_digest:
+        return None
+
+    names = []
+    offset = HEADER.size
+    for _ in range(group_count):
+        (length,) = NAME_LENGTH.unpack_from(view, offset)
+        offset += NAME_LENGTH.size
+        names.append(bytes(view[offset:offset + length]).decode())
+        offset += length
+
+    offset += -offset % SNAPSHOT_ALIGNMENT
+    if offset + group_count * days > len(view):
+        raise ValueError("Truncated snapshot")
+
+    codes = view[offset:offset + group_count * days].cast("b")
+
+    rules = dict()
+    offset += group_count * days
+    for name in names:
+        (count,) = RULES_COUNT.unpack_from(view, offset)
+        offset += RULES_COUNT.size
+        if count:
+            rules[name] = tuple(parse_rule(view, offset + i * RULE.size) for i in range(count))
+        offset += count * RULE.size
+
+    return ShiftStore(
+        start_ordinal,
+        {name: codes[i * days:(i + 1) * days] for i, name in enumerate(names)},
+        rules,
+    )
+
+
+def parse_rule(view: memoryview, offset: int):
+    """
+    Parse a rule of the rules table
+    :param view: snapshot buffer
+    :param offset: rule offset
+    :return: the shift rule
+    """
+    code, weekdays, start_ordinal, end_ordinal, every, parity = RULE.unpack_from(view, offset)
+    return ShiftRule(
+        code=code,
+        weekdays=weekdays,
+        start_ordinal=start_ordinal or None,
+        end_ordinal=end_ordinal or None,
+        every=every,
+        parity=None if parity < 0 else parity,
+    )
+
+
+def main(args):
+    """
+    Command line entry point
+    :param args: command line arguments
+    :return: exit code
+    """
+    from .shiftsheduling import compile_snapshot
+
+    if not args or args[0] != "compile" or len(args) > 3:
+        print("Usage: python -m shift.snapshot compile [shifts.json] [snapshot]", file=sys.stderr)
+        return 2
+
+    source = args[1] if len(args) > 1 else os.path.join(os.getenv("DATA_DIR") or os.getcwd(), get_shifts_filename())
+    target = compile_snapshot(source, args[2] if len(args) > 2 else None)
+    print(f"Compiled {source} in {target}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main(sys.argv[1:]))
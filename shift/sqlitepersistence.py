@@ -0,0 +1,575 @@
+"""SQLite persistence module."""
+
+import contextlib
+import logging
+import os
+import pickle
+import sqlite3
+import threading
+import time
+from collections import defaultdict
+
+from telegram.ext import BasePersistence, PicklePersistence
+
+from . import metrics
+from .constants import PERSISTENCE_SQLITE
+
+SCHEMA = (
+    "CREATE TABLE IF NOT EXISTS user_data (user_id INTEGER PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS chat_data (chat_id INTEGER PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS bot_data (key TEXT PRIMARY KEY, data BLOB NOT NULL)",
+    "CREATE TABLE IF NOT EXISTS bot_data_members ("
+    "key TEXT NOT NULL, member INTEGER NOT NULL, PRIMARY KEY (key, member)) WITHOUT ROWID",
+    "CREATE TABLE IF NOT EXISTS conversations (name TEXT PRIMARY KEY, data BLOB NOT NULL)",
+)
+
+USER_DATA, CHAT_DATA, BOT_DATA, CONVERSATIONS = "user_data", "chat_data", "bot_data", "conversations"
+MIGRATION_SUFFIX = ".migrating"
+
+logger = logging.getLogger(__name__)
+
+
+class SQLitePersistence(BasePersistence):
+    """
+    SQLite (WAL mode) persistence.
+    Every user/chat is stored in its own row and every bot_data key in its own row, so an update writes only the rows
+    that changed. Sets of integers in bot_data (E.g. ENABLED_USERS) are stored one member per row and updated with
+    the difference from the last write. Writes are batched and committed every batch_size changes or batch_interval
+    seconds.
+    bot_data keys starting with one of replaced_key_prefixes must be replaced, never mutated in place: their values are
+    pickled only when bound to a new object, so an update doesn't serialize them all again
+    Bot instances are never stored in the persisted data, so data isn't copied to replace them
+    """
+
+    def __init__(self, filename, batch_size: int = 100, batch_interval: float = 1.0, user_data_cache_size: int = 0,
+                 replaced_key_prefixes: tuple = ()):
+        """
+        Init method
+        :param filename: SQLite database file
+        :param batch_size: max pending changes before commit
+        :param batch_interval: max seconds before committing pending changes
+        :param user_data_cache_size: max user data kept in memory, loaded on demand (0 loads all users at startup)
+        :param replaced_key_prefixes: prefixes of the bot_data keys whose values are replaced, never mutated
+        """
+        super().__init__(store_user_data=True, store_chat_data=True, store_bot_data=True)
+        self.filename = filename
+        self.batch_size = batch_size
+        self.batch_interval = batch_interval
+        self.user_data_cache_size = user_data_cache_size
+        self.replaced_key_prefixes = tuple(replaced_key_prefixes)
+        self.user_data = None
+        self.chat_data = None
+        self.bot_data = None
+        self.conversations = dict()
+        self._hashes = {USER_DATA: dict(), CHAT_DATA: dict(), BOT_DATA: dict(), CONVERSATIONS: dict()}
+        self._members = dict()
+        # bot_data key -> last written value, for the replaced keys
+        self._written_values = dict()
+        self._pending = dict()
+        self._pending_members = list()
+        self._commit_timer = None
+        self._lock = threading.RLock()
+
+        self.connection = sqlite3.connect(filename, check_same_thread=False, isolation_level=None)
+        self.connection.execute("PRAGMA journal_mode=WAL")
+        self.connection.execute("PRAGMA synchronous=NORMAL")
+        for statement in SCHEMA:
+            self.connection.execute(statement)
+
+    def insert_bot(self, obj: object) -> object:
+        """
+        No op: bot instances are never stored
+        :param obj: object
+        :return: the same object
+        """
+        return obj
+
+    @classmethod
+    def replace_bot(cls, obj: object) -> object:
+        """
+        No op: bot instances are never stored
+        :param obj: object
+        :return: the same object
+        """
+        return obj
+
+    def get_user_data(self):
+        """
+        Returns the user_data
+        :return: defaultdict of user id -> user data
+        """
+        with self._lock:
+            if self.user_data is None:
+                if self.user_data_cache_size > 0:
+                    self.user_data = LazyUserData(self, self.user_data_cache_size)
+                else:
+                    self.user_data = defaultdict(dict, self._load_rows(USER_DATA))
+            return self.user_data
+
+    def iter_user_data(self):
+        """
+        Iterate all the user data.
+        With the lazy user data cache, users not in cache are streamed from the database without caching them
+        :return: iterator of (user id, user data)
+        """
+        if not isinstance(self.get_user_data(), LazyUserData):
+            yield from list(self.user_data.items())
+            return
+
+        connection = self._sync_user_data()
+        try:
+            for user_id, blob in connection.execute("SELECT user_id, data FROM user_data"):
+                data = dict.get(self.user_data, user_id)
+                yield user_id, pickle.loads(blob) if data is None else data
+        finally:
+            connection.close()
+
+    def _sync_user_data(self):
+        """
+        Write and commit the cached user data, so the database contains all the users
+        :return: a new read connection
+        """
+        with self._lock:
+            for user_id, data in list(self.user_data.items()):
+                self._write(USER_DATA, user_id, data)
+            self._commit()
+
+        return sqlite3.connect(self.filename, check_same_thread=False)
+
+    def _load_user_data(self, user_id: int):
+        """
+        Load the user data of a single user, pending writes included
+        :param user_id: user id
+        :return: the user data (empty if user isn't stored)
+        """
+        blob = self._pending.get((USER_DATA, user_id))
+        if blob is None:
+            row = self.connection.execute("SELECT data FROM user_data WHERE user_id = ?", (user_id,)).fetchone()
+            if row is None:
+                return dict()
+            blob = row[0]
+
+        self._hashes[USER_DATA][user_id] = hash(blob)
+        return pickle.loads(blob)
+
+    def _evict_user_data(self, user_id: int, data: dict):
+        """
+        Write back the user data evicted from the cache
+        :param user_id: user id
+        :param data: user data
+        """
+        self._write(USER_DATA, user_id, data)
+        self._hashes[USER_DATA].pop(user_id, None)
+
+    def get_chat_data(self):
+        """
+        Returns the chat_data
+        :return: defaultdict of chat id -> chat data
+        """
+        with self._lock:
+            if self.chat_data is None:
+                self.chat_data = defaultdict(dict, self._load_rows(CHAT_DATA))
+            return self.chat_data
+
+    def get_bot_data(self):
+        """
+        Returns the bot_data
+        :return: the bot data
+        """
+        with self._lock:
+            if self.bot_data is None:
+                self.bot_data = self._load_rows(BOT_DATA)
+                for key, member in self.connection.execute("SELECT key, member FROM bot_data_members"):
+                    self._members.setdefault(key, set()).add(member)
+                for key, members in self._members.items():
+                    self.bot_data[key] = set(members)
+                for key, value in self.bot_data.items():
+                    if self._is_replaced_key(key):
+                        self._written_values[key] = value
+            return self.bot_data
+
+    def get_conversations(self, name: str):
+        """
+        Returns the conversations
+        :param name: conversation handler name
+        :return: the conversations
+        """
+        with self._lock:
+            if name not in self.conversations:
+                row = self.connection.execute("SELECT data FROM conversations WHERE name = ?", (name,)).fetchone()
+                self.conversations[name] = pickle.loads(row[0]) if row else dict()
+            return self.conversations[name].copy()
+
+    def update_conversation(self, name: str, key, new_state) -> None:
+        """
+        Update a conversation state
+        :param name: conversation handler name
+        :param key: conversation key
+        :param new_state: new state
+        """
+        with self._lock:
+            conversations = self.conversations.setdefault(name, dict())
+            if conversations.get(key) == new_state:
+                return
+            conversations[key] = new_state
+            self._write(CONVERSATIONS, name, conversations)
+
+    def update_user_data(self, user_id: int, data: dict) -> None:
+        """
+        Update the user data row, if changed
+        :param user_id: user id
+        :param data: user data
+        """
+        with self._lock:
+            if self.user_data is not None:
+                self.user_data[user_id] = data
+            self._write(USER_DATA, user_id, data)
+
+    def update_chat_data(self, chat_id: int, data: dict) -> None:
+        """
+        Update the chat data row, if changed
+        :param chat_id: chat id
+        :param data: chat data
+        """
+        with self._lock:
+            if self.chat_data is not None:
+                self.chat_data[chat_id] = data
+            self._write(CHAT_DATA, chat_id, data)
+
+    def update_bot_data(self, data: dict) -> None:
+        """
+        Update the changed bot data rows
+        :param data: bot data
+        """
+        with self._lock:
+            self.bot_data = data
+
+            for key, value in list(data.items()):
+                if key in self._written_values and self._written_values[key] is value:
+                    continue
+
+                if isinstance(value, set) and (key in self._members or is_members_set(value)):
+                    self._write_members(key, value)
+                else:
+                    self._write(BOT_DATA, key, value)
+                if self._is_replaced_key(key):
+                    self._written_values[key] = value
+
+            for key in [key for key in self._members if not isinstance(data.get(key), set)]:
+                self._write_members(key, set())
+                del self._members[key]
+                self._written_values.pop(key, None)
+            # Removed keys and keys now stored as members set
+            for key in [key for key in self._hashes[BOT_DATA] if key not in data or key in self._members]:
+                self._delete(BOT_DATA, key)
+                self._written_values.pop(key, None)
+
+    def _is_replaced_key(self, key):
+        """
+        Return if the bot_data key is replaced, never mutated
+        :param key: bot data key
+        :return: True if the value is replaced, False otherwise
+        """
+        return isinstance(key, str) and key.startswith(self.replaced_key_prefixes)
+
+    def flush(self) -> None:
+        """
+        Commit all pending changes
+        """
+        with self._lock:
+            self._commit()
+
+    def close(self):
+        """
+        Commit all pending changes and close the database
+        """
+        with self._lock:
+            self._commit()
+            self.connection.close()
+
+    def _load_rows(self, table: str):
+        """
+        Load all rows of a table
+        :param table: table
+        :return: dict of key -> unpickled data
+        """
+        rows = dict()
+        for key, blob in self.connection.execute(f"SELECT * FROM {table}"):
+            rows[key] = pickle.loads(blob)
+            self._hashes[table][key] = hash(blob)
+
+        return rows
+
+    def _write(self, table: str, key, value):
+        """
+        Queue the row write, if value is changed since the last write
+        :param table: table
+        :param key: row key
+        :param value: row value
+        """
+        blob = pickle.dumps(value, pickle.HIGHEST_PROTOCOL)
+        blob_hash = hash(blob)
+        if self._hashes[table].get(key) == blob_hash:
+            return
+
+        self._hashes[table][key] = blob_hash
+        self._pending[(table, key)] = blob
+        self._schedule_commit()
+
+    def _delete(self, table: str, key):
+        """
+        Queue the row delete
+        :param table: table
+        :param key: row key
+        """
+        self._hashes[table].pop(key, None)
+        self._pending[(table, key)] = None
+        self._schedule_commit()
+
+    def _write_members(self, key: str, members: set):
+        """
+        Queue the members set changes
+        :param key: bot data key
+        :param members: members set
+        """
+        previous = self._members.get(key, set())
+        if members == previous:
+            return
+
+        added, removed = members - previous, previous - members
+
+        self._members[key] = set(members)
+        self._pending_members.append((key, added, removed))
+        self._schedule_commit()
+
+    def _schedule_commit(self):
+        """
+        Commit when batch is full, otherwise schedule a commit within batch_interval
+        """
+        if len(self._pending) + len(self._pending_members) >= self.batch_size:
+            self._commit()
+        elif self._commit_timer is None:
+            self._commit_timer = threading.Timer(self.batch_interval, self.flush)
+            self._commit_timer.daemon = True
+            self._commit_timer.start()
+
+    def _commit(self):
+        """
+        Write all pending changes in a single transaction
+        """
+        if self._commit_timer is not None:
+            self._commit_timer.cancel()
+            self._commit_timer = None
+
+        if not self._pending and not self._pending_members:
+            return
+
+        start = time.perf_counter()
+        pending, self._pending = self._pending, dict()
+        pending_members, self._pending_members = self._pending_members, list()
+
+        try:
+            with self.connection:
+                self.connection.execute("BEGIN")
+                for (table, key), blob in pending.items():
+                    key_column = table_key_column(table)
+                    if blob is None:
+                        self.connection.execute(f"DELETE FROM {table} WHERE {key_column} = ?", (key,))
+                    else:
+                        self.connection.execute(
+                            f"INSERT OR REPLACE INTO {table} ({key_column}, data) VALUES (?, ?)", (key, blob)
+                        )
+
+                for key, added, removed in pending_members:
+                    self.connection.executemany(
+                        "INSERT OR IGNORE INTO bot_data_members (key, member) VALUES (?, ?)",
+                        [(key, member) for member in added],
+                    )
+                    self.connection.executemany(
+                        "DELETE FROM bot_data_members WHERE key = ? AND member = ?",
+                        [(key, member) for member in removed],
+                    )
+        except Exception:
+            # The transaction is rolled back: the changes are pending again, so the hashes and the members of the
+            # last write still match what will be written, and the next commit retries them
+            self._pending = {**pending, **self._pending}
+            self._pending_members = pending_members + self._pending_members
+            raise
+
+        elapsed = time.perf_counter() - start
+        metrics.PERSISTENCE_FLUSH_DURATION.observe(elapsed, PERSISTENCE_SQLITE)
+        logger.debug(
+            "Committed %s rows and %s member changes in %.3fs",
+            len(pending),
+            len(pending_members),
+            elapsed,
+        )
+
+
+class LazyUserData(defaultdict):
+    """
+    Bounded user data cache.
+    User data is loaded from the database on first access and kept in LRU order, the least recently used user data is
+    written back and evicted when the cache exceeds maxsize.
+    A handler must not keep a user data reference after the update: once evicted, the next access loads a new copy.
+    User data in use (E.g. by the update handlers and the reminder jobs) is pinned: pinned user data is never evicted,
+    so the cache may exceed maxsize by the number of pinned users
+    """
+
+    def __init__(self, persistence: SQLitePersistence, maxsize: int):
+        """
+        Init method
+        :param persistence: SQLite persistence
+        :param maxsize: max cached user data
+        """
+        super().__init__(dict)
+        self.persistence = persistence
+        self.maxsize = maxsize
+        # User id -> pin count
+        self._pins = dict()
+
+    def __getitem__(self, user_id):
+        """
+        Gets the user data, loading it when not cached
+        :param user_id: user id
+        :return: the user data
+        """
+        with self.persistence._lock:
+            try:
+                # Pop and insert again to move the user at the end of LRU order
+                data = dict.pop(self, user_id)
+            except KeyError:
+                data = self.persistence._load_user_data(user_id)
+
+            self.__setitem__(user_id, data)
+            return data
+
+    def __setitem__(self, user_id, data):
+        """
+        Set the user data, evicting the least recently used ones when cache is full
+        :param user_id: user id
+        :param data: user data
+        """
+        with self.persistence._lock:
+            dict.__setitem__(self, user_id, data)
+            self._evict()
+
+    def pin(self, user_ids):
+        """
+        Pin the user data, so it isn't evicted until unpinned. Pins are counted
+        :param user_ids: user ids
+        """
+        with self.persistence._lock:
+            for user_id in user_ids:
+                self._pins[user_id] = self._pins.get(user_id, 0) + 1
+
+    def unpin(self, user_ids):
+        """
+        Release the pins of the user data, evicting the user data exceeding maxsize
+        :param user_ids: user ids
+        """
+        with self.persistence._lock:
+            for user_id in user_ids:
+                count = self._pins.pop(user_id) - 1
+                if count:
+                    self._pins[user_id] = count
+            self._evict()
+
+    def _evict(self):
+        """
+        Evict the least recently used user data not pinned, until the cache fits maxsize
+        """
+        while len(self) > self.maxsize:
+            evicted_id = next((user_id for user_id in self if user_id not in self._pins), None)
+            if evicted_id is None:
+                return
+            self.persistence._evict_user_data(evicted_id, dict.pop(self, evicted_id))
+
+
+@contextlib.contextmanager
+def pinned_user_data(user_data, user_ids):
+    """
+    Context manager pinning the user data in the lazy user data cache while its block runs.
+    No op when user data isn't a lazy cache
+    :param user_data: user data mapping
+    :param user_ids: user ids
+    """
+    if not isinstance(user_data, LazyUserData):
+        yield
+        return
+
+    user_ids = list(user_ids)
+    user_data.pin(user_ids)
+    try:
+        yield
+    finally:
+        user_data.unpin(user_ids)
+
+
+def table_key_column(table: str):
+    """
+    Gets the key column of a table
+    :param table: table
+    :return: the key column
+    """
+    return {USER_DATA: "user_id", CHAT_DATA: "chat_id", BOT_DATA: "key", CONVERSATIONS: "name"}[table]
+
+
+def is_members_set(value):
+    """
+    Return if the value is a set of integers, stored one member per row
+    :param value: value
+    :return: True if value is a set of integers, False otherwise
+    """
+    return isinstance(value, set) and all(isinstance(member, int) for member in value)
+
+
+def migrate_pickle(pickle_filename, persistence: SQLitePersistence):
+    """
+    Migrate the data of a pickle persistence file in the SQLite persistence
+    :param pickle_filename: pickle persistence file
+    :param persistence: SQLite persistence
+    """
+    pickle_persistence = PicklePersistence(filename=pickle_filename)
+
+    for user_id, data in pickle_persistence.get_user_data().items():
+        persistence.update_user_data(user_id, data)
+    for chat_id, data in pickle_persistence.get_chat_data().items():
+        persistence.update_chat_data(chat_id, data)
+    persistence.update_bot_data(pickle_persistence.get_bot_data())
+    for name, conversations in (pickle_persistence.conversations or dict()).items():
+        for key, state in conversations.items():
+            persistence.update_conversation(name, key, state)
+
+    persistence.flush()
+
+    logger.info("Migrated %s in %s", pickle_filename, persistence.filename)
+
+
+def create_persistence(filename, pickle_filename=None, batch_size: int = 100, batch_interval: float = 1.0,
+                       user_data_cache_size: int = 0, replaced_key_prefixes: tuple = ()):
+    """
+    Create the SQLite persistence. When database doesn't exist yet and pickle_filename exists,
+    the pickle data is migrated (one shot). The migration writes a temporary database, moved in place once complete,
+    so an interrupted migration is started again by the next run
+    :param filename: SQLite database file
+    :param pickle_filename: pickle persistence file to migrate
+    :param batch_size: max pending changes before commit
+    :param batch_interval: max seconds before committing pending changes
+    :param user_data_cache_size: max user data kept in memory (0 loads all users at startup)
+    :param replaced_key_prefixes: prefixes of the bot_data keys whose values are replaced, never mutated
+    :return: the SQLite persistence
+    """
+    if not os.path.exists(filename) and pickle_filename and os.path.exists(pickle_filename):
+        migration_filename = filename + MIGRATION_SUFFIX
+        for leftover in (migration_filename, migration_filename + "-wal", migration_filename + "-shm"):
+            if os.path.exists(leftover):
+                os.remove(leftover)
+
+        migration = SQLitePersistence(migration_filename, batch_size, batch_interval, 0, replaced_key_prefixes)
+        migrate_pickle(pickle_filename, migration)
+        # Closing the last connection checkpoints the WAL in the database file
+        migration.close()
+        os.replace(migration_filename, filename)
+
+    return SQLitePersistence(filename, batch_size, batch_interval, user_data_cache_size, replaced_key_prefixes)
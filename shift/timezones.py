@@ -0,0 +1,129 @@
+"""Timezones module."""
+
+import datetime
+import functools
+import logging
+import re
+
+import pytz
+from dateutil import tz
+
+from .constants import USER_TIMEZONE, get_default_timezone
+
+# The job queue scheduler only accepts pytz timezones
+UTC = pytz.utc
+TIMEZONE_NAME_REGEX = re.compile(r"^(UTC|[A-Z][A-Za-z_]+(/[A-Za-z0-9_+-]+)+)$")
+
+logger = logging.getLogger(__name__)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_timezone(name: str):
+    """
+    Gets the timezone, cached by name
+    :param name: IANA timezone name (E.g. Europe/Rome)
+    :return: the timezone, None if name isn't a valid timezone
+    """
+    # gettz also accepts file paths and POSIX TZ strings: only IANA names are valid user timezones
+    if not name or not TIMEZONE_NAME_REGEX.match(name):
+        return None
+
+    return tz.gettz(name)
+
+
+@functools.lru_cache(maxsize=1024)
+def get_conversion_timezone(name: str):
+    """
+    Gets the timezone the times are converted with, cached by name.
+    An invalid name (E.g. a stored timezone no longer known) falls back to the default timezone, then to the system
+    one, logging a warning once per name
+    :param name: IANA timezone name (E.g. Europe/Rome)
+    :return: the timezone, None for the system timezone
+    """
+    timezone = get_timezone(name)
+    if timezone is not None:
+        return timezone
+
+    default = get_default_timezone()
+    timezone = get_timezone(default)
+    if timezone is None:
+        logger.warning("Invalid timezone %r and default timezone %r, using the system timezone", name, default)
+    else:
+        logger.warning("Invalid timezone %r, using the default timezone %s", name, default)
+
+    return timezone
+
+
+def is_valid_timezone(name: str):
+    """
+    Return if the name is a valid timezone
+    :param name: timezone name
+    :return: True if timezone is valid, False otherwise
+    """
+    return get_timezone(name) is not None
+
+
+def user_timezone(user_data: dict):
+    """
+    Gets the timezone name of the user
+    :param user_data: user data
+    :return: the user timezone name (default timezone if user hasn't set it)
+    """
+    return user_data.get(USER_TIMEZONE) or get_default_timezone()
+
+
+@functools.lru_cache(maxsize=None)
+def parse_time(when_time: str):
+    """
+    Parse the HH:MM time
+    :param when_time: time in HH:MM format
+    :return: the time
+    """
+    hour, minute = when_time.split(":")
+    return datetime.time(int(hour), int(minute))
+
+
+@functools.lru_cache(maxsize=4096)
+def local_to_utc(date: datetime.date, when_time: str, timezone: str):
+    """
+    Convert a local wall time to UTC, with the offset of the given date.
+    A wall time skipped by a DST transition is moved forward by the transition, an ambiguous one resolves to its
+    first occurrence
+    :param date: local date
+    :param when_time: local time in HH:MM format
+    :param timezone: timezone name
+    :return: the UTC instant
+    """
+    local = datetime.datetime.combine(date, parse_time(when_time), tzinfo=get_conversion_timezone(timezone))
+    local = tz.resolve_imaginary(local)
+    return local.astimezone(UTC)
+
+
+def next_weekly_time(weekday: int, when_time: str, timezone: str, after: datetime.datetime = None):
+    """
+    Gets the next instant of a weekly local time. Every instant is computed with the offset of its own date, so the
+    result follows the DST transitions
+    :param weekday: local weekday (0 is Monday)
+    :param when_time: local time in HH:MM format
+    :param timezone: timezone name
+    :param after: UTC instant after which the result must be (now if not filled)
+    :return: the next UTC instant
+    """
+    after = after or datetime.datetime.now(UTC)
+    local_date = after.astimezone(get_conversion_timezone(timezone)).date()
+    date = local_date + datetime.timedelta(days=(weekday - local_date.weekday()) % 7)
+
+    instant = local_to_utc(date, when_time, timezone)
+    if instant <= after:
+        instant = local_to_utc(date + datetime.timedelta(weeks=1), when_time, timezone)
+
+    return instant
+
+
+def local_now(timezone: str):
+    """
+    Gets the current local time of the timezone
+    :param timezone: timezone name
+    :return: the naive local datetime
+    """
+    return datetime.datetime.now(get_conversion_timezone(timezone)).replace(tzinfo=None)
@@ -0,0 +1,139 @@
+"""User index module."""
+
+import threading
+
+USER_INDEX_VERSION = "user_index_version"
+USER_INDEX_CURRENT_VERSION = 1
+USER_INDEX_KEY_PREFIX = "user_index "
+USERS_KEY = USER_INDEX_KEY_PREFIX + "users"
+GROUP_KEY_PREFIX = USER_INDEX_KEY_PREFIX + "group "
+
+
+class UserIndex:
+    """
+    Index of known users and group -> users inverted index.
+    The index is kept in the store (E.g. bot_data), so it's persisted together with the other data and it's built from
+    the user data only when the store has no index (or an old version), then it's kept updated on every login/logout.
+    Known users and the users of every group are sets of user ids with a key each. Sets are replaced, never mutated,
+    so the persistence can serialise them while they're updated and can skip the sets still bound to the object it
+    last wrote (see SQLitePersistence replaced_key_prefixes)
+    """
+
+    def __init__(self):
+        """
+        Init method
+        """
+        self.store = dict()
+        self.user_groups = dict()
+        self._lock = threading.Lock()
+
+    def __contains__(self, user_id):
+        """
+        Return if user is known
+        :param user_id: user id
+        :return: True if user is known, False otherwise
+        """
+        return user_id in self.store.get(USERS_KEY, ())
+
+    def __len__(self):
+        """
+        Number of known users
+        :return: number of known users
+        """
+        return len(self.store.get(USERS_KEY, ()))
+
+    def load(self, store: dict):
+        """
+        Load the index of the store
+        :param store: mapping where the index is stored
+        :return: True if the index is loaded, False if the store has no index (or an old version) and it must be built
+        """
+        with self._lock:
+            self.store = store
+            self.user_groups = dict()
+            if store.get(USER_INDEX_VERSION) != USER_INDEX_CURRENT_VERSION:
+                return False
+
+            for key, users in store.items():
+                if isinstance(key, str) and key.startswith(GROUP_KEY_PREFIX):
+                    group = key[len(GROUP_KEY_PREFIX):]
+                    for user_id in users:
+                        self.user_groups[user_id] = group
+
+            return True
+
+    def build(self, users, group_key: str, store: dict = None):
+        """
+        Build the index, replacing the index of the store
+        :param users: iterable of (user id, user data)
+        :param group_key: user data key of the user group
+        :param store: mapping where the index is stored (the loaded one if not filled)
+        """
+        with self._lock:
+            if store is not None:
+                self.store = store
+            for key in [key for key in self.store if isinstance(key, str) and key.startswith(USER_INDEX_KEY_PREFIX)]:
+                del self.store[key]
+            self.user_groups = dict()
+
+            known_users = set()
+            group_users = dict()
+            for user_id, user_data in users:
+                known_users.add(user_id)
+                group = user_data.get(group_key)
+                if group is not None:
+                    self.user_groups[user_id] = group
+                    group_users.setdefault(group, set()).add(user_id)
+
+            self.store[USERS_KEY] = known_users
+            for group, members in group_users.items():
+                self.store[GROUP_KEY_PREFIX + group] = members
+            self.store[USER_INDEX_VERSION] = USER_INDEX_CURRENT_VERSION
+
+    def add_user(self, user_id: int):
+        """
+        Add a known user
+        :param user_id: user id
+        """
+        if user_id in self:
+            return
+
+        with self._lock:
+            self.store[USERS_KEY] = self.store.get(USERS_KEY, set()) | {user_id}
+
+    def set_group(self, user_id: int, group):
+        """
+        Set the user group (None on logout)
+        :param user_id: user id
+        :param group: group
+        """
+        with self._lock:
+            previous = self.user_groups.pop(user_id, None)
+            if previous is not None:
+                members = self.store.get(GROUP_KEY_PREFIX + previous, set()) - {user_id}
+                if members:
+                    self.store[GROUP_KEY_PREFIX + previous] = members
+                else:
+                    self.store.pop(GROUP_KEY_PREFIX + previous, None)
+
+            if group is not None:
+                self.user_groups[user_id] = group
+                self.store[GROUP_KEY_PREFIX + group] = self.store.get(GROUP_KEY_PREFIX + group, set()) | {user_id}
+
+    def get_users(self):
+        """
+        Gets the known users
+        :return: list of user ids, in user id order
+        """
+        return sorted(self.store.get(USERS_KEY, ()))
+
+    def get_group_users(self, group):
+        """
+        Gets the users of a group
+        :param group: group
+        :return: list of user ids
+        """
+        return list(self.store.get(GROUP_KEY_PREFIX + group, ()))
+
+
+user_index = UserIndex()
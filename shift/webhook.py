@@ -0,0 +1,152 @@
+"""Webhook module."""
+
+import hmac
+import json
+import logging
+import threading
+from http import HTTPStatus
+from queue import Full, Queue
+
+from telegram import Bot, Update
+from telegram.ext import Updater
+
+from .httpserver import BackgroundHTTPServer, BackgroundRequestHandler
+
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+MAX_BODY_SIZE = 1024 * 1024
+
+logger = logging.getLogger(__name__)
+
+
+class WebhookRequestHandler(BackgroundRequestHandler):
+    """
+    Webhook request handler.
+    Valid updates are put in the update queue without waiting: when queue is full the request is refused with
+    503, so Telegram retries it later (backpressure)
+    """
+
+    server: "WebhookServer"
+
+    def do_POST(self):
+        """
+        Handle the update POST
+        """
+        if self.path != self.server.path:
+            self.send_response_only(HTTPStatus.NOT_FOUND)
+            self.end_headers()
+            return
+
+        secret_token = self.server.secret_token
+        if secret_token and not hmac.compare_digest(self.headers.get(SECRET_TOKEN_HEADER, ""), secret_token):
+            logger.warning("Webhook request with invalid secret token from %s", self.client_address[0])
+            self.send_response_only(HTTPStatus.FORBIDDEN)
+            self.end_headers()
+            return
+
+        try:
+            length = int(self.headers.get("Content-Length", ""))
+        except ValueError:
+            length = -1
+
+        if length < 0 or length > MAX_BODY_SIZE:
+            self.send_response_only(HTTPStatus.REQUEST_ENTITY_TOO_LARGE if length > 0 else HTTPStatus.LENGTH_REQUIRED)
+            self.end_headers()
+            return
+
+        try:
+            data = json.loads(self.rfile.read(length))
+            if not isinstance(data, dict):
+                raise ValueError("Update must be an object")
+            update = Update.de_json(data, self.server.bot)
+        except (ValueError, TypeError, KeyError) as e:
+            logger.warning("Invalid webhook update: %s", e)
+            self.send_response_only(HTTPStatus.BAD_REQUEST)
+            self.end_headers()
+            return
+
+        try:
+            self.server.update_queue.put_nowait(update)
+        except Full:
+            logger.warning("Update queue is full, update %s refused", update.update_id)
+            self.send_response_only(HTTPStatus.SERVICE_UNAVAILABLE)
+            self.end_headers()
+            return
+
+        self.send_response_only(HTTPStatus.OK)
+        self.end_headers()
+
+
+class WebhookServer(BackgroundHTTPServer):
+    """
+    Webhook HTTP listener feeding the dispatcher update queue.
+    The updater stop shuts it down before stopping the dispatcher, so no update is accepted while the dispatcher
+    drains the queued ones
+    """
+
+    name = "webhook"
+    logger = logger
+
+    def __init__(self, host: str, port: int, path: str, secret_token: str, bot: Bot, update_queue: Queue):
+        """
+        Init method
+        :param host: listen host
+        :param port: listen port (0 to pick a free port)
+        :param path: webhook path
+        :param secret_token: secret token checked on every request (None to disable the check)
+        :param bot: bot used to decode updates
+        :param update_queue: update queue
+        """
+        super().__init__(host, port, WebhookRequestHandler)
+        self.path = path
+        self.secret_token = secret_token
+        self.bot = bot
+        self.update_queue = update_queue
+
+    def start(self):
+        """
+        Serve requests in a background thread
+        """
+        super().start()
+
+        logger.info("Webhook listening on %s:%s%s", *self.server_address[:2], self.path)
+
+
+def start_webhook(updater: Updater, url: str, host: str, port: int, path: str, secret_token: str = None,
+                  queue_size: int = 0):
+    """
+    Start the updater in webhook mode: job queue, dispatcher and webhook listener are started and the webhook is
+    registered to Telegram
+    :param updater: updater
+    :param url: public webhook URL registered to Telegram (None to skip the registration)
+    :param host: listen host
+    :param port: listen port
+    :param path: webhook path
+    :param secret_token: secret token
+    :param queue_size: max queued updates (0 for unbounded queue)
+    :return: the webhook server
+    """
+    # Bounded queue, shared by the listener and the dispatcher
+    updater.update_queue = updater.dispatcher.update_queue = Queue(maxsize=queue_size)
+
+    server = WebhookServer(host, port, path, secret_token, updater.bot, updater.update_queue)
+
+    dispatcher_ready = threading.Event()
+    updater.running = True
+    updater.job_queue.start()
+    threading.Thread(
+        target=updater.dispatcher.start,
+        kwargs={"ready": dispatcher_ready},
+        name="dispatcher",
+        daemon=True,
+    ).start()
+    dispatcher_ready.wait()
+
+    server.start()
+    # Stopped by the updater stop as its own webhook listener, before the dispatcher
+    updater.httpd = server
+
+    if url:
+        api_kwargs = {"secret_token": secret_token} if secret_token else None
+        updater.bot.set_webhook(url=url, api_kwargs=api_kwargs)
+
+    return server
@@ -0,0 +1,96 @@
+"""Broadcast campaign tests."""
+
+import threading
+from types import SimpleNamespace
+
+import pytest
+from telegram.error import Unauthorized
+
+from shift import broadcast
+from shift.userindex import user_index
+
+USERS = [101, 102, 103, 104, 105]
+
+
+class FakeBot:
+    def __init__(self, blocked=()):
+        self.blocked = set(blocked)
+        self.sent = []
+        self._lock = threading.Lock()
+
+    def send_message(self, chat_id, text, **kwargs):
+        if chat_id in self.blocked:
+            raise Unauthorized("blocked")
+        with self._lock:
+            self.sent.append((chat_id, text))
+        return SimpleNamespace(edit_text=lambda text: None)
+
+
+class FakePersistence:
+    store_bot_data = True
+
+    def __init__(self):
+        self.bot_data = []
+
+    def update_bot_data(self, data):
+        self.bot_data.append(dict(data))
+
+
+@pytest.fixture(autouse=True)
+def users(monkeypatch):
+    monkeypatch.setenv("BROADCAST_RATE", "1000")
+    user_index.build(((user_id, dict()) for user_id in USERS), "group")
+    yield
+    user_index.build((), "group")
+
+
+def campaign_state(cursor=0, sent=0):
+    return {
+        broadcast.CAMPAIGN_ID: "c",
+        broadcast.ADMIN_CHAT_ID: 1,
+        broadcast.TEXT: "ciao",
+        broadcast.CURSOR: cursor,
+        broadcast.SENT: sent,
+        broadcast.FAILED: 0,
+        broadcast.BLOCKED: 0,
+    }
+
+
+def dispatcher(bot):
+    return SimpleNamespace(bot=bot, bot_data=dict(), persistence=FakePersistence())
+
+
+def test_campaign_sends_to_all_users_and_clears_the_state():
+    bot = FakeBot(blocked=[103])
+    campaign = broadcast.BroadcastCampaign(dispatcher(bot), campaign_state())
+    campaign.run()
+
+    assert sorted(chat_id for chat_id, text in bot.sent if text == "ciao") == [101, 102, 104, 105]
+    assert (campaign.state[broadcast.SENT], campaign.state[broadcast.BLOCKED]) == (4, 1)
+    assert broadcast.BROADCAST_CAMPAIGN not in campaign.dispatcher.bot_data
+    assert broadcast.BROADCAST_CAMPAIGN not in campaign.dispatcher.persistence.bot_data[-1]
+
+
+def test_resume_rebuilds_recipients_from_cursor():
+    bot = FakeBot()
+    campaign = broadcast.BroadcastCampaign(dispatcher(bot), campaign_state(103, 2))
+    campaign.run()
+
+    assert sorted(chat_id for chat_id, text in bot.sent if text == "ciao") == [103, 104, 105]
+    assert campaign.state[broadcast.SENT] == 5
+
+
+def test_checkpoint_stores_only_the_cursor():
+    bot = FakeBot()
+    campaign = broadcast.BroadcastCampaign(dispatcher(bot), campaign_state())
+    pending = threading.BoundedSemaphore(2)
+    for index in (1, 0):
+        pending.acquire()
+        future = SimpleNamespace(result=lambda: broadcast.SEND_SENT)
+        campaign._complete(index, future, pending)
+    campaign._checkpoint(force=True)
+
+    stored = campaign.dispatcher.bot_data[broadcast.BROADCAST_CAMPAIGN]
+    assert stored == {**campaign.state, broadcast.CURSOR: 103, broadcast.SENT: 2}
+    assert stored is not campaign.state
+    assert set(stored) == set(campaign_state())
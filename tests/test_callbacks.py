@@ -0,0 +1,91 @@
+"""Signed callback data tests."""
+
+import time
+from types import SimpleNamespace
+
+import pytest
+
+from shift import bot, helpers
+from shift.constants import CALLBACK_DEFAULT_TTL, ENABLED_USERS, get_callback_ttl
+from shift.helpers import get_callback_key, sign_callback_data, verify_callback_data
+
+USER_ID = 123456789
+ADMIN_ID = 42
+
+
+@pytest.fixture(autouse=True)
+def callback_secret(monkeypatch):
+    monkeypatch.setenv("CALLBACK_SECRET", "test")
+    monkeypatch.delenv("CALLBACK_TTL", raising=False)
+    get_callback_key.cache_clear()
+    yield
+    get_callback_key.cache_clear()
+
+
+def test_missing_secret_is_refused(monkeypatch):
+    monkeypatch.delenv("CALLBACK_SECRET")
+    monkeypatch.delenv("TELEGRAM_TOKEN", raising=False)
+    get_callback_key.cache_clear()
+
+    with pytest.raises(ValueError):
+        get_callback_key()
+
+
+def test_token_is_the_default_secret(monkeypatch):
+    data = sign_callback_data(USER_ID, "action", "1")
+    monkeypatch.delenv("CALLBACK_SECRET")
+    monkeypatch.setenv("TELEGRAM_TOKEN", "test")
+    get_callback_key.cache_clear()
+
+    assert verify_callback_data(data, USER_ID)
+
+
+def test_signature_is_bound_to_user_and_data():
+    data = sign_callback_data(USER_ID, "action", "1")
+
+    assert verify_callback_data(data, USER_ID, get_callback_ttl())
+    assert not verify_callback_data(data, USER_ID + 1)
+    assert not verify_callback_data(data.replace("#1.", "#2."), USER_ID)
+    assert not verify_callback_data("action#1", USER_ID)
+
+
+def test_expired_data_is_refused(monkeypatch):
+    data = sign_callback_data(USER_ID, "action")
+    now = time.time()
+    monkeypatch.setattr(helpers.time, "time", lambda: now + CALLBACK_DEFAULT_TTL + 1)
+
+    assert get_callback_ttl() == 7 * 24 * 60 * 60
+    assert not verify_callback_data(data, USER_ID, get_callback_ttl())
+    assert verify_callback_data(data, USER_ID)
+
+
+def approve_update(data):
+    message = SimpleNamespace(
+        text_html=f"L'utente <pre>{USER_ID}</pre> ha richiesto l'utilizzo",
+        text_markdown=f"L'utente ```{USER_ID}``` ha richiesto l'utilizzo",
+    )
+    query = SimpleNamespace(data=data, answer=lambda: None, edit_message_text=lambda **kwargs: None)
+    return SimpleNamespace(
+        callback_query=query,
+        effective_user=SimpleNamespace(id=ADMIN_ID),
+        effective_message=message,
+        message=None,
+    )
+
+
+@pytest.mark.parametrize("expired", [False, True])
+def test_approve_callback_checks_the_ttl(monkeypatch, expired):
+    data = sign_callback_data(ADMIN_ID, bot.APPROVE_CALLBACK)
+    if expired:
+        now = time.time()
+        monkeypatch.setattr(helpers.time, "time", lambda: now + CALLBACK_DEFAULT_TTL + 1)
+
+    sent = []
+    context = SimpleNamespace(
+        bot_data={bot.PENDING_APPROVAL: {USER_ID: None}, ENABLED_USERS: set()},
+        bot=SimpleNamespace(send_message=lambda **kwargs: sent.append(kwargs["chat_id"])),
+    )
+    bot.approve_callback(approve_update(data), context)
+
+    assert (USER_ID in context.bot_data[ENABLED_USERS]) is not expired
+    assert sent == ([] if expired else [USER_ID])
@@ -0,0 +1,102 @@
+"""Concurrent update processing tests."""
+
+import threading
+from queue import Queue
+
+import pytest
+from telegram import Bot
+
+from shift import concurrency
+from shift.sqlitepersistence import SQLitePersistence
+
+
+@pytest.fixture
+def persistence(tmp_path):
+    persistence = SQLitePersistence(str(tmp_path / "data.sqlite"))
+    yield persistence
+    persistence.close()
+
+
+@pytest.fixture
+def dispatcher(persistence):
+    concurrency.pop_changed_user_ids()
+    return concurrency.UserDataDispatcher(Bot("123456:TEST"), Queue(), persistence=persistence)
+
+
+def test_job_persistence_writes_only_changed_users(dispatcher, persistence, monkeypatch):
+    for user_id in range(10):
+        dispatcher.user_data[user_id]["value"] = user_id
+        persistence.update_user_data(user_id, dispatcher.user_data[user_id])
+
+    written = []
+    update_user_data = persistence.update_user_data
+    monkeypatch.setattr(
+        persistence,
+        "update_user_data",
+        lambda user_id, data: written.append(user_id) or update_user_data(user_id, data),
+    )
+
+    # Idle job run
+    dispatcher.update_persistence()
+
+    assert written == []
+
+    with concurrency.user_lock(3):
+        dispatcher.user_data[3]["value"] = 30
+        concurrency.mark_user_data_changed(3)
+    dispatcher.bot_data["key"] = "value"
+    dispatcher.update_persistence()
+    persistence.flush()
+
+    assert written == [3]
+    assert persistence.connection.execute("SELECT COUNT(*) FROM user_data").fetchone()[0] == 10
+    assert persistence.connection.execute("SELECT COUNT(*) FROM bot_data").fetchone()[0] == 1
+
+    # Marks are consumed by the write
+    written.clear()
+    dispatcher.update_persistence()
+
+    assert written == []
+
+
+def test_flooding_key_doesnt_block_other_keys():
+    executor = concurrency.UserSerialExecutor(workers=2, max_pending=2, max_pending_per_key=3)
+    release = threading.Event()
+    done = []
+
+    def task(key, index):
+        if index == 0:
+            release.wait(5)
+        done.append((key, index))
+
+    submitted = [executor.submit(1, task, 1, index) for index in range(10)]
+
+    # The running task and the waiting ones of key 1 take a single slot, the tasks over the cap are dropped
+    assert submitted == [True] * 4 + [False] * 6
+
+    served = threading.Event()
+    assert executor.submit(2, lambda: served.set())
+    assert served.wait(5)
+
+    release.set()
+    executor.shutdown()
+
+    assert [index for key, index in done if key == 1] == [0, 1, 2, 3]
+
+
+def test_submit_waits_when_all_slots_are_busy():
+    executor = concurrency.UserSerialExecutor(workers=1, max_pending=1)
+    release = threading.Event()
+    executor.submit(1, release.wait, 5)
+
+    submitter = threading.Thread(target=executor.submit, args=(2, lambda: None))
+    submitter.start()
+    submitter.join(0.2)
+
+    assert submitter.is_alive()
+
+    release.set()
+    submitter.join(5)
+    executor.shutdown()
+
+    assert not submitter.is_alive()
@@ -0,0 +1,107 @@
+"""Incremental JSON reader and streaming shifts parser tests."""
+
+import datetime
+import io
+import json
+
+import pytest
+
+from shift import shiftsheduling
+from shift.jsonstream import JsonStream
+
+MONDAY = datetime.date(2026, 10, 19)
+
+
+def walk(stream: JsonStream):
+    """
+    Decode the next value through the walk methods, descending in every object and array
+    """
+    if stream.peek() == "{":
+        return {key: walk(stream) for key in stream.items()}
+    if stream.peek() == "[":
+        return [walk(stream) for _ in stream.elements()]
+    return stream.value()
+
+
+DOCUMENT = {
+    "groups": [
+        {"name": "a", "shifts": [{"date": "2026-10-19", "presence": True}], "note": "x" * 100},
+        {"name": "b", "count": 1234567890123, "ratio": -1.5e-3, "empty": {}, "list": [], "none": None},
+    ],
+    "version": 2,
+}
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 7, 64 * 1024])
+def test_walk_matches_json_load(chunk_size):
+    stream = JsonStream(io.StringIO(json.dumps(DOCUMENT, indent=2)), chunk_size)
+
+    assert walk(stream) == DOCUMENT
+    assert stream.peek() == ""
+
+
+@pytest.mark.parametrize("chunk_size", [1, 2, 3, 4, 5])
+def test_numbers_split_by_chunk_boundary(chunk_size):
+    stream = JsonStream(io.StringIO("[1234567, -1.5e-3, 2E+10, 89]"), chunk_size)
+
+    assert walk(stream) == [1234567, -1.5e-3, 2E+10, 89]
+
+
+def test_value_skips_unrequested_members():
+    stream = JsonStream(io.StringIO('{"skip": {"a": [1, 2, {"b": "}"}]}, "keep": "value"}'), 4)
+
+    values = dict()
+    for key in stream.items():
+        if key == "keep":
+            values[key] = stream.value()
+        else:
+            stream.value()
+
+    assert values == {"keep": "value"}
+
+
+@pytest.mark.parametrize("document", ['{"a" 1}', '{"a": 1 "b": 2}', "[1 2]", '{"a": [1, }', "{1: 2}"])
+def test_invalid_document(document):
+    with pytest.raises(ValueError):
+        walk(JsonStream(io.StringIO(document), 2))
+
+
+def test_stream_parser_matches_json_parser(tmp_path):
+    file = tmp_path / "shifts.json"
+    file.write_text(json.dumps({
+        "version": 1,
+        "groups": [
+            # Shifts and rules before the group name
+            {
+                "shifts": [{"date": MONDAY.isoformat(), "presence": True}],
+                "rules": [{"weekdays": [4], "presence": False}],
+                "name": "a",
+            },
+            {"name": "b", "shifts": [{"date": (MONDAY + datetime.timedelta(days=1)).isoformat(), "presence": False}]},
+        ],
+    }))
+
+    streamed = shiftsheduling.parse_shifts(file, streaming=True)
+    loaded = shiftsheduling.parse_shifts(file, streaming=False)
+
+    assert list(streamed) == list(loaded) == ["a", "b"]
+    for days in range(7):
+        date = MONDAY + datetime.timedelta(days=days)
+        for name in ("a", "b"):
+            assert streamed.get(name, date) == loaded.get(name, date)
+    assert streamed.get("a", MONDAY + datetime.timedelta(days=4)) == 0
+
+
+@pytest.mark.parametrize("document", [
+    {"version": 1},
+    {"groups": {}},
+    {"groups": [{"shifts": []}]},
+    {"groups": [{"name": "a", "shifts": {}}]},
+    {"groups": [{"name": "a", "shifts": [{"date": "2026-10-19"}]}]},
+])
+def test_stream_parser_rejects_invalid_file(tmp_path, document):
+    file = tmp_path / "shifts.json"
+    file.write_text(json.dumps(document))
+
+    with pytest.raises(ValueError):
+        shiftsheduling.parse_shifts(file, streaming=True)
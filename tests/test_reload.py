@@ -0,0 +1,115 @@
+"""Shifts hot reload tests."""
+
+import datetime
+import json
+import os
+from types import SimpleNamespace
+
+import pytest
+
+from shift import bot, outbound, shiftsheduling
+from shift.constants import USER_GROUP
+from shift.shiftstore import NO_SHIFT, ShiftStore
+from shift.userindex import UserIndex
+
+MONDAY = datetime.date(2026, 10, 19)
+
+
+@pytest.fixture(autouse=True)
+def shift_store(monkeypatch):
+    monkeypatch.setattr(shiftsheduling, "shift_store", ShiftStore())
+    monkeypatch.setattr(shiftsheduling, "shifts_file_signature", None)
+    monkeypatch.setenv("SHIFTS_STREAMING", "")
+
+
+def write_shifts(file, groups, mtime_ns=None):
+    with open(file, "w") as f:
+        json.dump({"groups": groups}, f)
+
+    if mtime_ns is not None:
+        os.utime(file, ns=(mtime_ns, mtime_ns))
+
+
+def group(name, presence, date=MONDAY):
+    return {"name": name, "shifts": [{"date": date.isoformat(), "presence": presence}]}
+
+
+def test_reload_swaps_changed_file(tmp_path):
+    file = tmp_path / "shifts.json"
+    write_shifts(file, [group("a", True)], 1_000_000_000)
+    shiftsheduling.load_shifts(file)
+    loaded = shiftsheduling.shift_store
+
+    write_shifts(file, [group("a", False), group("b", True)], 2_000_000_000)
+    old_store = shiftsheduling.reload_shifts(file)
+
+    assert old_store is loaded
+    assert shiftsheduling.shift_store is not loaded
+    assert shiftsheduling.shift_store.generation == loaded.generation + 1
+    assert shiftsheduling.shift_store.get("a", MONDAY) == 0
+    assert shiftsheduling.shift_store.get("b", MONDAY) == 1
+    assert shiftsheduling.get_shift_changes(old_store, MONDAY, 7) == {
+        "a": [(MONDAY, shiftsheduling.ShiftType.PRESENCE, shiftsheduling.ShiftType.SMART_WORKING)],
+        "b": [(MONDAY, None, shiftsheduling.ShiftType.PRESENCE)],
+    }
+
+
+def test_reload_skips_unchanged_file(tmp_path):
+    file = tmp_path / "shifts.json"
+    write_shifts(file, [group("a", True)])
+    shiftsheduling.load_shifts(file)
+    loaded = shiftsheduling.shift_store
+
+    assert shiftsheduling.reload_shifts(file) is None
+    assert shiftsheduling.shift_store is loaded
+
+
+def test_reload_keeps_previous_store_on_invalid_file(tmp_path):
+    file = tmp_path / "shifts.json"
+    write_shifts(file, [group("a", True)], 1_000_000_000)
+    shiftsheduling.load_shifts(file)
+    loaded = shiftsheduling.shift_store
+
+    write_shifts(file, [{"name": "a", "shifts": [{"date": MONDAY.isoformat(), "presence": "yes"}]}], 2_000_000_000)
+
+    assert shiftsheduling.reload_shifts(file) is None
+    assert shiftsheduling.shift_store is loaded
+    assert shiftsheduling.shift_store.get("a", MONDAY) == 1
+
+    # The invalid file isn't parsed again until it changes
+    signature = shiftsheduling.shifts_file_signature
+    assert shiftsheduling.reload_shifts(file) is None
+    assert shiftsheduling.shifts_file_signature == signature
+
+    write_shifts(file, [group("a", False)], 3_000_000_000)
+
+    assert shiftsheduling.reload_shifts(file) is loaded
+    assert shiftsheduling.shift_store.get("a", MONDAY) == 0
+
+
+def test_reload_keeps_previous_store_on_missing_file(tmp_path):
+    file = tmp_path / "shifts.json"
+    write_shifts(file, [group("a", True)])
+    shiftsheduling.load_shifts(file)
+    loaded = shiftsheduling.shift_store
+    os.remove(file)
+
+    assert shiftsheduling.reload_shifts(file) is None
+    assert shiftsheduling.shift_store is loaded
+    assert shiftsheduling.shift_store.get("a", MONDAY + datetime.timedelta(days=1)) == NO_SHIFT
+
+
+def test_shift_changes_are_sent_with_bulk_priority(monkeypatch):
+    index = UserIndex()
+    index.build({1: {USER_GROUP: "a"}, 2: {USER_GROUP: "b"}, 3: {USER_GROUP: "a"}}.items(), USER_GROUP, dict())
+    monkeypatch.setattr(bot, "user_index", index)
+    sent = []
+    send_bot = SimpleNamespace(
+        send_message=lambda chat_id, text: sent.append((chat_id, outbound.current_priority(), text))
+    )
+
+    bot.notify_shift_changes(send_bot, {"a": [(MONDAY, None, shiftsheduling.ShiftType.PRESENCE)]})
+
+    assert sorted(chat_id for chat_id, _, _ in sent) == [1, 3]
+    assert {priority for _, priority, _ in sent} == {outbound.BULK}
+    assert sent[0][2].endswith(f"Nessun turno 😢 ➡ {shiftsheduling.ShiftType.PRESENCE.formatted}")
@@ -0,0 +1,274 @@
+"""Reminder engine tests."""
+
+import datetime
+from types import SimpleNamespace
+
+import pytest
+
+from shift import notifications
+from shift.constants import get_default_timezone
+from shift.reminders import REMINDER_CHUNK_SIZE, SLOT_KEY_PREFIX, ReminderEngine, slot_key, slot_of_key
+from shift.sqlitepersistence import SQLitePersistence
+from shift.timezones import get_timezone, next_weekly_time
+
+TIMEZONE = "Europe/Rome"
+
+
+class FakeJob:
+    def __init__(self, callback, when, context, name):
+        self.callback = callback
+        self.when = when
+        self.context = context
+        self.name = name
+        self.removed = False
+
+    def schedule_removal(self):
+        self.removed = True
+
+
+class FakeJobQueue:
+    def __init__(self):
+        self.jobs = []
+
+    def run_once(self, callback, when, context=None, name=None):
+        job = FakeJob(callback, when, context, name)
+        self.jobs.append(job)
+        return job
+
+    def pending(self):
+        return [job for job in self.jobs if not job.removed]
+
+
+@pytest.fixture
+def fired():
+    return []
+
+
+@pytest.fixture
+def engine(fired):
+    def reminder_callback(bot, reminders):
+        fired.append((bot, list(reminders)))
+
+    user_data = {1: {"name": "one"}, 2: {"name": "two"}}
+    return ReminderEngine(FakeJobQueue(), user_data, reminder_callback, next_weekly_time, dict())
+
+
+def fire(engine: ReminderEngine, job: FakeJob):
+    job.callback(SimpleNamespace(job=job, bot="bot"))
+
+
+def test_slot_key_round_trip():
+    slot = (3, "08:30", TIMEZONE)
+
+    assert slot_of_key(slot_key(slot)) == slot
+
+
+def test_add_stores_a_copy_in_every_slot(engine):
+    schedule_data = {"days": [0, 2]}
+    engine.add(1, "a", schedule_data, [0, 2], "08:00", TIMEZONE)
+    schedule_data["days"].append(4)
+
+    assert len(engine) == 2
+    assert engine.store == {
+        slot_key((0, "08:00", TIMEZONE)): {(1, "a"): {"days": [0, 2]}},
+        slot_key((2, "08:00", TIMEZONE)): {(1, "a"): {"days": [0, 2]}},
+    }
+    # Slots aren't armed before arm()
+    assert not engine.job_queue.jobs
+
+
+def test_add_replaces_the_slot_dict(engine):
+    engine.add(1, "a", {}, [0], "08:00", TIMEZONE)
+    subscribers = engine.store[slot_key((0, "08:00", TIMEZONE))]
+    engine.add(2, "a", {}, [0], "08:00", TIMEZONE)
+
+    assert subscribers == {(1, "a"): {}}
+    assert engine.store[slot_key((0, "08:00", TIMEZONE))] == {(1, "a"): {}, (2, "a"): {}}
+
+
+def test_arm_schedules_one_job_per_slot(engine):
+    engine.add(1, "a", {}, [0], "08:00", TIMEZONE)
+    engine.add(2, "a", {}, [0], "08:00", TIMEZONE)
+    engine.add(2, "b", {}, [1], "09:00", TIMEZONE)
+    engine.arm()
+
+    jobs = engine.job_queue.pending()
+    assert sorted(job.name for job in jobs) == [slot_key((0, "08:00", TIMEZONE)), slot_key((1, "09:00", TIMEZONE))]
+    now = datetime.datetime.now(datetime.timezone.utc)
+    for job in jobs:
+        slot, when = job.context
+        assert job.when == when
+        assert now < when <= now + datetime.timedelta(weeks=1)
+        assert when.astimezone(datetime.timezone.utc).weekday() == slot[0]
+
+    # Slots added after arm() are armed immediately
+    engine.add(1, "c", {}, [5], "10:00", TIMEZONE)
+
+    assert len(engine.job_queue.pending()) == 3
+
+
+def test_remove_drops_the_job_of_empty_slot(engine):
+    engine.add(1, "a", {}, [0], "08:00", TIMEZONE)
+    engine.add(2, "a", {}, [0], "08:00", TIMEZONE)
+    engine.arm()
+    (job,) = engine.job_queue.pending()
+
+    engine.remove(1, "a", [0], "08:00", TIMEZONE)
+
+    assert not job.removed
+    assert engine.store[slot_key((0, "08:00", TIMEZONE))] == {(2, "a"): {}}
+
+    engine.remove(2, "a", [0], "08:00", TIMEZONE)
+    # Removing a missing reminder is a no op
+    engine.remove(2, "a", [0], "08:00", TIMEZONE)
+
+    assert job.removed
+    assert not engine.store
+    assert len(engine) == 0
+
+
+def test_fire_notifies_subscribers_and_rearms(engine, fired):
+    engine.add(1, "a", {"key": "a"}, [0], "08:00", TIMEZONE)
+    engine.add(2, "b", {"key": "b"}, [0], "08:00", TIMEZONE)
+    engine.arm()
+    (job,) = engine.job_queue.pending()
+
+    fire(engine, job)
+
+    assert fired == [("bot", [
+        (1, {"name": "one"}, {"key": "a"}),
+        (2, {"name": "two"}, {"key": "b"}),
+    ])]
+
+    next_job = engine.job_queue.jobs[-1]
+    assert next_job is not job
+    assert engine.jobs[(0, "08:00", TIMEZONE)] is next_job
+    # Same local time a week later, also across a DST transition
+    fired_local = job.context[1].astimezone(get_timezone(TIMEZONE))
+    next_local = next_job.context[1].astimezone(get_timezone(TIMEZONE))
+    assert next_local.date() - fired_local.date() == datetime.timedelta(weeks=1)
+    assert next_local.strftime("%H:%M") == fired_local.strftime("%H:%M") == "08:00"
+
+
+def test_fire_of_replaced_job_doesnt_rearm(engine, fired):
+    engine.add(1, "a", {}, [0], "08:00", TIMEZONE)
+    engine.arm()
+    (job,) = engine.job_queue.pending()
+    engine.remove(1, "a", [0], "08:00", TIMEZONE)
+
+    fire(engine, job)
+
+    assert fired == [("bot", [])]
+    assert len(engine.job_queue.jobs) == 1
+
+
+def test_load_and_clear(engine):
+    engine.add(1, "a", {}, [0, 1], "08:00", TIMEZONE)
+    engine.store["other"] = 1
+
+    loaded = ReminderEngine(FakeJobQueue(), engine.user_data, None, next_weekly_time, engine.store)
+
+    assert loaded.load() == 2
+    assert loaded.slots == engine.slots
+
+    loaded.arm()
+    jobs = loaded.job_queue.pending()
+    loaded.clear()
+
+    assert engine.store == {"other": 1}
+    assert len(loaded) == 0
+    assert all(job.removed for job in jobs)
+
+
+def test_large_slot_is_staggered_over_the_spread_window(fired):
+    user_data = {user_id: dict() for user_id in range(250)}
+    engine = ReminderEngine(
+        FakeJobQueue(),
+        user_data,
+        lambda bot, reminders: fired.append([user_id for user_id, _, _ in reminders]),
+        next_weekly_time,
+        dict(),
+        spread=60,
+    )
+    for user_id in user_data:
+        engine.add(user_id, "a", {}, [0], "08:00", TIMEZONE)
+    engine.arm()
+    (job,) = engine.job_queue.pending()
+
+    fire(engine, job)
+
+    # First chunk is notified immediately, the others by jobs spaced over the window
+    assert fired == [list(range(REMINDER_CHUNK_SIZE))]
+    chunk_jobs = [queued for queued in engine.job_queue.jobs if queued.name.endswith(("chunk 1", "chunk 2"))]
+    assert [queued.when for queued in chunk_jobs] == [20, 40]
+
+    for chunk_job in chunk_jobs:
+        fire(engine, chunk_job)
+
+    assert fired[1] == list(range(REMINDER_CHUNK_SIZE, 2 * REMINDER_CHUNK_SIZE))
+    assert fired[2] == list(range(2 * REMINDER_CHUNK_SIZE, 250))
+
+
+def test_small_slot_is_notified_at_once(engine, fired):
+    engine.spread = 60
+    engine.add(1, "a", {}, [0], "08:00", TIMEZONE)
+    engine.arm()
+    (job,) = engine.job_queue.pending()
+
+    fire(engine, job)
+
+    assert fired == [("bot", [(1, {"name": "one"}, {})])]
+    assert len(engine.job_queue.jobs) == 2
+
+
+def make_updater(persistence=None):
+    schedule_data = {
+        notifications.SHIFT_TYPE: 0,
+        notifications.WHEN_DAYS: [1],
+        notifications.WHEN_TIME: "18:00",
+        notifications.WHEN_TIMEZONE: TIMEZONE,
+    }
+    return SimpleNamespace(
+        job_queue=FakeJobQueue(),
+        dispatcher=SimpleNamespace(
+            bot_data={"other": 1, SLOT_KEY_PREFIX + "stale": dict(), notifications.REMINDER_INDEX_VERSION: 1},
+            user_data={1: {notifications.SHIFT_REMINDERS: [schedule_data]}},
+            persistence=persistence,
+        ),
+    )
+
+
+def test_index_is_kept_in_memory_without_sqlite():
+    updater = make_updater()
+    notifications.setup_scheduler(updater, lambda bot, reminders: None)
+
+    # The index keys left in bot_data are removed and the index isn't stored there
+    assert updater.dispatcher.bot_data == {"other": 1}
+    assert notifications.reminder_engine.store[notifications.REMINDER_INDEX_VERSION] == \
+        notifications.REMINDER_INDEX_CURRENT_VERSION
+    assert len(notifications.reminder_engine) == 1
+
+
+def test_index_is_stored_in_bot_data_with_sqlite(tmp_path):
+    persistence = SQLitePersistence(str(tmp_path / "data.sqlite"))
+    updater = make_updater(persistence)
+    updater.dispatcher.user_data = persistence.get_user_data()
+    updater.dispatcher.user_data.update(make_updater().dispatcher.user_data)
+    notifications.setup_scheduler(updater, lambda bot, reminders: None)
+    persistence.close()
+
+    bot_data = updater.dispatcher.bot_data
+    assert notifications.reminder_engine.store is bot_data
+    assert bot_data[notifications.REMINDER_INDEX_VERSION] == notifications.REMINDER_INDEX_CURRENT_VERSION
+    assert SLOT_KEY_PREFIX + "stale" not in bot_data
+    assert len(notifications.reminder_engine) == 1
+
+
+def test_notification_key_includes_the_timezone():
+    schedule_data = make_updater().dispatcher.user_data[1][notifications.SHIFT_REMINDERS][0]
+    moved = {**schedule_data, notifications.WHEN_TIMEZONE: "Europe/London"}
+    legacy = {key: value for key, value in schedule_data.items() if key != notifications.WHEN_TIMEZONE}
+
+    assert notifications.notification_key(schedule_data) != notifications.notification_key(moved)
+    assert notifications.notification_key(legacy) == \
+        notifications.notification_key({**legacy, notifications.WHEN_TIMEZONE: get_default_timezone()})
@@ -0,0 +1,88 @@
+"""Update router tests."""
+
+from queue import Queue
+
+import pytest
+from telegram import Bot, Update
+from telegram.ext import Dispatcher, TypeHandler
+
+from shift.router import UpdateRouter
+
+USER = {"id": 123456789, "is_bot": False, "first_name": "Mario"}
+CHAT = {"id": 123456789, "first_name": "Mario", "type": "private"}
+
+
+def message_update(text, entities=()):
+    return Update.de_json({
+        "update_id": 1,
+        "message": {"message_id": 1, "from": USER, "chat": CHAT, "date": 1760774400, "text": text,
+                    "entities": list(entities)},
+    }, None)
+
+
+def callback_update(data):
+    return Update.de_json({
+        "update_id": 1,
+        "callback_query": {"id": "1", "from": USER, "chat_instance": "1", "data": data,
+                           "message": {"message_id": 1, "chat": CHAT, "date": 1760774400, "text": "menu"}},
+    }, None)
+
+
+def record(name, calls):
+    return lambda update, context: calls.append(name)
+
+
+@pytest.fixture
+def calls():
+    return []
+
+
+@pytest.fixture
+def router(calls):
+    return UpdateRouter(
+        {"first": record("first", calls), "second": record("second", calls)},
+        record("input", calls),
+    )
+
+
+@pytest.mark.parametrize("data, expected", [
+    ("first#1.6716f000.signature", "first"),
+    ("second", "second"),
+    ("first_other#1", None),
+    ("unknown#first", None),
+    ("", None),
+])
+def test_callback_routes(router, data, expected):
+    assert router.check_update(callback_update(data)) is (router.callback_routes.get(expected) if expected else None)
+
+
+def test_text_input_is_routed(router):
+    assert router.check_update(message_update("ciao")) is router.input_callback
+
+
+def test_commands_and_other_objects_are_not_routed(router):
+    command = message_update("/turni", [{"offset": 0, "length": 6, "type": "bot_command"}])
+
+    assert router.check_update(command) is None
+    assert router.check_update("update") is None
+
+
+def test_dispatcher_routes_to_callback(router, calls):
+    dispatcher = Dispatcher(Bot("123456:TEST"), Queue())
+    dispatcher.add_handler(router)
+    # Updates not routed reach the next handlers of the group
+    dispatcher.add_handler(TypeHandler(Update, record("other", calls)))
+
+    dispatcher.process_update(callback_update("second#2"))
+    dispatcher.process_update(message_update("ciao"))
+    dispatcher.process_update(message_update("/turni", [{"offset": 0, "length": 6, "type": "bot_command"}]))
+    dispatcher.process_update(callback_update("unknown"))
+
+    assert calls == ["second", "input", "other", "other"]
+
+
+def test_route_as_plain_callback(router, calls):
+    router.route(callback_update("first"), None)
+    router.route(callback_update("unknown"), None)
+
+    assert calls == ["first"]
@@ -0,0 +1,98 @@
+"""Recurring shift rules tests."""
+
+import datetime
+
+import pytest
+
+from shift.shiftsheduling import add_rule, encode_presence
+from shift.shiftstore import NO_SHIFT, ShiftStore
+
+# ISO week 43, odd
+MONDAY = datetime.date(2026, 10, 19)
+PRESENCE, SMART_WORKING = encode_presence(True), encode_presence(False)
+
+
+def day(days):
+    return MONDAY + datetime.timedelta(days=days)
+
+
+def make_store(*rules):
+    store = ShiftStore()
+    for rule in rules:
+        add_rule(store, "a", rule)
+    return store
+
+
+def test_explicit_shift_overrides_rules():
+    store = make_store({"weekdays": [0, 1], "presence": True})
+    store.set("a", MONDAY, SMART_WORKING)
+
+    assert store.get("a", MONDAY) == SMART_WORKING
+    assert store.get("a", day(1)) == PRESENCE
+    assert store.get("a", day(2)) == NO_SHIFT
+
+    # The explicit shift of a date wins also when it's set after the rules are evaluated
+    store.set("a", day(1), SMART_WORKING)
+
+    assert store.get("a", day(1)) == SMART_WORKING
+
+
+def test_first_matching_rule_wins():
+    store = make_store(
+        {"weekdays": [0], "presence": False},
+        {"weekdays": [0, 1, 2], "presence": True},
+    )
+
+    assert [store.get("a", day(days)) for days in range(4)] == [SMART_WORKING, PRESENCE, PRESENCE, NO_SHIFT]
+
+
+def test_from_and_until_are_inclusive():
+    store = make_store({"weekdays": list(range(7)), "presence": True, "from": day(1).isoformat(),
+                        "until": day(3).isoformat()})
+
+    assert [store.get("a", day(days)) for days in range(5)] == [NO_SHIFT, PRESENCE, PRESENCE, PRESENCE, NO_SHIFT]
+
+
+def test_rule_out_of_range_falls_through_to_next_rule():
+    store = make_store(
+        {"weekdays": [0], "presence": False, "until": day(6).isoformat()},
+        {"weekdays": [0], "presence": True},
+    )
+
+    assert store.get("a", MONDAY) == SMART_WORKING
+    assert store.get("a", day(7)) == PRESENCE
+
+
+@pytest.mark.parametrize("weeks, expected", [
+    ("odd", [PRESENCE, NO_SHIFT, PRESENCE]),
+    ("even", [NO_SHIFT, PRESENCE, NO_SHIFT]),
+])
+def test_odd_and_even_weeks(weeks, expected):
+    store = make_store({"weekdays": [0], "presence": True, "weeks": weeks})
+
+    assert [store.get("a", day(week * 7)) for week in range(3)] == expected
+
+
+def test_every_counts_weeks_from_the_start_week():
+    # Starts on Wednesday: the week of the start counts as the first one
+    store = make_store({"weekdays": [0, 2], "presence": True, "from": day(2).isoformat(), "every": 3})
+
+    assert store.get("a", MONDAY) == NO_SHIFT
+    assert store.get("a", day(2)) == PRESENCE
+    assert [store.get("a", day(week * 7)) for week in range(1, 7)] == [
+        NO_SHIFT, NO_SHIFT, PRESENCE, NO_SHIFT, NO_SHIFT, PRESENCE,
+    ]
+
+
+@pytest.mark.parametrize("rule", [
+    {"weekdays": [], "presence": True},
+    {"weekdays": [7], "presence": True},
+    {"weekdays": [True], "presence": True},
+    {"weekdays": [0], "presence": "yes"},
+    {"weekdays": [0], "presence": True, "weeks": "first"},
+    {"weekdays": [0], "presence": True, "every": 0},
+    {"weekdays": [0], "presence": True, "every": 2},
+])
+def test_invalid_rules(rule):
+    with pytest.raises(ValueError):
+        make_store(rule)
@@ -0,0 +1,118 @@
+"""Shift store tests."""
+
+import datetime
+
+from shift.shiftstore import NO_SHIFT, ShiftRule, ShiftStore
+
+MONDAY = datetime.date(2026, 10, 19)
+
+
+def test_set_and_get():
+    store = ShiftStore()
+    store.set("a", MONDAY, 1)
+    store.set("a", MONDAY + datetime.timedelta(days=2), 0)
+
+    assert store.get("a", MONDAY) == 1
+    assert store.get("a", MONDAY + datetime.timedelta(days=1)) == NO_SHIFT
+    assert store.get("a", MONDAY + datetime.timedelta(days=2)) == 0
+    assert store.get("a", MONDAY - datetime.timedelta(days=1)) == NO_SHIFT
+    assert store.get("missing", MONDAY) == NO_SHIFT
+
+
+def test_descending_dates_share_the_axis():
+    store = ShiftStore()
+    for days in range(100):
+        date = MONDAY - datetime.timedelta(days=days)
+        store.set("a", date, days % 2)
+        store.set("b", date, (days + 1) % 2)
+
+    for days in range(100):
+        date = MONDAY - datetime.timedelta(days=days)
+        assert store.get("a", date) == days % 2
+        assert store.get("b", date) == (days + 1) % 2
+
+
+def test_descending_dates_grow_the_front_geometrically():
+    store = ShiftStore()
+    lengths = set()
+    for days in range(1000):
+        store.set("a", MONDAY - datetime.timedelta(days=days), 1)
+        lengths.add(store.days)
+
+    # The axis is reallocated a logarithmic number of times, not at every date
+    assert len(lengths) < 20
+
+
+def test_compact_removes_leading_padding():
+    store = ShiftStore()
+    for days in range(10):
+        store.set("a", MONDAY - datetime.timedelta(days=days), 1)
+    store.set("b", MONDAY + datetime.timedelta(days=3), 0)
+
+    store.compact()
+
+    assert store.start_ordinal == (MONDAY - datetime.timedelta(days=9)).toordinal()
+    assert store.days == 13
+    assert store.get("a", MONDAY - datetime.timedelta(days=9)) == 1
+    assert store.get("b", MONDAY + datetime.timedelta(days=3)) == 0
+
+
+def test_window_pads_outside_axis():
+    store = ShiftStore()
+    store.set("a", MONDAY, 1)
+    store.set("a", MONDAY + datetime.timedelta(days=1), 0)
+
+    window = store.window("a", MONDAY.toordinal() - 2, 5)
+
+    assert list(window) == [NO_SHIFT, NO_SHIFT, 1, 0, NO_SHIFT]
+    assert list(store.window("missing", MONDAY.toordinal(), 2)) == [NO_SHIFT, NO_SHIFT]
+
+
+def test_diff_reports_changed_dates():
+    old = ShiftStore()
+    new = ShiftStore()
+    for store in (old, new):
+        store.set("a", MONDAY, 1)
+        store.set("b", MONDAY, 1)
+    new.set("a", MONDAY + datetime.timedelta(days=1), 0)
+
+    changes = new.diff(old, MONDAY.toordinal(), 7)
+
+    assert changes == {"a": [(MONDAY.toordinal() + 1, NO_SHIFT, 0)]}
+
+
+def test_diff_evaluates_rules_only_on_changed_dates():
+    old = ShiftStore()
+    new = ShiftStore()
+    for store in (old, new):
+        # Presence every weekday
+        store.add_rule("a", ShiftRule(1, 0b0011111))
+        store.set("a", MONDAY, 0)
+        store.set("a", MONDAY + datetime.timedelta(days=1), 0)
+    # Back to the rule shift on Tuesday, smart working on Wednesday
+    new.set("a", MONDAY + datetime.timedelta(days=1), NO_SHIFT)
+    new.set("a", MONDAY + datetime.timedelta(days=2), 0)
+
+    evaluated = []
+    rule_code = new.rule_code
+    new.rule_code = lambda group, ordinal: evaluated.append(ordinal) or rule_code(group, ordinal)
+
+    changes = new.diff(old, MONDAY.toordinal(), 7)
+
+    assert changes == {"a": [(MONDAY.toordinal() + 1, 0, 1), (MONDAY.toordinal() + 2, 1, 0)]}
+    assert evaluated == [MONDAY.toordinal() + 1]
+
+
+def test_diff_with_changed_rules_compares_the_whole_window():
+    old = ShiftStore()
+    new = ShiftStore()
+    old.add_rule("a", ShiftRule(1, 0b0000001))
+    new.add_rule("a", ShiftRule(1, 0b0000010))
+    new.add_rule("b", ShiftRule(0, 0b0000001))
+
+    changes = new.diff(old, MONDAY.toordinal(), 7)
+
+    assert changes == {
+        "a": [(MONDAY.toordinal(), 1, NO_SHIFT), (MONDAY.toordinal() + 1, NO_SHIFT, 1)],
+        "b": [(MONDAY.toordinal(), NO_SHIFT, 0)],
+    }
@@ -0,0 +1,114 @@
+"""Binary shifts snapshot tests."""
+
+import datetime
+import json
+
+import pytest
+
+from shift import shiftsheduling
+from shift.snapshot import (
+    HEADER,
+    SNAPSHOT_VERSION,
+    get_snapshot_filename,
+    load_snapshot,
+    source_hash,
+    write_snapshot,
+)
+
+MONDAY = datetime.date(2026, 10, 19)
+
+SHIFTS = {
+    "groups": [
+        {
+            "name": "a",
+            "shifts": [{"date": MONDAY.isoformat(), "presence": True}],
+            "rules": [{"weekdays": [2], "presence": False, "from": MONDAY.isoformat(), "weeks": "odd"}],
+        },
+        {"name": "b", "shifts": [{"date": (MONDAY + datetime.timedelta(days=3)).isoformat(), "presence": False}]},
+        {"name": "c"},
+    ]
+}
+
+
+@pytest.fixture
+def source(tmp_path):
+    file = tmp_path / "shifts.json"
+    file.write_text(json.dumps(SHIFTS))
+    return str(file)
+
+
+def test_snapshot_matches_parsed_store(source):
+    target = shiftsheduling.compile_snapshot(source)
+    parsed = shiftsheduling.parse_shifts(source)
+    mapped = load_snapshot(target, source_hash(source))
+
+    assert target == get_snapshot_filename(source)
+    assert list(mapped) == list(parsed) == ["a", "b", "c"]
+    assert mapped.rules == parsed.rules
+    for days in range(-7, 21):
+        date = MONDAY + datetime.timedelta(days=days)
+        for name in parsed:
+            assert mapped.get(name, date) == parsed.get(name, date)
+
+
+def test_read_shifts_uses_fresh_snapshot(source, monkeypatch):
+    shiftsheduling.compile_snapshot(source)
+    monkeypatch.setattr(shiftsheduling, "parse_shifts", None)
+
+    store = shiftsheduling.read_shifts(source)
+
+    assert store.get("a", MONDAY) == 1
+
+
+def test_stale_snapshot_is_ignored(source):
+    target = shiftsheduling.compile_snapshot(source)
+
+    with open(source, "w") as f:
+        json.dump({"groups": [{"name": "a", "shifts": [{"date": MONDAY.isoformat(), "presence": False}]}]}, f)
+
+    assert load_snapshot(target, source_hash(source)) is None
+    # Without the digest the outdated snapshot is still readable
+    assert load_snapshot(target).get("a", MONDAY) == 1
+
+    store = shiftsheduling.read_shifts(source)
+
+    assert list(store) == ["a"]
+    assert store.get("a", MONDAY) == 0
+
+
+def test_unsupported_version_is_ignored(source):
+    target = shiftsheduling.compile_snapshot(source)
+    with open(target, "r+b") as f:
+        header = list(HEADER.unpack(f.read(HEADER.size)))
+        header[1] = SNAPSHOT_VERSION + 1
+        f.seek(0)
+        f.write(HEADER.pack(*header))
+
+    assert load_snapshot(target, source_hash(source)) is None
+    assert shiftsheduling.read_shifts(source).get("a", MONDAY) == 1
+
+
+def test_truncated_snapshot_is_ignored(source):
+    target = shiftsheduling.compile_snapshot(source)
+    with open(target, "r+b") as f:
+        f.truncate(HEADER.size + 4)
+
+    assert load_snapshot(target, source_hash(source)) is None
+
+
+def test_missing_snapshot(tmp_path):
+    assert load_snapshot(str(tmp_path / "missing.snapshot")) is None
+
+
+def test_written_snapshot_header(source, tmp_path):
+    store = shiftsheduling.parse_shifts(source)
+    target = str(tmp_path / "target.snapshot")
+    write_snapshot(store, target, b"\1" * 32)
+
+    with open(target, "rb") as f:
+        magic, version, _, start_ordinal, days, groups, digest = HEADER.unpack(f.read(HEADER.size))
+
+    assert (magic, version) == (b"SHFT", SNAPSHOT_VERSION)
+    assert (start_ordinal, days, groups) == (store.start_ordinal, store.days, 3)
+    assert digest == b"\1" * 32
+    assert not list(tmp_path.glob("*.tmp"))
@@ -0,0 +1,106 @@
+"""SQLite persistence tests."""
+
+import pytest
+
+from shift.sqlitepersistence import LazyUserData, SQLitePersistence, pinned_user_data
+
+
+@pytest.fixture
+def database(tmp_path):
+    filename = str(tmp_path / "data.sqlite")
+    persistence = SQLitePersistence(filename)
+    for user_id in range(10):
+        persistence.update_user_data(user_id, {"value": user_id})
+    persistence.close()
+
+    return filename
+
+
+@pytest.fixture
+def persistence(database):
+    persistence = SQLitePersistence(database, user_data_cache_size=3)
+    yield persistence
+    persistence.close()
+
+
+def test_user_data_is_loaded_on_demand(persistence):
+    user_data = persistence.get_user_data()
+
+    assert isinstance(user_data, LazyUserData)
+    assert len(user_data) == 0
+    assert user_data[4] == {"value": 4}
+    assert user_data[42] == dict()
+    assert list(user_data) == [4, 42]
+
+
+def test_least_recently_used_is_evicted_and_written_back(persistence):
+    user_data = persistence.get_user_data()
+    for user_id in range(3):
+        user_data[user_id]["value"] += 100
+
+    # Access moves the user at the end of LRU order
+    user_data[0]
+    user_data[3]
+
+    assert list(user_data) == [2, 0, 3]
+
+    persistence.flush()
+    rows = persistence.connection.execute("SELECT user_id FROM user_data WHERE user_id = 1").fetchall()
+    assert rows == [(1,)]
+    # Evicted user data is loaded again with its changes
+    assert user_data[1] == {"value": 101}
+
+
+def test_pinned_user_data_is_not_evicted(persistence):
+    user_data = persistence.get_user_data()
+    pinned = user_data[0]
+
+    with pinned_user_data(user_data, [0]):
+        for user_id in range(1, 8):
+            user_data[user_id]
+
+        # The least recently used user is pinned, the next one is evicted
+        assert list(user_data) == [0, 6, 7]
+        assert user_data[0] is pinned
+
+
+def test_pinned_user_data_exceeds_maxsize_until_unpinned(persistence):
+    user_data = persistence.get_user_data()
+
+    with pinned_user_data(user_data, range(5)):
+        for user_id in range(5):
+            user_data[user_id]
+        user_data[5]
+
+        assert list(user_data) == [0, 1, 2, 3, 4]
+
+    # Unpin evicts the users exceeding maxsize
+    assert list(user_data) == [2, 3, 4]
+
+
+def test_pins_are_counted(persistence):
+    user_data = persistence.get_user_data()
+
+    with pinned_user_data(user_data, range(4)):
+        with pinned_user_data(user_data, [0]):
+            for user_id in range(4):
+                user_data[user_id]
+
+        assert len(user_data) == 4
+
+    assert len(user_data) == 3
+
+
+def test_pinned_user_data_without_lazy_cache():
+    user_data = {1: dict()}
+
+    with pinned_user_data(user_data, [1]):
+        assert user_data == {1: dict()}
+
+
+def test_iter_user_data_doesnt_fill_the_cache(persistence):
+    user_data = persistence.get_user_data()
+    user_data[0]["value"] = 100
+
+    assert dict(persistence.iter_user_data()) == {0: {"value": 100}, **{i: {"value": i} for i in range(1, 10)}}
+    assert list(user_data) == [0]
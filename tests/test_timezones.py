@@ -0,0 +1,107 @@
+"""Timezones tests, around the 2026 DST transitions of Europe/Rome (29 March and 25 October)."""
+
+import datetime
+import logging
+from types import SimpleNamespace
+
+import pytest
+
+from shift import bot, notifications
+from shift.datehelper import format_date
+from shift.shiftsheduling import ShiftType
+from shift.timezones import UTC, get_conversion_timezone, local_to_utc, next_weekly_time
+
+ROME = "Europe/Rome"
+SUNDAY = 6
+
+
+def utc(*args):
+    return datetime.datetime(*args, tzinfo=UTC)
+
+
+@pytest.mark.parametrize("date, when_time, expected", [
+    # Standard time (UTC+1) before the spring transition, summer time (UTC+2) from its day
+    (datetime.date(2026, 3, 28), "18:00", utc(2026, 3, 28, 17, 0)),
+    (datetime.date(2026, 3, 29), "01:59", utc(2026, 3, 29, 0, 59)),
+    (datetime.date(2026, 3, 29), "03:00", utc(2026, 3, 29, 1, 0)),
+    (datetime.date(2026, 3, 29), "18:00", utc(2026, 3, 29, 16, 0)),
+    # Summer time before the autumn transition, standard time from its day
+    (datetime.date(2026, 10, 24), "18:00", utc(2026, 10, 24, 16, 0)),
+    (datetime.date(2026, 10, 25), "01:59", utc(2026, 10, 24, 23, 59)),
+    (datetime.date(2026, 10, 25), "03:00", utc(2026, 10, 25, 2, 0)),
+    (datetime.date(2026, 10, 25), "18:00", utc(2026, 10, 25, 17, 0)),
+])
+def test_local_to_utc_uses_offset_of_date(date, when_time, expected):
+    assert local_to_utc(date, when_time, ROME) == expected
+
+
+def test_local_to_utc_skipped_time_moves_forward():
+    # 02:30 doesn't exist on 29 March: clocks jump from 02:00 to 03:00
+    assert local_to_utc(datetime.date(2026, 3, 29), "02:30", ROME) == utc(2026, 3, 29, 1, 30)
+
+
+def test_local_to_utc_ambiguous_time_is_first_occurrence():
+    # 02:30 happens twice on 25 October: first in summer time (00:30 UTC), then in standard time (01:30 UTC)
+    assert local_to_utc(datetime.date(2026, 10, 25), "02:30", ROME) == utc(2026, 10, 25, 0, 30)
+
+
+def test_local_to_utc_result_is_tz_aware_utc():
+    instant = local_to_utc(datetime.date(2026, 3, 29), "18:00", ROME)
+    assert instant.tzinfo is UTC
+
+
+@pytest.mark.parametrize("when_time, after, expected", [
+    # The week before the transition fires in standard time, the next one in summer time
+    ("18:00", utc(2026, 3, 22, 17, 1), utc(2026, 3, 29, 16, 0)),
+    ("18:00", utc(2026, 3, 29, 16, 1), utc(2026, 4, 5, 16, 0)),
+    ("18:00", utc(2026, 10, 18, 16, 1), utc(2026, 10, 25, 17, 0)),
+    ("18:00", utc(2026, 10, 25, 17, 1), utc(2026, 11, 1, 17, 0)),
+    # Skipped time fires once, an hour later in wall time
+    ("02:30", utc(2026, 3, 28, 12, 0), utc(2026, 3, 29, 1, 30)),
+    ("02:30", utc(2026, 3, 29, 1, 31), utc(2026, 4, 5, 0, 30)),
+    # Ambiguous time fires once, on its first occurrence, and not again on the second one
+    ("02:30", utc(2026, 10, 24, 12, 0), utc(2026, 10, 25, 0, 30)),
+    ("02:30", utc(2026, 10, 25, 0, 31), utc(2026, 11, 1, 1, 30)),
+])
+def test_next_weekly_time_across_transitions(when_time, after, expected):
+    assert next_weekly_time(SUNDAY, when_time, ROME, after) == expected
+
+
+def test_next_weekly_time_uses_local_date_of_after():
+    # 23:30 UTC of Saturday is already 00:30 of Sunday in Rome: Sunday 00:15 has passed, so it's next week
+    after = utc(2026, 3, 28, 23, 30)
+    assert next_weekly_time(SUNDAY, "00:15", ROME, after) == utc(2026, 4, 4, 22, 15)
+
+
+def test_next_weekly_time_same_instant_is_next_week():
+    after = utc(2026, 3, 29, 16, 0)
+    assert next_weekly_time(SUNDAY, "18:00", ROME, after) == utc(2026, 4, 5, 16, 0)
+
+
+def test_invalid_timezone_falls_back_to_default_with_warning(monkeypatch, caplog):
+    monkeypatch.delenv("DEFAULT_TIMEZONE", raising=False)
+    get_conversion_timezone.cache_clear()
+
+    with caplog.at_level(logging.WARNING, logger="shift.timezones"):
+        assert local_to_utc(datetime.date(2026, 3, 28), "18:00", "Atlantis/Lost") == utc(2026, 3, 28, 17, 0)
+        next_weekly_time(SUNDAY, "18:00", "Atlantis/Lost")
+
+    # Warned once per name
+    assert [record.getMessage() for record in caplog.records] == [
+        "Invalid timezone 'Atlantis/Lost', using the default timezone Europe/Rome"
+    ]
+    get_conversion_timezone.cache_clear()
+
+
+@pytest.mark.parametrize("compare_date, expected", [
+    # Reminder sent on Friday, Saturday and Sunday for the next day
+    (datetime.datetime(2026, 10, 17, 18, 0), "domani"),
+    (datetime.datetime(2026, 10, 18, 18, 0), format_date(datetime.datetime(2026, 10, 18, 18, 0))),
+    (datetime.datetime(2026, 10, 19, 18, 0), format_date(datetime.datetime(2026, 10, 19, 18, 0))),
+])
+def test_weekend_reminder_names_the_date(compare_date, expected):
+    sent = []
+    send_bot = SimpleNamespace(send_message=lambda **kwargs: sent.append(kwargs["text"]))
+    bot.shift_reminder(send_bot, 1, dict(), {notifications.SHIFT_TYPE: ShiftType.PRESENCE.value}, compare_date)
+
+    assert sent == [f"Hey. Ricordati che {expected} sarai in {ShiftType.PRESENCE.formatted}"]
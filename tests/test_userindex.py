@@ -0,0 +1,114 @@
+"""User index tests."""
+
+from types import SimpleNamespace
+
+import pytest
+
+from shift import bot
+from shift.constants import USER_GROUP
+from shift.sqlitepersistence import SQLitePersistence
+from shift.userindex import GROUP_KEY_PREFIX, USER_INDEX_KEY_PREFIX, USER_INDEX_VERSION, USERS_KEY, UserIndex, user_index
+
+USERS = {1: {"group": "a"}, 2: {"group": "a"}, 3: {"group": "b"}, 4: dict()}
+
+
+@pytest.fixture
+def index():
+    index = UserIndex()
+    index.build(USERS.items(), "group", dict())
+    return index
+
+
+def test_build(index):
+    assert len(index) == 4
+    assert 4 in index and 5 not in index
+    assert index.get_users() == [1, 2, 3, 4]
+    assert sorted(index.get_group_users("a")) == [1, 2]
+    assert index.get_group_users("b") == [3]
+    assert index.get_group_users("c") == []
+    assert index.store[USERS_KEY] == {1, 2, 3, 4}
+    assert index.store[GROUP_KEY_PREFIX + "a"] == {1, 2}
+
+
+def test_load_requires_the_index_version(index):
+    loaded = UserIndex()
+
+    assert loaded.load(dict(index.store))
+    assert loaded.user_groups == {1: "a", 2: "a", 3: "b"}
+    assert not loaded.load({USERS_KEY: {1}})
+    assert not loaded.load({**index.store, USER_INDEX_VERSION: 0})
+
+
+def test_build_replaces_the_stored_index(index):
+    index.store["other"] = 1
+    index.build({5: {"group": "c"}}.items(), "group")
+
+    assert index.store == {
+        "other": 1,
+        USERS_KEY: {5},
+        GROUP_KEY_PREFIX + "c": {5},
+        USER_INDEX_VERSION: index.store[USER_INDEX_VERSION],
+    }
+
+
+def test_updates_replace_the_sets(index):
+    users = index.store[USERS_KEY]
+    group_a = index.store[GROUP_KEY_PREFIX + "a"]
+
+    index.add_user(5)
+    index.add_user(5)
+    index.set_group(5, "a")
+    index.set_group(1, "b")
+    index.set_group(3, None)
+
+    assert users == {1, 2, 3, 4}
+    assert group_a == {1, 2}
+    assert index.get_users() == [1, 2, 3, 4, 5]
+    assert sorted(index.get_group_users("a")) == [2, 5]
+    assert index.get_group_users("b") == [1]
+
+    index.set_group(1, None)
+
+    assert GROUP_KEY_PREFIX + "b" not in index.store
+
+
+def test_index_is_persisted_and_only_changed_sets_are_written(tmp_path):
+    filename = str(tmp_path / "data.sqlite")
+    persistence = SQLitePersistence(filename, replaced_key_prefixes=(USER_INDEX_KEY_PREFIX,))
+    index = UserIndex()
+    index.build(USERS.items(), "group", persistence.get_bot_data())
+    persistence.update_bot_data(index.store)
+    persistence.close()
+
+    persistence = SQLitePersistence(filename, replaced_key_prefixes=(USER_INDEX_KEY_PREFIX,))
+    loaded = UserIndex()
+
+    assert loaded.load(persistence.get_bot_data())
+    assert loaded.store[USERS_KEY] == {1, 2, 3, 4}
+    assert sorted(loaded.get_group_users("a")) == [1, 2]
+
+    written = []
+    write_members = persistence._write_members
+    persistence._write_members = lambda key, members: written.append(key) or write_members(key, members)
+    loaded.set_group(4, "b")
+    persistence.update_bot_data(loaded.store)
+
+    assert written == [GROUP_KEY_PREFIX + "b"]
+    persistence.close()
+
+    persistence = SQLitePersistence(filename)
+    assert persistence.get_bot_data()[GROUP_KEY_PREFIX + "b"] == {3, 4}
+    persistence.close()
+
+
+def test_index_is_kept_in_memory_without_sqlite():
+    dispatcher = SimpleNamespace(
+        bot_data={"other": 1, USERS_KEY: {9}, USER_INDEX_VERSION: 1},
+        user_data={1: {USER_GROUP: "a"}, 2: dict()},
+        persistence=None,
+    )
+    bot.setup_user_index(dispatcher)
+
+    assert dispatcher.bot_data == {"other": 1}
+    assert user_index.get_users() == [1, 2]
+    assert user_index.get_group_users("a") == [1]
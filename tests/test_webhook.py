@@ -0,0 +1,197 @@
+"""Webhook listener tests."""
+
+import datetime
+import http.client
+import json
+from queue import Queue
+
+import pytest
+from telegram import Bot, Update
+from telegram.ext import TypeHandler, Updater
+
+from benchmarks.fakeapi import FakeBotApi
+from shift import bot, shiftsheduling
+from shift.constants import ENABLED_USERS, LOGGED, USER_GROUP
+from shift.helpers import get_callback_key
+from shift.lrucache import LRUCache
+from shift.shiftsheduling import ShiftType
+from shift.shiftstore import ShiftStore
+from shift.webhook import SECRET_TOKEN_HEADER, WebhookServer, start_webhook
+
+PATH = "/telegram"
+SECRET_TOKEN = "secret"
+# Update recorded from the Bot API (/turni sent in a private chat)
+UPDATE = {
+    "update_id": 518423001,
+    "message": {
+        "message_id": 1042,
+        "from": {"id": 123456789, "is_bot": False, "first_name": "Mario", "language_code": "it"},
+        "chat": {"id": 123456789, "first_name": "Mario", "type": "private"},
+        "date": 1760774400,
+        "text": "/turni",
+        "entities": [{"offset": 0, "length": 6, "type": "bot_command"}],
+    },
+}
+
+
+@pytest.fixture
+def update_queue():
+    return Queue(maxsize=1)
+
+
+@pytest.fixture
+def server(update_queue):
+    server = WebhookServer("127.0.0.1", 0, PATH, SECRET_TOKEN, Bot("123456:TEST"), update_queue)
+    server.start()
+    yield server
+    server.shutdown()
+
+
+def post(server, body, path=PATH, secret_token=SECRET_TOKEN):
+    """
+    POST a body to the webhook server
+    :param server: webhook server
+    :param body: JSON body
+    :param path: request path
+    :param secret_token: secret token header (None to omit it)
+    :return: the response status
+    """
+    headers = {"Content-Type": "application/json"}
+    if secret_token is not None:
+        headers[SECRET_TOKEN_HEADER] = secret_token
+
+    connection = http.client.HTTPConnection(*server.server_address[:2], timeout=5)
+    try:
+        connection.request("POST", path, json.dumps(body), headers)
+        return connection.getresponse().status
+    finally:
+        connection.close()
+
+
+def test_update_reaches_queue(server, update_queue):
+    assert post(server, UPDATE) == 200
+
+    update = update_queue.get_nowait()
+    assert isinstance(update, Update)
+    assert update.update_id == UPDATE["update_id"]
+    assert update.effective_user.id == 123456789
+    assert update.effective_message.text == "/turni"
+
+
+@pytest.mark.parametrize("secret_token", [None, "", "wrong"])
+def test_bad_secret_token_is_forbidden(server, update_queue, secret_token):
+    assert post(server, UPDATE, secret_token=secret_token) == 403
+    assert update_queue.empty()
+
+
+def test_unknown_path_is_not_found(server, update_queue):
+    assert post(server, UPDATE, path="/other") == 404
+    assert update_queue.empty()
+
+
+def test_invalid_update_is_bad_request(server, update_queue):
+    assert post(server, [UPDATE]) == 400
+    assert update_queue.empty()
+
+
+def test_full_queue_is_unavailable(server, update_queue):
+    assert post(server, UPDATE) == 200
+    assert post(server, dict(UPDATE, update_id=UPDATE["update_id"] + 1)) == 503
+    assert update_queue.qsize() == 1
+
+
+def test_shutdown_closes_listener(update_queue):
+    server = WebhookServer("127.0.0.1", 0, PATH, SECRET_TOKEN, Bot("123456:TEST"), update_queue)
+    server.start()
+    address = server.server_address[:2]
+    server.shutdown()
+
+    with pytest.raises(ConnectionRefusedError):
+        http.client.HTTPConnection(*address, timeout=5).connect()
+
+
+@pytest.fixture
+def api():
+    api = FakeBotApi()
+    api.start()
+    yield api
+    api.stop()
+
+
+def test_updater_stop_closes_listener_then_drains_queue(api):
+    updater = Updater(bot=Bot("123456:TEST", base_url=api.base_url))
+    processed = []
+    updater.dispatcher.add_handler(TypeHandler(Update, lambda update, context: processed.append(update.update_id)))
+
+    server = start_webhook(updater, None, "127.0.0.1", 0, PATH, SECRET_TOKEN, queue_size=10)
+    assert updater.httpd is server
+    address = server.server_address[:2]
+    assert post(server, UPDATE) == 200
+
+    updater.stop()
+
+    assert processed == [UPDATE["update_id"]]
+    assert updater.httpd is None
+    with pytest.raises(ConnectionRefusedError):
+        http.client.HTTPConnection(*address, timeout=5).connect()
+
+
+@pytest.fixture
+def shift_bot(api, monkeypatch):
+    monkeypatch.setenv("CALLBACK_SECRET", "test")
+    get_callback_key.cache_clear()
+    store = ShiftStore()
+    # /turni shows the next week on Sunday
+    for days in range(-7, 14):
+        store.set("a", datetime.date.today() + datetime.timedelta(days=days), ShiftType.PRESENCE.value)
+    monkeypatch.setattr(shiftsheduling, "shift_store", store)
+    monkeypatch.setattr(shiftsheduling, "week_cache", LRUCache(0))
+
+    updater = Updater(bot=Bot("123456:TEST", base_url=api.base_url))
+    bot.register_handlers(updater.dispatcher)
+    server = start_webhook(updater, None, "127.0.0.1", 0, PATH, SECRET_TOKEN, queue_size=10)
+    yield updater, server
+    updater.stop()
+    get_callback_key.cache_clear()
+
+
+def command_update(update_id, text):
+    """
+    Gets a command update of the recorded user
+    :param update_id: update id
+    :param text: command text
+    :return: the update
+    """
+    message = dict(UPDATE["message"], text=text, entities=[{"offset": 0, "length": len(text), "type": "bot_command"}])
+    return {"update_id": update_id, "message": message}
+
+
+def sent_message(api, chat_id):
+    return api.wait_call(
+        lambda call: call["method"] == "sendMessage" and int(call["params"]["chat_id"]) == chat_id,
+        timeout=5,
+    )
+
+
+def test_start_command_is_answered(shift_bot, api):
+    _, server = shift_bot
+
+    assert post(server, command_update(1, "/start")) == 200
+
+    call = sent_message(api, 123456789)
+    assert call is not None
+    assert "Ciao" in call["params"]["text"]
+    assert "inline_keyboard" in json.loads(call["params"]["reply_markup"])
+
+
+def test_shifts_command_is_answered(shift_bot, api):
+    updater, server = shift_bot
+    updater.dispatcher.bot_data[ENABLED_USERS] = {123456789}
+    updater.dispatcher.user_data[123456789].update({LOGGED: True, USER_GROUP: "a"})
+
+    assert post(server, command_update(2, "/turni")) == 200
+
+    call = sent_message(api, 123456789)
+    assert call is not None
+    assert call["params"]["text"].startswith("Ecco i turni della settimana")
+    assert ShiftType.PRESENCE.formatted in call["params"]["text"]